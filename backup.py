@@ -0,0 +1,293 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+from database import Database
+
+SNAPSHOT_SUFFIX = '.db'
+
+
+class BackupError(Exception):
+    '''
+    Снимок базы поврежден или не может быть восстановлен.
+    '''
+
+
+def verify_snapshot(path):
+    '''
+    Проверяет снимок базы через PRAGMA integrity_check.
+
+    :param path: путь к файлу снимка
+    :type path: str
+    :returns: None
+    :raises BackupError: если снимок поврежден
+    '''
+    if not os.path.exists(path):
+        raise BackupError(f'Снимок не найден: {path}')
+    conn = sqlite3.connect(f'file:{quote(os.path.abspath(path))}?mode=ro', uri=True)
+    try:
+        rows = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f'Снимок {path} не читается: {e}') from e
+    finally:
+        conn.close()
+    if rows != ['ok']:
+        raise BackupError(f'Снимок {path} поврежден: ' + '; '.join(rows[:5]))
+
+
+def copy_database(source_name, dest_name, pages=256, pause=0.005, pin=True,
+                  journal_mode=None):
+    '''
+    Копирует базу через sqlite3 backup API небольшими шагами.
+
+    За шаг копируется pages страниц, между шагами - пауза pause
+    секунд, чтобы копирование не забирало диск у записи бота.
+    Встроенный sleep у Connection.backup срабатывает только на
+    SQLITE_BUSY, поэтому пауза делается в обратном вызове progress.
+
+    Если во время копирования базу меняет другое соединение, backup API
+    начинает копирование заново, и на занятой базе оно может не
+    закончиться никогда. При pin=True на источнике открывается
+    читающая транзакция: в режиме WAL она фиксирует снимок базы на
+    момент начала, писатели при этом не блокируются, а копия получается
+    согласованной на этот момент (point-in-time).
+
+    :param source_name: путь к исходной базе
+    :type source_name: str
+    :param dest_name: путь к файлу копии (перезаписывается)
+    :type dest_name: str
+    :param pages: страниц за шаг (-1 - все за один шаг)
+    :type pages: int
+    :param pause: пауза между шагами, сек
+    :type pause: float
+    :param pin: зафиксировать снимок читающей транзакцией
+    :type pin: bool
+    :param journal_mode: режим журнала копии (по умолчанию - как у источника)
+    :type journal_mode: str, optional
+    :returns: число шагов копирования
+    :rtype: int
+    '''
+    source = sqlite3.connect(source_name, isolation_level=None)
+    dest = sqlite3.connect(dest_name)
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        if remaining and pause:
+            time.sleep(pause)
+
+    try:
+        if pin:
+            source.execute('BEGIN')
+            source.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+        source.backup(dest, pages=pages, progress=progress)
+        if pin:
+            source.execute('COMMIT')
+        if journal_mode:
+            dest.execute(f'PRAGMA journal_mode={journal_mode}')
+    finally:
+        dest.close()
+        source.close()
+    return steps
+
+
+class BackupManager:
+    '''
+    Онлайн-резервные копии базы SQLite с ротацией.
+
+    Снимки пишутся в каталог directory под именами
+    <база>-ГГГГММДД-ЧЧММСС.db, бот при этом продолжает работать
+    (см. copy_database). Снимок переводится из WAL в обычный журнал,
+    чтобы он был одним самодостаточным файлом. Копия сначала пишется во временный файл и
+    проверяется integrity_check, и только целая копия получает имя
+    снимка; после этого старые снимки сверх keep удаляются.
+    '''
+
+    def __init__(self, db_name, directory, keep=7, pages=256, pause=0.005):
+        '''
+        :param db_name: путь к базе
+        :type db_name: str
+        :param directory: каталог снимков
+        :type directory: str
+        :param keep: сколько последних снимков хранить
+        :type keep: int
+        :param pages: страниц за шаг копирования
+        :type pages: int
+        :param pause: пауза между шагами, сек
+        :type pause: float
+        '''
+        self.db_name = db_name
+        self.directory = directory
+        self.keep = keep
+        self.pages = pages
+        self.pause = pause
+        self.prefix = os.path.splitext(os.path.basename(db_name))[0] + '-'
+
+    def backup(self, now=None):
+        '''
+        Делает проверенный снимок базы и удаляет устаревшие.
+
+        :param now: время снимка для имени файла (по умолчанию - сейчас)
+        :type now: datetime, optional
+        :returns: путь к снимку
+        :rtype: str
+        :raises BackupError: если копия не прошла проверку
+        '''
+        now = now or datetime.now()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, self.prefix + now.strftime('%Y%m%d-%H%M%S') + SNAPSHOT_SUFFIX
+        )
+        tmp = path + '.tmp'
+        started = time.monotonic()
+        try:
+            steps = copy_database(
+                self.db_name, tmp, self.pages, self.pause, journal_mode='DELETE'
+            )
+            verify_snapshot(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        logging.info(
+            'Снимок %s: %s байт, %s шагов, %.1f с',
+            path, os.path.getsize(path), steps, time.monotonic() - started
+        )
+        self.rotate()
+        return path
+
+    def snapshots(self):
+        '''
+        Возвращает снимки базы, от новых к старым.
+
+        :rtype: list
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(
+            (name for name in os.listdir(self.directory)
+             if name.startswith(self.prefix) and name.endswith(SNAPSHOT_SUFFIX)),
+            reverse=True
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def rotate(self):
+        '''
+        Удаляет снимки сверх keep последних.
+
+        :returns: список удаленных снимков
+        :rtype: list
+        '''
+        removed = self.snapshots()[self.keep:]
+        for path in removed:
+            os.remove(path)
+        return removed
+
+
+def restore(snapshot, db_name, pages=-1):
+    '''
+    Восстанавливает базу из снимка.
+
+    Бот должен быть остановлен. Снимок сначала проверяется, затем
+    записывается в базу через backup API, а не копированием файла:
+    так SQLite сам учитывает WAL и -shm текущей базы, и старые кадры
+    WAL не накатятся поверх восстановленных страниц.
+
+    :param snapshot: путь к снимку
+    :type snapshot: str
+    :param db_name: путь к восстанавливаемой базе
+    :type db_name: str
+    :param pages: страниц за шаг копирования
+    :type pages: int
+    :returns: None
+    :raises BackupError: если снимок поврежден
+    '''
+    verify_snapshot(snapshot)
+    copy_database(snapshot, db_name, pages=pages, pause=0, pin=False)
+    verify_snapshot(db_name)
+
+
+def build_backup(db):
+    '''
+    Создает менеджер резервных копий, если они включены в окружении.
+
+    Переменные окружения:
+        BACKUP_DIR: каталог снимков (не задано - выключено)
+        BACKUP_KEEP: сколько последних снимков хранить (7)
+        BACKUP_PAGES: страниц за шаг копирования (256)
+        BACKUP_PAUSE_MS: пауза между шагами, мс (5)
+
+    Резервные копии работают только поверх SQLite: для других
+    хранилищ возвращается None.
+
+    :param db: хранилище задач
+    :type db: TaskStore
+    :returns: менеджер резервных копий или None
+    :rtype: BackupManager or None
+    '''
+    directory = os.getenv('BACKUP_DIR')
+    if not directory or not isinstance(db, Database):
+        return None
+    return BackupManager(
+        db.db_name,
+        directory,
+        keep=int(os.getenv('BACKUP_KEEP', '7')),
+        pages=int(os.getenv('BACKUP_PAGES', '256')),
+        pause=float(os.getenv('BACKUP_PAUSE_MS', '5')) / 1000,
+    )
+
+
+def main():
+    '''
+    CLI резервных копий.
+
+    python backup.py create --dir backups
+    python backup.py list --dir backups
+    python backup.py verify backups/todo_bot-20240101-030000.db
+    python backup.py restore backups/todo_bot-20240101-030000.db
+    '''
+    parser = argparse.ArgumentParser(description='Резервные копии базы')
+    parser.add_argument('--db', default='todo_bot.db', help='путь к файлу БД')
+    parser.add_argument('--dir', default=os.getenv('BACKUP_DIR', 'backups'),
+                        help='каталог снимков')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='сделать снимок работающей базы')
+    create.add_argument('--keep', type=int, default=int(os.getenv('BACKUP_KEEP', '7')))
+    create.add_argument('--pages', type=int, default=int(os.getenv('BACKUP_PAGES', '256')))
+    create.add_argument('--pause-ms', type=float,
+                        default=float(os.getenv('BACKUP_PAUSE_MS', '5')))
+    commands.add_parser('list', help='показать снимки')
+    check = commands.add_parser('verify', help='проверить снимок')
+    check.add_argument('snapshot')
+    back = commands.add_parser('restore', help='восстановить базу из снимка (бот остановлен)')
+    back.add_argument('snapshot', nargs='?', help='снимок (по умолчанию - последний)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'create':
+        manager = BackupManager(args.db, args.dir, args.keep, args.pages, args.pause_ms / 1000)
+        print(manager.backup())
+    elif args.command == 'list':
+        for path in BackupManager(args.db, args.dir).snapshots():
+            print(f'{path}\t{os.path.getsize(path)}')
+    elif args.command == 'verify':
+        verify_snapshot(args.snapshot)
+        print('ok')
+    else:
+        snapshot = args.snapshot
+        if snapshot is None:
+            snapshots = BackupManager(args.db, args.dir).snapshots()
+            if not snapshots:
+                parser.error(f'в {args.dir} нет снимков')
+            snapshot = snapshots[0]
+        restore(snapshot, args.db)
+        print(f'{args.db} восстановлена из {snapshot}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,870 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+from session import (
+    LANE_BACKGROUND, LANE_INTERACTIVE, TunedSession, outbound_lane
+)
+
+BENCH_TOKEN = '42:BENCHMARK'
+
+
+class FakeBotAPI:
+    '''
+    Локальный сервер, имитирующий Telegram Bot API.
+
+    Отвечает на любые методы правдоподобными результатами
+    с заданной задержкой и считает пришедшие запросы.
+    '''
+
+    def __init__(self, latency=0.01):
+        '''
+        :param latency: искусственная задержка ответа, сек
+        :type latency: float
+        '''
+        self.latency = latency
+        self.calls = {}
+        self.active = 0
+        self.peak = 0
+        self._runner = None
+        self.port = None
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            form = await request.post()
+            await asyncio.sleep(self.latency)
+        finally:
+            self.active -= 1
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(form.get('chat_id', 1))
+            result = {
+                'message_id': int(form.get('message_id', 1)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': form.get('text', ''),
+            }
+        elif method == 'getMe':
+            result = {'id': 42, 'is_bot': True, 'first_name': 'bench'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        '''
+        Запускает сервер на свободном локальном порту.
+
+        :returns: базовый URL сервера
+        :rtype: str
+        '''
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{self.port}'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def reset(self):
+        self.calls = {}
+        self.peak = 0
+
+
+async def _session_scenario(bot, reminders, taps):
+    '''
+    Всплеск напоминаний вперемешку с двойными нажатиями кнопок:
+    каждое нажатие порождает два одинаковых answerCallbackQuery
+    и два одинаковых editMessageText.
+    '''
+    async def tap(i):
+        await asyncio.gather(
+            bot.answer_callback_query(f'cb{i}'),
+            bot.answer_callback_query(f'cb{i}'),
+            bot.edit_message_text('Твои задачи:', chat_id=i, message_id=i),
+            bot.edit_message_text('Твои задачи:', chat_id=i, message_id=i),
+        )
+
+    jobs = [bot.send_message(i, 'Напоминание') for i in range(reminders)]
+    jobs += [tap(i) for i in range(taps)]
+    started = time.perf_counter()
+    await asyncio.gather(*jobs)
+    return time.perf_counter() - started
+
+
+async def bench_session(reminders=2000, taps=500, latency=0.01):
+    '''
+    Сравнивает стандартную сессию aiogram с TunedSession
+    на локальном фейковом Bot API.
+    '''
+    server = FakeBotAPI(latency=latency)
+    base = await server.start()
+    api = TelegramAPIServer.from_base(base)
+    sessions = {
+        'default': AiohttpSession(api=api),
+        'tuned': TunedSession(api=api, limit=100, max_concurrency=50),
+    }
+    try:
+        for name, session in sessions.items():
+            server.reset()
+            bot = Bot(token=BENCH_TOKEN, session=session)
+            elapsed = await _session_scenario(bot, reminders, taps)
+            await session.close()
+            total = sum(server.calls.values())
+            print(
+                f'{name:8} {elapsed:7.3f} s  http={total:6d}  '
+                f'peak_concurrency={server.peak:4d}  '
+                f'rps={(reminders + taps * 4) / elapsed:8.0f}'
+            )
+    finally:
+        await server.stop()
+
+
+async def _lanes_scenario(bot, reminders, taps, reminder_lane):
+    '''
+    Пользователи нажимают кнопки каждые 5 мс, пока идет всплеск
+    напоминаний, отправленных в полосу reminder_lane.
+    '''
+    async def reminder(i):
+        with outbound_lane(reminder_lane):
+            await bot.send_message(i, 'Напоминание')
+
+    async def tap(i):
+        await bot.answer_callback_query(f'cb{i}')
+        await bot.edit_message_text('Твои задачи:', chat_id=i, message_id=i)
+
+    burst = [asyncio.ensure_future(reminder(i)) for i in range(reminders)]
+    interactive = []
+    for i in range(taps):
+        interactive.append(asyncio.ensure_future(tap(i)))
+        await asyncio.sleep(0.005)
+    await asyncio.gather(*interactive, *burst)
+
+
+async def bench_lanes(reminders=10000, taps=300, latency=0.02):
+    '''
+    Проверяет, что p95 интерактивных запросов не растет во время
+    всплеска из 10k напоминаний, если они идут в фоновой полосе.
+    '''
+    server = FakeBotAPI(latency=latency)
+    base = await server.start()
+    api = TelegramAPIServer.from_base(base)
+    runs = (
+        ('idle', 0, LANE_BACKGROUND),
+        ('burst-fifo', reminders, LANE_INTERACTIVE),
+        ('burst-lanes', reminders, LANE_BACKGROUND),
+    )
+    try:
+        for name, count, lane in runs:
+            session = TunedSession(api=api, max_concurrency=50, reserved=10)
+            bot = Bot(token=BENCH_TOKEN, session=session)
+            await _lanes_scenario(bot, count, taps, lane)
+            await session.close()
+            print(f'{name}:')
+            for lane_name, (n, p50, p95, p99) in session.latency_report().items():
+                print(
+                    f'  {lane_name:12} n={n:6d}  p50<={p50 * 1000:7.0f} ms  '
+                    f'p95<={p95 * 1000:7.0f} ms  p99<={p99 * 1000:7.0f} ms'
+                )
+    finally:
+        await server.stop()
+
+
+def synthetic_update(update_id, user_id, data=None):
+    '''
+    Собирает сырой апдейт: команду /start или нажатие кнопки с data.
+
+    :rtype: dict
+    '''
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+    if data is None:
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': chat, 'from': user, 'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        }}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+        'data': data, 'message': {
+            'message_id': 1, 'date': int(time.time()), 'chat': chat,
+            'text': 'menu',
+        },
+    }}
+
+
+def bench_shards(updates=6000, users=1000, counts=(1, 2, 4)):
+    '''
+    Пропускная способность шардированного режима с сессией-заглушкой
+    в зависимости от числа воркеров.
+    '''
+    from sharding import ShardRouter
+
+    os.environ.setdefault('BOT_TOKEN', BENCH_TOKEN)
+    actions = (None, 'list', 'stats')
+    stream = [
+        synthetic_update(i, 1000 + i % users, actions[i % len(actions)])
+        for i in range(updates)
+    ]
+    print(f'cpu_count={os.cpu_count()}')
+    for shards in counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            router = ShardRouter(shards, os.path.join(tmp, 'bench.db'), stub=True)
+            router.start()
+            started = time.perf_counter()
+            for update in stream:
+                router.route(update)
+            stats = router.stop()
+            elapsed = time.perf_counter() - started
+        print(
+            f'shards={shards}  {elapsed:7.2f} s  '
+            f'{updates / elapsed:8.0f} updates/s  per_shard={sorted(stats.values())}'
+        )
+
+
+async def bench_throttle(updates=200000, users=5000):
+    '''
+    Накладные расходы ThrottlingMiddleware на один апдейт.
+    '''
+    from types import SimpleNamespace
+
+    from aiogram.types import User
+
+    from middlewares import ThrottlingMiddleware
+
+    async def handler(event, data):
+        return None
+
+    async def answer(*args, **kwargs):
+        return None
+
+    actions = ('list', 'stats', 'add', 'done_1')
+    events = [
+        (SimpleNamespace(data=actions[i % len(actions)], answer=answer),
+         {'event_from_user': User(id=i % users, is_bot=False, first_name='u')})
+        for i in range(updates)
+    ]
+    middleware = ThrottlingMiddleware()
+
+    started = time.perf_counter()
+    for event, data in events:
+        await handler(event, data)
+    bare = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for event, data in events:
+        await middleware(handler, event, data)
+    throttled = time.perf_counter() - started
+
+    print(
+        f'без middleware {bare / updates * 1e6:6.2f} us/update  '
+        f'с middleware {throttled / updates * 1e6:6.2f} us/update  '
+        f'накладные {(throttled - bare) / updates * 1e6:6.2f} us  '
+        f'корзин={len(middleware.buckets)}'
+    )
+
+
+async def bench_logging(updates=3000, stall=0.0005):
+    '''
+    Задержка обработки апдейта с логами: выключены, синхронный
+    обработчик с медленным выводом, очередь (QueueHandler) и очередь
+    с сэмплированием. Медленный вывод имитирует задержки диска.
+    '''
+    import io
+    import logging
+
+    from aiogram import Bot, Dispatcher
+
+    from logconfig import configure_logging
+    from middlewares import CorrelationMiddleware
+    from session import StubSession
+
+    class StalledStream(io.StringIO):
+        def write(self, text):
+            time.sleep(stall)
+            return len(text)
+
+    dp = Dispatcher()
+    dp.update.outer_middleware(CorrelationMiddleware())
+
+    @dp.message()
+    async def handle(message):
+        logging.info('update user=%s text=%r', message.from_user.id, message.text)
+        logging.info('finalize_add_task: user=%s category=%r deadline=%r',
+                     message.from_user.id, None, None)
+        await message.answer('ok')
+
+    bot = Bot(BENCH_TOKEN, session=StubSession())
+    raw = [synthetic_update(i, i % 100) for i in range(updates)]
+    root = logging.getLogger()
+    saved = root.handlers[:], root.level
+
+    def plain(level, handler=None):
+        for old in root.handlers[:]:
+            root.removeHandler(old)
+        if handler is not None:
+            root.addHandler(handler)
+        root.setLevel(level)
+
+    modes = (
+        ('off', lambda: plain(logging.WARNING)),
+        ('sync', lambda: plain(logging.INFO, logging.StreamHandler(StalledStream()))),
+        ('queue', lambda: configure_logging(stream=StalledStream())),
+        ('queue+sample', lambda: configure_logging(
+            stream=StalledStream(), sample_rate=0.1)),
+    )
+    for mode, setup in modes:
+        listener = setup()
+        latencies = []
+        started = time.perf_counter()
+        for update in raw:
+            begin = time.perf_counter()
+            await dp.feed_raw_update(bot, update)
+            latencies.append(time.perf_counter() - begin)
+        elapsed = time.perf_counter() - started
+        if listener is not None:
+            listener.stop()
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1e6
+        p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+        print(f'{mode:12}  {updates / elapsed:8.0f} upd/s  '
+              f'p50={p50:7.1f} us  p99={p99:7.1f} us')
+    plain(saved[1])
+    for handler in saved[0]:
+        root.addHandler(handler)
+    await bot.session.close()
+
+
+async def bench_writes(concurrency=(100, 1000), ops_per_user=5):
+    '''
+    Записей в секунду при N одновременных пользователях:
+    транзакция на каждое изменение против групповой записи.
+    '''
+    from database import Database
+    from writer import GroupCommitWriter
+
+    async def user(store, user_id, sync):
+        for i in range(ops_per_user):
+            if sync:
+                task_id = store.add_task(user_id, f'Задача {i}')
+                store.mark_done(user_id, task_id)
+            else:
+                task_id = await store.add_task(user_id, f'Задача {i}')
+                await store.mark_done(user_id, task_id)
+
+    for users in concurrency:
+        for mode in ('per-op', 'group'):
+            with tempfile.TemporaryDirectory() as tmp:
+                db = Database(os.path.join(tmp, 'bench.db'))
+                db.create_table(None)
+                store = db
+                if mode == 'group':
+                    store = GroupCommitWriter(db)
+                    store.start()
+                started = time.perf_counter()
+                await asyncio.gather(*[
+                    user(store, user_id, mode == 'per-op') for user_id in range(users)
+                ])
+                elapsed = time.perf_counter() - started
+                batches = ''
+                if mode == 'group':
+                    batches = f'  batches={store.batches}'
+                    await store.close()
+            writes = users * ops_per_user * 2
+            print(
+                f'users={users:5d}  {mode:7}  {writes / elapsed:9.0f} writes/s{batches}'
+            )
+
+
+def bench_reads(users=1000, tasks_per_user=20, readers=4, duration=3.0):
+    '''
+    Задержки чтения списков при насыщенном писателе: пул соединений
+    только для чтения против чтения через соединение-писатель.
+    '''
+    import random
+    import threading
+
+    from database import Database
+
+    def read_via_writer(db, user_id):
+        with db._write_connection() as conn:
+            return conn.execute(
+                'SELECT id, user_id, task_text, category, done, deadline '
+                'FROM tasks WHERE user_id = ? ORDER BY id', (user_id,)
+            ).fetchall()
+
+    for mode, read in (('writer-conn', read_via_writer),
+                       ('read-pool', lambda db, uid: db.get_tasks(uid))):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, 'bench.db'), read_pool_size=readers)
+            db.create_table(None)
+            with db._write_connection() as conn:
+                conn.executemany(
+                    'INSERT INTO tasks (user_id, task_text) VALUES (?, ?)',
+                    [(u, f'Задача {i}') for u in range(users)
+                     for i in range(tasks_per_user)]
+                )
+            stop = threading.Event()
+            writes = [0]
+            latencies = []
+
+            def writer():
+                while not stop.is_set():
+                    db.add_task(random.randrange(users), 'Новая задача')
+                    writes[0] += 1
+
+            def reader():
+                local = []
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    read(db, random.randrange(users))
+                    local.append(time.perf_counter() - started)
+                latencies.extend(local)
+
+            threads = [threading.Thread(target=writer)]
+            threads += [threading.Thread(target=reader) for _ in range(readers)]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            db.close()
+        latencies.sort()
+
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+        print(
+            f'{mode:11}  reads={len(latencies):7d}  writes={writes[0]:6d}  '
+            f'p50={pct(50):7.2f} ms  p95={pct(95):7.2f} ms  p99={pct(99):7.2f} ms'
+        )
+
+
+def bench_stores(users=1000, tasks_per_user=20):
+    '''
+    Типовые операции бота на хранилищах TaskStore: SQLite (файл)
+    и в памяти (DB_BACKEND=memory).
+    '''
+    import random
+    from datetime import date, timedelta
+
+    from database import Database
+    from storage import MemoryTaskStore
+
+    rng = random.Random(1)
+    today = date(2030, 6, 15)
+    rows = [(u, f'Задача {i}', None, today + timedelta(days=rng.randrange(30)))
+            for u in range(users) for i in range(tasks_per_user)]
+    for name in ('sqlite', 'memory'):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = (Database(os.path.join(tmp, 'bench.db')) if name == 'sqlite'
+                     else MemoryTaskStore())
+            store.create_table(None)
+            timings = []
+            started = time.perf_counter()
+            ids = [store.add_task(*row) for row in rows]
+            timings.append(('add', len(rows), time.perf_counter() - started))
+            started = time.perf_counter()
+            for user_id in range(users):
+                store.get_tasks(user_id)
+            timings.append(('list', users, time.perf_counter() - started))
+            started = time.perf_counter()
+            for user_id in range(users):
+                store.get_due(user_id, today, today + timedelta(days=3))
+            timings.append(('due', users, time.perf_counter() - started))
+            started = time.perf_counter()
+            for task_id, row in zip(ids[::10], rows[::10]):
+                store.complete_task(row[0], task_id, today)
+            timings.append(('done', len(ids[::10]), time.perf_counter() - started))
+            started = time.perf_counter()
+            store.get_due_in_bucket(today + timedelta(days=1), 0, 0)
+            timings.append(('bucket', 1, time.perf_counter() - started))
+            store.close()
+        print(name + ': ' + '  '.join(
+            f'{op}={elapsed / count * 1e6:.1f} us' for op, count, elapsed in timings
+        ))
+
+
+def bench_subtasks(depth=500, width=5000, pages=20):
+    '''
+    Отрисовка списка задач с прогрессом по глубокому (цепочка из depth
+    подзадач) и широкому (width подзадач в два уровня) деревьям:
+    один рекурсивный запрос против обхода дерева запросом на узел (N+1).
+    Считаются SQL-запросы к базе (set_trace_callback) на одну отрисовку.
+    '''
+    from database import Database
+
+    user_id = 1
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'), read_pool_size=1)
+        db.create_table(None)
+        deep = db.add_task(user_id, 'Глубокая')
+        parent = deep
+        for i in range(depth):
+            parent = db.add_task(user_id, f'Шаг {i}', parent_id=parent)
+        wide = db.add_task(user_id, 'Широкая')
+        groups = [db.add_task(user_id, f'Группа {i}', parent_id=wide) for i in range(50)]
+        with db._write_connection() as conn:
+            conn.executemany(
+                'INSERT INTO tasks (user_id, task_text, parent_id, done) VALUES (?, ?, ?, ?)',
+                [(user_id, f'Пункт {i}', groups[i % len(groups)], i % 2)
+                 for i in range(width - len(groups))]
+            )
+        for i in range(pages):
+            db.add_task(user_id, f'Простая {i}')
+
+        statements = [0]
+        with db._read_connection() as conn:
+            conn.set_trace_callback(lambda sql: statements.__setitem__(0, statements[0] + 1))
+
+        def render_cte():
+            tasks = db.get_subtasks(user_id)
+            return db.get_progress(user_id, [task.id for task in tasks])
+
+        def render_naive():
+            progress = {}
+            for task in db.get_subtasks(user_id):
+                done = total = 0
+                stack = [task.id]
+                while stack:
+                    for sub in db.get_subtasks(user_id, stack.pop()):
+                        done += sub.done
+                        total += 1
+                        stack.append(sub.id)
+                if total:
+                    progress[task.id] = (done, total)
+            return progress
+
+        assert render_cte() == render_naive()
+        for mode, render in (('n+1', render_naive), ('recursive-cte', render_cte)):
+            statements[0] = 0
+            started = time.perf_counter()
+            render()
+            elapsed = time.perf_counter() - started
+            print(f'{mode:13}  tasks={depth + width + pages + 2}  '
+                  f'queries={statements[0]:6d}  {elapsed * 1000:8.1f} ms')
+        db.close()
+
+
+async def bench_lists(members=1000, edits=20, latency=0.005, window=0.2):
+    '''
+    Серия правок общего списка на members участников: рассылка
+    по правке каждому участнику против склейки ListNotifier
+    (одно сообщение на участника за окно). Отдельно - проверка
+    доступа участника к задачам списка по индексу членства.
+    '''
+    from database import Database
+    from fanout import ListNotifier
+
+    server = FakeBotAPI(latency=latency)
+    base = await server.start()
+    api = TelegramAPIServer.from_base(base)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'), read_pool_size=1)
+        db.create_table(None)
+        shared = db.create_list(1, 'Команда')
+        for user_id in range(2, members + 1):
+            db.join_list(user_id, shared.invite_code)
+        for user_id in range(1, edits + 1):
+            db.add_task(user_id, f'Задача {user_id}', list_id=shared.id)
+
+        started = time.perf_counter()
+        for user_id in range(1, members + 1):
+            db.get_subtasks(user_id, list_id=shared.id)
+        elapsed = time.perf_counter() - started
+        print(f'access     members={members}  '
+              f'{elapsed / members * 1e6:7.1f} us/list view')
+
+        async def naive(bot):
+            for author in range(1, edits + 1):
+                recipients = [user_id for user_id in db.get_list_members(shared.id)
+                              if user_id != author]
+                await asyncio.gather(*(
+                    bot.send_message(user_id, f'✅ Задача {author}')
+                    for user_id in recipients
+                ))
+
+        async def coalesced(bot):
+            notifier = ListNotifier(bot, db, window=window)
+            for author in range(1, edits + 1):
+                notifier.notify(shared.id, author, f'✅ Задача {author}')
+            await notifier._tasks[shared.id]
+
+        try:
+            for mode, scenario in (('per-edit', naive), ('coalesced', coalesced)):
+                server.reset()
+                session = TunedSession(api=api, limit=100, max_concurrency=50)
+                bot = Bot(token=BENCH_TOKEN, session=session)
+                started = time.perf_counter()
+                with outbound_lane(LANE_BACKGROUND):
+                    await scenario(bot)
+                elapsed = time.perf_counter() - started
+                await session.close()
+                print(f'{mode:10} edits={edits}  '
+                      f'sendMessage={server.calls.get("sendMessage", 0):6d}  '
+                      f'{elapsed:7.3f} s')
+        finally:
+            await server.stop()
+            db.close()
+
+
+def bench_events(users=1000, tasks_per_user=20, changes=200):
+    '''
+    Поиск изменений после серии правок: полное перечитывание задач
+    всех пользователей (сравнение со снимком) против чтения журнала
+    changes_since с последнего seq.
+    '''
+    import random
+
+    from database import Database
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'), read_pool_size=1)
+        db.create_table(None)
+        with db._write_connection() as conn:
+            conn.executemany(
+                'INSERT INTO tasks (user_id, task_text) VALUES (?, ?)',
+                [(user_id, f'Задача {i}')
+                 for user_id in range(users) for i in range(tasks_per_user)]
+            )
+        snapshot = {user_id: db.get_tasks(user_id) for user_id in range(users)}
+        seq = db.last_seq()
+
+        touched = set()
+        for _ in range(changes):
+            user_id = rng.randrange(users)
+            tasks = db.get_tasks(user_id)
+            if tasks and rng.random() < 0.5:
+                db.mark_done(user_id, rng.choice(tasks).id)
+            else:
+                db.add_task(user_id, 'Новая')
+            touched.add(user_id)
+
+        started = time.perf_counter()
+        rescanned = {user_id for user_id in range(users)
+                     if db.get_tasks(user_id) != snapshot[user_id]}
+        rescan = time.perf_counter() - started
+
+        started = time.perf_counter()
+        followed = {event.user_id for event in db.changes_since(seq)}
+        feed = time.perf_counter() - started
+
+        assert rescanned == followed == touched
+        print(f'rescan         queries={users:6d}  {rescan * 1000:8.1f} ms')
+        print(f'changes_since  events={changes:7d}  {feed * 1000:8.1f} ms  '
+              f'changed_users={len(followed)}')
+        db.close()
+
+
+def bench_backup(size_mb=2048, rate=200, idle=3.0):
+    '''
+    Задержки записи во время онлайн-снимка базы размером size_mb МБ:
+    без снимка, снимок одним шагом и снимок шагами по 256 страниц
+    с паузами. Писатель добавляет rate задач в секунду. Большая база
+    создается во временном каталоге (TMPDIR), нужно ~3x size_mb на диске.
+    '''
+    import sqlite3
+    import threading
+
+    from backup import copy_database
+    from database import Database
+
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, 'bench.db')
+        db = Database(name, read_pool_size=1)
+        db.create_table(None)
+        rows = size_mb * 1024 * 1024 // 2100
+        with db._write_connection() as conn:
+            conn.execute(
+                'WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ?) '
+                'INSERT INTO tasks (user_id, task_text) '
+                'SELECT i % 10000, hex(randomblob(1000)) FROM n', (rows - 1,)
+            )
+        conn = sqlite3.connect(name)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+        print(f'база: {os.path.getsize(name) / 2 ** 20:.0f} МБ')
+
+        modes = (
+            ('idle', None),
+            ('one-step', dict(pages=-1, pause=0)),
+            ('stepped', dict(pages=256, pause=0.005)),
+        )
+        for mode, options in modes:
+            stop = threading.Event()
+            latencies = []
+
+            def writer():
+                interval = 1 / rate
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    db.add_task(len(latencies) % 10000, 'Новая задача')
+                    elapsed = time.perf_counter() - started
+                    latencies.append(elapsed)
+                    time.sleep(max(0.0, interval - elapsed))
+
+            thread = threading.Thread(target=writer)
+            thread.start()
+            started = time.perf_counter()
+            if options is None:
+                time.sleep(idle)
+            else:
+                copy_database(name, os.path.join(tmp, 'snapshot.db'), **options)
+                os.remove(os.path.join(tmp, 'snapshot.db'))
+            duration = time.perf_counter() - started
+            stop.set()
+            thread.join()
+            latencies.sort()
+
+            def pct(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+            print(
+                f'{mode:8}  {duration:7.1f} s  writes={len(latencies):6d}  '
+                f'p50={pct(50):6.2f} ms  p99={pct(99):7.2f} ms  max={latencies[-1] * 1000:7.1f} ms'
+            )
+        db.close()
+
+
+def bench_recurrence(tasks=100000):
+    '''
+    Вычисление следующих повторений для 100k повторяющихся задач,
+    в том числе закрытых с опозданием (с перескоком пропущенных).
+    '''
+    import random
+    from datetime import date, timedelta
+
+    from recurrence import FREQUENCIES, make_rule, next_due, parse_rule
+
+    rng = random.Random(1)
+    today = date(2030, 6, 15)
+    items = []
+    for _ in range(tasks):
+        deadline = today - timedelta(days=rng.choice((0, 0, 0, 3, 40, 400)))
+        rule = make_rule(rng.choice(FREQUENCIES), deadline, rng.choice((1, 1, 2, 3)))
+        items.append((rule, deadline))
+
+    parse_rule.cache_clear()
+    for mode in ('parse-nocache', 'next_due'):
+        if mode == 'parse-nocache':
+            parse = parse_rule.__wrapped__
+            started = time.perf_counter()
+            for rule, deadline in items:
+                parse(rule)
+        else:
+            started = time.perf_counter()
+            for rule, deadline in items:
+                next_due(rule, deadline, today)
+        elapsed = time.perf_counter() - started
+        print(f'{mode:13}  tasks={tasks}  {elapsed * 1000:8.1f} ms  '
+              f'{elapsed / tasks * 1e6:6.2f} us/task')
+    info = parse_rule.cache_info()
+    print(f'кеш правил: hits={info.hits} misses={info.misses}')
+
+
+def bench_models(rows=100000):
+    '''
+    Память и время загрузки 100k задач в разных представлениях строки:
+    кортеж, Task (NamedTuple), dict, dataclass и dataclass(slots=True).
+    '''
+    import sqlite3
+    import tracemalloc
+    from dataclasses import dataclass, make_dataclass
+    from datetime import date
+
+    from database import from_epoch_day, task_row
+    from models import Task
+
+    fields = Task._fields
+    plain = make_dataclass('PlainTask', fields)
+    slotted = dataclass(slots=True)(make_dataclass('SlottedTask', fields))
+
+    def tuple_row(cursor, row):
+        return row[:5] + (from_epoch_day(row[5]),) + row[6:]
+
+    def dict_row(cursor, row):
+        return dict(zip(fields, tuple_row(cursor, row)))
+
+    factories = {
+        'tuple': tuple_row,
+        'Task': task_row,
+        'dict': dict_row,
+        'dataclass': lambda cursor, row: plain(*tuple_row(cursor, row)),
+        'dc-slots': lambda cursor, row: slotted(*tuple_row(cursor, row)),
+    }
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''CREATE TABLE tasks (id INTEGER PRIMARY KEY, user_id INTEGER,
+                    task_text TEXT, category TEXT, done INTEGER, deadline INTEGER,
+                    recurrence TEXT)''')
+    base = date(2030, 1, 1).toordinal() - date(1970, 1, 1).toordinal()
+    conn.executemany(
+        'INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(i, i % 1000, f'Задача {i}', 'Работа' if i % 3 else None, i % 2,
+          base + i % 365, 'FREQ=WEEKLY;INTERVAL=1' if i % 10 == 0 else None)
+         for i in range(rows)]
+    )
+    query = 'SELECT id, user_id, task_text, category, done, deadline, recurrence FROM tasks'
+
+    for name, factory in factories.items():
+        cursor = conn.cursor()
+        cursor.row_factory = factory
+        from_epoch_day.cache_clear()
+        started = time.perf_counter()
+        cursor.execute(query).fetchall()
+        elapsed = time.perf_counter() - started
+        from_epoch_day.cache_clear()
+        tracemalloc.start()
+        loaded = cursor.execute(query).fetchall()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:10}  rows={len(loaded)}  {size / len(loaded):6.0f} B/row  '
+              f'{elapsed * 1000:8.1f} ms')
+        del loaded
+    conn.close()
+
+
+BENCHMARKS = {
+    'session': bench_session,
+    'lanes': bench_lanes,
+    'shards': bench_shards,
+    'throttle': bench_throttle,
+    'logging': bench_logging,
+    'writes': bench_writes,
+    'reads': bench_reads,
+    'stores': bench_stores,
+    'subtasks': bench_subtasks,
+    'lists': bench_lists,
+    'events': bench_events,
+    'backup': bench_backup,
+    'recurrence': bench_recurrence,
+    'models': bench_models,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки бота')
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    args = parser.parse_args()
+    result = BENCHMARKS[args.name]()
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+)
+
+from models import DELIVERY_BLOCKED, DELIVERY_FAILED, DELIVERY_SENT
+from session import LANE_BACKGROUND, outbound_lane
+
+
+class Broadcaster:
+    '''
+    Рассылка сообщения администратора всем пользователям бота.
+
+    Получатели фиксируются в базе при создании рассылки. Пачки по batch
+    получателей читаются по ключу в очередь, из которой сообщения
+    отправляют workers конкурентных обработчиков; общий темп не выше
+    rate сообщений в секунду (лимит Telegram - около 30 в секунду на
+    бота). На TelegramRetryAfter все обработчики ждут указанное время,
+    после чего сообщение отправляется повторно.
+
+    Итоги доставки записываются в базу пачками: прерванная остановкой
+    бота рассылка продолжается после запуска (resume) с неотправленных
+    получателей. Сообщения последней незаписанной пачки при аварийном
+    завершении процесса могут уйти повторно. Пользователи, заблокировавшие
+    бота (TelegramForbiddenError), помечаются в реестре и пропускаются
+    следующими рассылками.
+
+    Переменные окружения:
+        BROADCAST_RATE: сообщений в секунду (25)
+        BROADCAST_WORKERS: одновременных отправок (8)
+        BROADCAST_BATCH: размер пачки получателей и записи итогов (100)
+    '''
+
+    RETRIES = 3
+
+    def __init__(self, bot, db, rate=None, workers=None, batch=None):
+        '''
+        :param bot: бот для отправки сообщений
+        :type bot: aiogram.Bot
+        :param db: хранилище задач и рассылок
+        :type db: TaskStore
+        :param rate: сообщений в секунду
+        :type rate: float, optional
+        :param workers: одновременных отправок
+        :type workers: int, optional
+        :param batch: размер пачки получателей
+        :type batch: int, optional
+        '''
+        self.bot = bot
+        self.db = db
+        self.rate = rate or float(os.getenv('BROADCAST_RATE', '25'))
+        self.workers = workers or int(os.getenv('BROADCAST_WORKERS', '8'))
+        self.batch = batch or int(os.getenv('BROADCAST_BATCH', '100'))
+        self._next = 0.0
+        self._tasks = {}
+
+    async def start(self, admin_id, text):
+        '''
+        Создает рассылку и запускает ее в фоне.
+
+        :param admin_id: ID администратора, автора рассылки
+        :type admin_id: int
+        :param text: текст сообщения
+        :type text: str
+        :returns: созданная рассылка
+        :rtype: Broadcast
+        '''
+        broadcast = await asyncio.to_thread(self.db.create_broadcast, admin_id, text)
+        self._launch(broadcast)
+        return broadcast
+
+    async def resume(self):
+        '''
+        Запускает рассылки, прерванные остановкой бота.
+
+        :returns: возобновленные рассылки
+        :rtype: list of Broadcast
+        '''
+        broadcasts = await asyncio.to_thread(self.db.get_unfinished_broadcasts)
+        for broadcast in broadcasts:
+            if broadcast.id not in self._tasks:
+                logging.info('Возобновление рассылки %s: осталось %s',
+                             broadcast.id, broadcast.pending)
+                self._launch(broadcast)
+        return broadcasts
+
+    def _launch(self, broadcast):
+        task = asyncio.create_task(self.run(broadcast))
+        self._tasks[broadcast.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast.id, None))
+
+    async def run(self, broadcast):
+        '''
+        Рассылает сообщение неотправленным получателям и сообщает
+        итог автору рассылки.
+
+        :param broadcast: рассылка
+        :type broadcast: Broadcast
+        :returns: рассылка с итоговой сводкой
+        :rtype: Broadcast
+        '''
+        queue = asyncio.Queue(self.workers * 2)
+        results = []
+
+        async def flush():
+            done = results[:]
+            results.clear()
+            await asyncio.to_thread(self.db.record_deliveries, broadcast.id, done)
+
+        async def produce():
+            after = 0
+            while True:
+                batch = await asyncio.to_thread(
+                    self.db.get_pending_recipients, broadcast.id, after, self.batch
+                )
+                if not batch:
+                    break
+                for user_id in batch:
+                    await queue.put(user_id)
+                after = batch[-1]
+            for _ in range(self.workers):
+                await queue.put(None)
+
+        async def work():
+            while (user_id := await queue.get()) is not None:
+                results.append((user_id, await self._deliver(user_id, broadcast.text)))
+                if len(results) >= self.batch:
+                    await flush()
+
+        try:
+            await asyncio.gather(produce(), *(work() for _ in range(self.workers)))
+        finally:
+            await asyncio.shield(flush())
+        broadcast = await asyncio.to_thread(self.db.finish_broadcast, broadcast.id)
+        logging.info('Рассылка %s завершена: %s', broadcast.id, broadcast)
+        try:
+            await self.bot.send_message(broadcast.admin_id, format_report(broadcast))
+        except Exception as e:
+            logging.warning('Не удалось отправить отчет о рассылке %s: %s', broadcast.id, e)
+        return broadcast
+
+    async def _throttle(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next)
+        self._next = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _deliver(self, user_id, text):
+        '''
+        Отправляет сообщение одному получателю.
+
+        :returns: статус доставки DELIVERY_*
+        :rtype: int
+        '''
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while True:
+            await self._throttle()
+            try:
+                with outbound_lane(LANE_BACKGROUND):
+                    await self.bot.send_message(user_id, text)
+                return DELIVERY_SENT
+            except TelegramRetryAfter as e:
+                self._next = max(self._next, loop.time() + e.retry_after)
+            except TelegramForbiddenError:
+                return DELIVERY_BLOCKED
+            except TelegramNetworkError as e:
+                failures += 1
+                if failures >= self.RETRIES:
+                    logging.warning('Рассылка не доставлена user=%s: %s', user_id, e)
+                    return DELIVERY_FAILED
+                await asyncio.sleep(failures)
+            except TelegramAPIError as e:
+                logging.warning('Рассылка не доставлена user=%s: %s', user_id, e)
+                return DELIVERY_FAILED
+
+    async def close(self):
+        '''
+        Останавливает рассылки, записав итоги уже отправленных сообщений.
+        Остаток будет разослан после запуска (resume).
+
+        :returns: None
+        '''
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def format_report(broadcast):
+    '''
+    Текст сводки доставки рассылки.
+
+    :param broadcast: рассылка
+    :type broadcast: Broadcast
+    :rtype: str
+    '''
+    state = 'завершена' if broadcast.finished else 'идет'
+    return (
+        f"Рассылка #{broadcast.id} {state}: получателей {broadcast.total}, "
+        f"отправлено {broadcast.sent}, заблокировали бота {broadcast.blocked}, "
+        f"ошибок {broadcast.failed}, осталось {broadcast.pending}."
+    )
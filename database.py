@@ -1,9 +1,162 @@
+import json
 import sqlite3
 import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
 from datetime import date
+from functools import lru_cache
+from urllib.parse import quote
 
+from models import (
+    DEFAULT_REMINDERS, DELIVERY_BLOCKED, DELIVERY_FAILED, DELIVERY_PENDING, DELIVERY_SENT,
+    REMIND_1D, Broadcast, Task, TaskEvent, TaskList, TaskRef
+)
+from recurrence import next_due
+from storage import TaskStore
 
-class Database:
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def to_epoch_day(value):
+    """
+    Переводит дату в номер дня от 1970-01-01, в котором хранятся дедлайны.
+
+    :param value: Дата или строка YYYY-MM-DD
+    :type value: datetime.date or str or None
+    :return: Номер дня или None
+    :rtype: int or None
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    return value.toordinal() - EPOCH_ORDINAL
+
+
+@lru_cache(maxsize=4096)
+def from_epoch_day(value):
+    """
+    Переводит номер дня от 1970-01-01 обратно в дату.
+
+    Дедлайны повторяются, поэтому даты кешируются: строки с одним
+    дедлайном ссылаются на один объект date.
+
+    :param value: Номер дня или None
+    :type value: int or None
+    :return: Дата или None
+    :rtype: datetime.date or None
+    """
+    if value is None:
+        return None
+    return date.fromordinal(value + EPOCH_ORDINAL)
+
+
+TASK_COLUMNS = (
+    'id, user_id, task_text, category, done, deadline, recurrence, parent_id, list_id, '
+    'reminders'
+)
+
+# Доступ к задаче: своя личная задача или задача общего списка, где
+# пользователь участник. Задача списка принадлежит списку, а не автору:
+# вышедший из списка теряет доступ и к своим задачам в нем.
+# Параметры: (user_id, user_id).
+TASK_ACCESS = (
+    '((list_id IS NULL AND user_id = ?) OR '
+    'list_id IN (SELECT list_id FROM list_members WHERE user_id = ?))'
+)
+
+
+def next_id(table):
+    """
+    Подзапрос следующего ID таблицы с AUTOINCREMENT по sqlite_sequence.
+
+    Сам SQLite выдает ID больше и счетчика, и наибольшего ID в таблице.
+    После перебалансировки шардов в таблице лежат строки из диапазонов
+    других шардов, и такой ID ушел бы в чужой диапазон; счетчик же
+    возвращается в диапазон шарда (sharding.reserve_id_range). Пока
+    счетчика нет, подзапрос дает NULL и ID выбирает SQLite.
+
+    :param table: имя таблицы
+    :type table: str
+    :rtype: str
+    """
+    return f"(SELECT seq + 1 FROM sqlite_sequence WHERE name = '{table}')"
+
+
+def task_row(cursor, row):
+    """
+    row_factory для строк задач с колонками TASK_COLUMNS.
+
+    :rtype: Task
+    """
+    return tuple.__new__(Task, (
+        row[0], row[1], row[2], row[3], bool(row[4]), from_epoch_day(row[5]),
+        row[6], row[7], row[8], row[9]
+    ))
+
+
+def task_ref_row(cursor, row):
+    """
+    row_factory для строк (id, user_id, task_text, deadline).
+
+    :rtype: TaskRef
+    """
+    return tuple.__new__(TaskRef, (row[0], row[1], row[2], from_epoch_day(row[3])))
+
+
+def task_event_row(cursor, row):
+    """
+    row_factory для строк (seq, user_id, task_id, kind, created_at).
+
+    :rtype: TaskEvent
+    """
+    return tuple.__new__(TaskEvent, row)
+
+
+def _snapshot(cursor, sql, params):
+    """
+    Снимок строк для восстановления при отмене: имена колонок и значения.
+
+    :rtype: dict
+    """
+    cursor.execute(sql, params)
+    return {
+        'columns': [column[0] for column in cursor.description],
+        'rows': cursor.fetchall(),
+    }
+
+
+def _restore(cursor, table, snapshot):
+    """
+    Возвращает в таблицу строки снимка _snapshot с их исходными ID.
+    """
+    columns = ', '.join(snapshot['columns'])
+    marks = ', '.join('?' * len(snapshot['columns']))
+    cursor.executemany(
+        f'INSERT OR IGNORE INTO {table} ({columns}) VALUES ({marks})',
+        [tuple(row) for row in snapshot['rows']]
+    )
+
+
+def _fetch(conn, factory, sql, params):
+    """
+    Выполняет запрос и собирает строки через row_factory.
+
+    :param conn: соединение с базой
+    :type conn: sqlite3.Connection
+    :param factory: row_factory курсора
+    :type factory: callable
+    :rtype: list
+    """
+    cursor = conn.cursor()
+    cursor.row_factory = factory
+    return cursor.execute(sql, params).fetchall()
+
+
+class Database(TaskStore):
     """
     Класс для работы с базой данных SQLite задач.
 
@@ -14,15 +167,214 @@ class Database:
     - Отметка выполнения
     - Удаление задач
     - Очистка всех задач пользователя
+    - Архивация давно выполненных задач
+
+    База работает в режиме WAL: все изменения идут через одно
+    соединение-писатель, а чтения (списки, статистика) - через пул
+    соединений только для чтения, которые не блокируются писателем.
+
+    Схема развивается миграциями из MIGRATIONS, номер примененной
+    миграции хранится в PRAGMA user_version.
+
+    Дедлайн хранится целым числом - номером дня от 1970-01-01,
+    а наружу отдается как datetime.date.
+
+    Подзадачи ссылаются на родительскую задачу через parent_id
+    (частичный индекс idx_tasks_parent); прогресс по всему поддереву
+    считается одним рекурсивным запросом (get_progress).
+
+    Задача может принадлежать общему списку (list_id): тогда с ней
+    работают все участники списка. Доступ проверяется условием
+    TASK_ACCESS по индексу участников idx_list_members_user.
+
+    Каждое изменение задач (добавление, выполнение, удаление, очистка)
+    в той же транзакции дописывается в журнал task_events с растущим
+    номером seq: по нему работают отмена (undo_last) и чтение изменений
+    другими процессами (changes_since).
+
+    Реализует интерфейс TaskStore (см. storage.py).
     """
-    def __init__(self, db_name='todo_bot.db'):
+    MIGRATIONS = (
+        (
+            'ALTER TABLE tasks ADD COLUMN done_at INTEGER',
+            "UPDATE tasks SET done_at = CAST(strftime('%s', 'now') AS INTEGER) "
+            'WHERE done = 1',
+            '''
+                CREATE TABLE tasks_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    task_text TEXT NOT NULL,
+                    category TEXT,
+                    done INTEGER DEFAULT 0,
+                    deadline DATE,
+                    done_at INTEGER
+                )
+            ''',
+            'CREATE INDEX idx_archive_user ON tasks_archive (user_id, id)',
+            'CREATE INDEX idx_tasks_done_at ON tasks (done_at) WHERE done = 1',
+        ),
+        (
+            'UPDATE tasks SET deadline = '
+            "CAST(julianday(deadline) - julianday('1970-01-01') AS INTEGER) "
+            "WHERE typeof(deadline) = 'text'",
+            'UPDATE tasks_archive SET deadline = '
+            "CAST(julianday(deadline) - julianday('1970-01-01') AS INTEGER) "
+            "WHERE typeof(deadline) = 'text'",
+            'CREATE INDEX idx_tasks_pending_deadline ON tasks (deadline) '
+            'WHERE done = 0 AND deadline IS NOT NULL',
+            'CREATE INDEX idx_tasks_user_pending_deadline ON tasks (user_id, deadline) '
+            'WHERE done = 0 AND deadline IS NOT NULL',
+        ),
+        (
+            'ALTER TABLE tasks ADD COLUMN recurrence TEXT',
+            'ALTER TABLE tasks_archive ADD COLUMN recurrence TEXT',
+        ),
+        (
+            '''
+            CREATE TABLE users (
+                user_id INTEGER PRIMARY KEY,
+                tz TEXT NOT NULL,
+                utc_offset INTEGER NOT NULL
+            )
+            ''',
+            'CREATE INDEX idx_users_tz ON users (tz)',
+        ),
+        (
+            '''
+            CREATE TABLE sent_reminders (
+                task_id INTEGER NOT NULL,
+                deadline INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                sent_at INTEGER NOT NULL,
+                PRIMARY KEY (task_id, deadline)
+            ) WITHOUT ROWID
+            ''',
+        ),
+        (
+            'ALTER TABLE tasks ADD COLUMN parent_id INTEGER',
+            'ALTER TABLE tasks_archive ADD COLUMN parent_id INTEGER',
+            'CREATE INDEX idx_tasks_parent ON tasks (parent_id) '
+            'WHERE parent_id IS NOT NULL',
+        ),
+        (
+            '''
+            CREATE TABLE lists (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                invite_code TEXT NOT NULL UNIQUE
+            )
+            ''',
+            '''
+            CREATE TABLE list_members (
+                list_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (list_id, user_id)
+            ) WITHOUT ROWID
+            ''',
+            'CREATE INDEX idx_list_members_user ON list_members (user_id, list_id)',
+            'ALTER TABLE tasks ADD COLUMN list_id INTEGER',
+            'ALTER TABLE tasks_archive ADD COLUMN list_id INTEGER',
+            'CREATE INDEX idx_tasks_list ON tasks (list_id) WHERE list_id IS NOT NULL',
+        ),
+        (
+            f'ALTER TABLE tasks ADD COLUMN reminders INTEGER NOT NULL DEFAULT {REMIND_1D}',
+            'ALTER TABLE tasks_archive ADD COLUMN reminders INTEGER NOT NULL '
+            f'DEFAULT {REMIND_1D}',
+            '''
+            CREATE TABLE sent_reminders_kind (
+                task_id INTEGER NOT NULL,
+                deadline INTEGER NOT NULL,
+                kind INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                sent_at INTEGER NOT NULL,
+                PRIMARY KEY (task_id, deadline, kind)
+            ) WITHOUT ROWID
+            ''',
+            'INSERT INTO sent_reminders_kind (task_id, deadline, kind, user_id, sent_at) '
+            f'SELECT task_id, deadline, {REMIND_1D}, user_id, sent_at FROM sent_reminders',
+            'DROP TABLE sent_reminders',
+            'ALTER TABLE sent_reminders_kind RENAME TO sent_reminders',
+        ),
+        (
+            '''
+            CREATE TABLE task_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                task_id INTEGER,
+                kind TEXT NOT NULL,
+                payload TEXT,
+                created_at INTEGER NOT NULL
+            )
+            ''',
+            'CREATE INDEX idx_task_events_user ON task_events (user_id, seq)',
+        ),
+        (
+            '''
+            CREATE TABLE users_registry (
+                user_id INTEGER PRIMARY KEY,
+                tz TEXT,
+                utc_offset INTEGER,
+                joined_at INTEGER,
+                blocked_at INTEGER
+            )
+            ''',
+            'INSERT INTO users_registry (user_id, tz, utc_offset) '
+            'SELECT user_id, tz, utc_offset FROM users',
+            'INSERT OR IGNORE INTO users_registry (user_id) '
+            'SELECT user_id FROM tasks WHERE user_id IS NOT NULL '
+            'UNION SELECT user_id FROM tasks_archive WHERE user_id IS NOT NULL',
+            'DROP TABLE users',
+            'ALTER TABLE users_registry RENAME TO users',
+            'CREATE INDEX idx_users_tz ON users (tz) WHERE tz IS NOT NULL',
+            '''
+            CREATE TABLE broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                finished_at INTEGER
+            )
+            ''',
+            '''
+            CREATE TABLE broadcast_recipients (
+                broadcast_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (broadcast_id, user_id)
+            ) WITHOUT ROWID
+            ''',
+            'CREATE INDEX idx_broadcast_pending ON broadcast_recipients '
+            f'(broadcast_id, user_id) WHERE status = {DELIVERY_PENDING}',
+        ),
+        (
+            '''
+            CREATE TABLE pending_updates (
+                update_id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                saved_at INTEGER NOT NULL
+            )
+            ''',
+        ),
+    )
+
+    def __init__(self, db_name='todo_bot.db', read_pool_size=4, trace=None):
         """
         Инициализирует объект базы данных.
 
         :param db_name: Имя файла базы данных
         :type db_name: str
+        :param read_pool_size: Число соединений только для чтения в пуле
+        :type read_pool_size: int
+        :param trace: Функция, получающая текст каждого выполненного
+            запроса (sqlite3 set_trace_callback), например для их подсчета
+        :type trace: callable, optional
         """
         self.db_name = db_name
+        self.trace = trace
+        self._writer = None
+        self._write_lock = threading.Lock()
+        self._readers = queue.LifoQueue(maxsize=read_pool_size)
         self._ensure_db_exists()
 
     def _ensure_db_exists(self):
@@ -33,43 +385,114 @@ class Database:
         """
         if not os.path.exists(self.db_name):
             conn = sqlite3.connect(self.db_name)
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
             conn.close()
 
-    def _get_connection(self):
+    @contextmanager
+    def _write_connection(self):
+        """
+        Выдает соединение-писатель внутри транзакции.
+
+        Транзакция фиксируется при выходе из блока и откатывается
+        при исключении. Одновременно писатель доступен одному потоку.
+
+        :return: Соединение с открытой транзакцией
+        :rtype: sqlite3.Connection
+        :raises sqlite3.Error: Если не удается установить соединение
+        """
+        with self._write_lock:
+            if self._writer is None:
+                conn = sqlite3.connect(
+                    self.db_name, isolation_level=None, check_same_thread=False
+                )
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=FULL')
+                conn.set_trace_callback(self.trace)
+                self._writer = conn
+            conn = self._writer
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    @contextmanager
+    def _read_connection(self):
         """
-        Создает и возвращает соединение с базой данных.
+        Выдает соединение только для чтения из пула.
 
-        :return: Соединение с SQLite базой данных
+        Соединение открыто с mode=ro и query_only, поэтому случайная
+        запись через него невозможна.
+
+        :return: Соединение только для чтения
         :rtype: sqlite3.Connection
         :raises sqlite3.Error: Если не удается установить соединение
         """
-        conn = sqlite3.connect(self.db_name)
-        return conn
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(
+                f'file:{quote(os.path.abspath(self.db_name))}?mode=ro',
+                uri=True, check_same_thread=False
+            )
+            conn.execute('PRAGMA query_only=1')
+            conn.set_trace_callback(self.trace)
+        try:
+            yield conn
+        finally:
+            try:
+                self._readers.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """
+        Закрывает соединение-писатель и все соединения пула чтения.
+        """
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
 
     def create_table(self, user_id):
         """
-        Создает таблицу tasks если она не существует.
+        Создает таблицу tasks если она не существует и применяет миграции.
 
         :param user_id: ID пользователя Telegram
         :type user_id: int
         :raises sqlite3.Error: Если не удается создать таблицу
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                task_text TEXT NOT NULL,
-                category TEXT,
-                done INTEGER DEFAULT 0,
-                deadline DATE
+        with self._write_connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    task_text TEXT NOT NULL,
+                    category TEXT,
+                    done INTEGER DEFAULT 0,
+                    deadline DATE
+                )
+            ''')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_tasks_user ON tasks (user_id)'
             )
-        ''')
-        conn.commit()
-        conn.close()
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number in range(version, len(self.MIGRATIONS)):
+                for statement in self.MIGRATIONS[number]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number + 1}')
 
-    def add_task(self, user_id, task_text, category=None, deadline=None):
+    def add_task(self, user_id, task_text, category=None, deadline=None,
+                 recurrence=None, parent_id=None, list_id=None,
+                 reminders=DEFAULT_REMINDERS):
         """
         Добавляет новую задачу для указанного пользователя.
 
@@ -81,21 +504,171 @@ class Database:
         :type category: str, optional
         :param deadline: Дедлайн задачи, необязательно
         :type deadline: datetime.date, optional
-        :return: ID добавленной задачи
-        :rtype: int
+        :param recurrence: Правило повторения (см. recurrence.py), требует дедлайна
+        :type recurrence: str, optional
+        :param parent_id: ID родительской задачи, если это подзадача
+        :type parent_id: int, optional
+        :param list_id: ID общего списка; подзадача наследует список родителя
+        :type list_id: int, optional
+        :param reminders: Смещения напоминаний, маска из констант REMIND_*
+        :type reminders: int
+        :return: ID добавленной задачи или None, если родительская задача
+            не найдена или пользователь не участник списка
+        :rtype: int or None
         :raises sqlite3.Error: Если не удается добавить задачу
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO tasks (user_id, task_text, category, deadline)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, task_text, category, deadline))
+        with self._write_connection() as conn:
+            return self._add_task(
+                conn.cursor(), user_id, task_text, category, deadline, recurrence,
+                parent_id, list_id, reminders
+            )
+
+    def _add_task(self, cursor, user_id, task_text, category=None, deadline=None,
+                  recurrence=None, parent_id=None, list_id=None,
+                  reminders=DEFAULT_REMINDERS):
+        """
+        Добавляет задачу в рамках уже открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: ID добавленной задачи или None
+        :rtype: int or None
+        """
+        if parent_id is not None:
+            parent = cursor.execute(
+                f'SELECT list_id FROM tasks WHERE id = ? AND {TASK_ACCESS}',
+                (parent_id, user_id, user_id)
+            ).fetchone()
+            if parent is None:
+                return None
+            list_id = parent[0]
+        elif list_id is not None and cursor.execute(
+            'SELECT 1 FROM list_members WHERE list_id = ? AND user_id = ?',
+            (list_id, user_id)
+        ).fetchone() is None:
+            return None
+        cursor.execute(f'''
+            INSERT INTO tasks (id, user_id, task_text, category, deadline, recurrence,
+                               parent_id, list_id, reminders)
+            VALUES ({next_id('tasks')}, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, task_text, category, to_epoch_day(deadline), recurrence,
+              parent_id, list_id, reminders))
         task_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        self._log_event(cursor, user_id, task_id, 'add')
         return task_id
 
+    def get_task(self, user_id, task_id):
+        """
+        Получает задачу пользователя (или его общего списка) по ID.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param task_id: ID задачи
+        :type task_id: int
+        :return: Задача или None, если она не найдена
+        :rtype: Task or None
+        :raises sqlite3.Error: Если не удается получить задачу
+        """
+        with self._read_connection() as conn:
+            rows = _fetch(conn, task_row, f'''
+                SELECT {TASK_COLUMNS}
+                FROM tasks WHERE id = ? AND {TASK_ACCESS}
+            ''', (task_id, user_id, user_id))
+        return rows[0] if rows else None
+
+    def get_subtasks(self, user_id, parent_id=None, list_id=None):
+        """
+        Получает подзадачи одного уровня.
+
+        Без parent_id возвращаются задачи верхнего уровня личного списка
+        (или общего списка list_id), в том числе подзадачи, чья
+        родительская задача уже ушла в архив.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param parent_id: ID родительской задачи
+        :type parent_id: int, optional
+        :param list_id: ID общего списка
+        :type list_id: int, optional
+        :return: Список задач в порядке ID
+        :rtype: list of Task
+        :raises sqlite3.Error: Если не удается получить задачи
+        """
+        top_level = '''(
+            parent_id IS NULL
+            OR NOT EXISTS (SELECT 1 FROM tasks p WHERE p.id = t.parent_id)
+        )'''
+        with self._read_connection() as conn:
+            if parent_id is not None:
+                return _fetch(conn, task_row, f'''
+                    SELECT {TASK_COLUMNS}
+                    FROM tasks WHERE parent_id = ? AND {TASK_ACCESS} ORDER BY id
+                ''', (parent_id, user_id, user_id))
+            if list_id is not None:
+                return _fetch(conn, task_row, f'''
+                    SELECT {TASK_COLUMNS}
+                    FROM tasks t
+                    WHERE list_id = ? AND {top_level} AND EXISTS (
+                        SELECT 1 FROM list_members m
+                        WHERE m.list_id = t.list_id AND m.user_id = ?
+                    )
+                    ORDER BY id
+                ''', (list_id, user_id))
+            return _fetch(conn, task_row, f'''
+                SELECT {TASK_COLUMNS}
+                FROM tasks t
+                WHERE user_id = ? AND list_id IS NULL AND {top_level}
+                ORDER BY id
+            ''', (user_id,))
+
+    def get_progress(self, user_id, task_ids):
+        """
+        Считает выполнение подзадач по всему поддереву каждой задачи.
+
+        Один рекурсивный запрос на весь список задач: число запросов
+        к базе не зависит ни от глубины, ни от ширины дерева.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param task_ids: ID задач, для которых нужен прогресс
+        :type task_ids: list of int
+        :return: Словарь {ID задачи: (выполнено, всего подзадач)},
+            задачи без подзадач в него не попадают
+        :rtype: dict
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        if not task_ids:
+            return {}
+        marks = ', '.join('?' * len(task_ids))
+        with self._read_connection() as conn:
+            rows = conn.execute(f'''
+                WITH RECURSIVE tree (root, id, done) AS (
+                    SELECT parent_id, id, done FROM tasks
+                    WHERE parent_id IN ({marks}) AND {TASK_ACCESS}
+                    UNION ALL
+                    SELECT tree.root, t.id, t.done
+                    FROM tasks t JOIN tree ON t.parent_id = tree.id
+                )
+                SELECT root, SUM(done), COUNT(*) FROM tree GROUP BY root
+            ''', (*task_ids, user_id, user_id)).fetchall()
+        return {root: (done, total) for root, done, total in rows}
+
+    def get_subtask_stats(self, user_id):
+        """
+        Считает подзадачи пользователя без выборки самих строк.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :return: Пара (всего подзадач, выполнено)
+        :rtype: tuple
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            return conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(done), 0) FROM tasks '
+                'WHERE user_id = ? AND parent_id IS NOT NULL', (user_id,)
+            ).fetchone()
+
     def get_tasks(self, user_id):
         """
         Получает все задачи для указанного пользователя.
@@ -103,18 +676,628 @@ class Database:
         :param user_id: ID пользователя Telegram
         :type user_id: int
         :return: Список задач пользователя
-        :rtype: list of tuples
+        :rtype: list of Task
+        :raises sqlite3.Error: Если не удается получить задачи
+        """
+        with self._read_connection() as conn:
+            return _fetch(conn, task_row, f'''
+                SELECT {TASK_COLUMNS}
+                FROM tasks WHERE user_id = ? ORDER BY id
+            ''', (user_id,))
+
+    def get_due(self, user_id, start, end):
+        """
+        Получает невыполненные задачи пользователя с дедлайном в диапазоне.
+
+        Запрос идет по частичному индексу (user_id, deadline)
+        невыполненных задач с дедлайном.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param start: Начало диапазона включительно, None - без ограничения
+        :type start: datetime.date or None
+        :param end: Конец диапазона включительно
+        :type end: datetime.date
+        :return: Список задач, ближайшие дедлайны первыми
+        :rtype: list of Task
+        :raises sqlite3.Error: Если не удается получить задачи
+        """
+        start_day = -2 ** 31 if start is None else to_epoch_day(start)
+        with self._read_connection() as conn:
+            return _fetch(conn, task_row, f'''
+                SELECT {TASK_COLUMNS}
+                FROM tasks
+                WHERE user_id = ? AND done = 0 AND deadline IS NOT NULL
+                  AND deadline BETWEEN ? AND ?
+                ORDER BY deadline, id
+            ''', (user_id, start_day, to_epoch_day(end)))
+
+    def get_stats(self, user_id):
+        """
+        Считает задачи пользователя без выборки самих строк.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :return: Пара (всего задач, выполнено)
+        :rtype: tuple
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            total, done = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(done), 0) FROM tasks WHERE user_id = ?',
+                (user_id,)
+            ).fetchone()
+            archived = conn.execute(
+                'SELECT COUNT(*) FROM tasks_archive WHERE user_id = ?', (user_id,)
+            ).fetchone()[0]
+        return total + archived, done + archived
+
+    def get_due_in_bucket(self, day, utc_offset, default_offset, kind=REMIND_1D):
+        """
+        Получает невыполненные задачи с дедлайном day у пользователей
+        с заданным смещением от UTC, у которых включено напоминание kind.
+
+        Задачи выбираются по частичному индексу дедлайнов, пользователи -
+        по первичному ключу users. Пользователи без своего пояса
+        считаются живущими со смещением default_offset. Задачи, о которых
+        уже напомнили с этим смещением (см. mark_reminded), пропускаются.
+
+        :param day: Дата дедлайна
+        :type day: datetime.date
+        :param utc_offset: Смещение пояса от UTC в минутах
+        :type utc_offset: int
+        :param default_offset: Смещение пояса по умолчанию в минутах
+        :type default_offset: int
+        :param kind: Смещение напоминания, одна из констант REMIND_*
+        :type kind: int
+        :return: Список задач (только поля, нужные для напоминания)
+        :rtype: list of TaskRef
         :raises sqlite3.Error: Если не удается получить задачи
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, user_id, task_text, category, done, deadline
-            FROM tasks WHERE user_id = ? ORDER BY id
-        ''', (user_id,))
-        tasks = cursor.fetchall()
-        conn.close()
-        return tasks
+        with self._read_connection() as conn:
+            return _fetch(conn, task_ref_row, '''
+                SELECT t.id, t.user_id, t.task_text, t.deadline
+                FROM tasks t LEFT JOIN users u ON u.user_id = t.user_id
+                WHERE t.done = 0 AND t.deadline IS NOT NULL AND t.deadline = ?
+                  AND t.reminders & ? != 0
+                  AND COALESCE(u.utc_offset, ?) = ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM sent_reminders s
+                      WHERE s.task_id = t.id AND s.deadline = t.deadline AND s.kind = ?
+                  )
+                ORDER BY t.id
+            ''', (to_epoch_day(day), kind, default_offset, utc_offset, kind))
+
+    def mark_reminded(self, tasks, kind=REMIND_1D):
+        """
+        Запоминает отправленные напоминания, чтобы не повторять их
+        после перезапуска бота.
+
+        :param tasks: Задачи, о которых напомнили
+        :type tasks: list of TaskRef
+        :param kind: Смещение напоминания, одна из констант REMIND_*
+        :type kind: int
+        :raises sqlite3.Error: Если не удается сохранить отметки
+        """
+        if not tasks:
+            return
+        now = int(time.time())
+        with self._write_connection() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO sent_reminders '
+                '(task_id, deadline, kind, user_id, sent_at) VALUES (?, ?, ?, ?, ?)',
+                [(task.id, to_epoch_day(task.deadline), kind, task.user_id, now)
+                 for task in tasks]
+            )
+
+    def set_reminders(self, user_id, task_id, reminders):
+        """
+        Задает смещения напоминаний задачи.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param task_id: ID задачи
+        :type task_id: int
+        :param reminders: Маска из констант REMIND_*
+        :type reminders: int
+        :return: True, если задача найдена
+        :rtype: bool
+        :raises sqlite3.Error: Если не удается сохранить смещения
+        """
+        with self._write_connection() as conn:
+            return conn.execute(
+                f'UPDATE tasks SET reminders = ? WHERE id = ? AND {TASK_ACCESS}',
+                (reminders, task_id, user_id, user_id)
+            ).rowcount > 0
+
+    def toggle_reminder(self, user_id, task_id, kind):
+        """
+        Включает или выключает одно смещение напоминаний задачи.
+
+        Бит переключается одним UPDATE, поэтому два быстрых нажатия
+        разных смещений не затирают друг друга.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param task_id: ID задачи
+        :type task_id: int
+        :param kind: Смещение, одна из констант REMIND_*
+        :type kind: int
+        :return: Новая маска смещений или None, если задача не найдена
+        :rtype: int or None
+        :raises sqlite3.Error: Если не удается сохранить смещения
+        """
+        with self._write_connection() as conn:
+            return self._toggle_reminder(conn.cursor(), user_id, task_id, kind)
+
+    def _toggle_reminder(self, cursor, user_id, task_id, kind):
+        """
+        Переключает смещение напоминаний в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: Новая маска смещений или None
+        :rtype: int or None
+        """
+        # В SQLite нет XOR: a ^ b = (a | b) - (a & b).
+        if not cursor.execute(
+            'UPDATE tasks SET reminders = (reminders | ?) - (reminders & ?) '
+            f'WHERE id = ? AND {TASK_ACCESS}',
+            (kind, kind, task_id, user_id, user_id)
+        ).rowcount:
+            return None
+        return cursor.execute(
+            'SELECT reminders FROM tasks WHERE id = ?', (task_id,)
+        ).fetchone()[0]
+
+    def set_user_tz(self, user_id, tz, utc_offset):
+        """
+        Сохраняет часовой пояс пользователя.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param tz: Имя пояса IANA, например Europe/Moscow
+        :type tz: str
+        :param utc_offset: Текущее смещение пояса от UTC в минутах
+        :type utc_offset: int
+        :raises sqlite3.Error: Если не удается сохранить пояс
+        """
+        with self._write_connection() as conn:
+            conn.execute('''
+                INSERT INTO users (user_id, tz, utc_offset) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE
+                SET tz = excluded.tz, utc_offset = excluded.utc_offset
+            ''', (user_id, tz, utc_offset))
+
+    def get_user_tz(self, user_id):
+        """
+        Получает часовой пояс пользователя.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :return: Имя пояса IANA или None, если пользователь его не задавал
+        :rtype: str or None
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            row = conn.execute(
+                'SELECT tz FROM users WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_timezones(self):
+        """
+        Получает пояса пользователей с их сохраненными смещениями.
+
+        :return: Словарь {имя пояса: смещение от UTC в минутах}
+        :rtype: dict
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            return dict(conn.execute(
+                'SELECT tz, MIN(utc_offset) FROM users WHERE tz IS NOT NULL GROUP BY tz'
+            ).fetchall())
+
+    def update_offsets(self, offsets):
+        """
+        Обновляет смещения поясов, например после перехода на летнее время.
+
+        :param offsets: Словарь {имя пояса: смещение от UTC в минутах}
+        :type offsets: dict
+        :return: Количество обновленных пользователей
+        :rtype: int
+        :raises sqlite3.Error: Если не удается обновить смещения
+        """
+        with self._write_connection() as conn:
+            return sum(
+                conn.execute(
+                    'UPDATE users SET utc_offset = ? WHERE tz = ? AND utc_offset != ?',
+                    (offset, tz, offset)
+                ).rowcount
+                for tz, offset in offsets.items()
+            )
+
+    def register_user(self, user_id):
+        """
+        Добавляет пользователя в реестр; вернувшийся пользователь
+        перестает считаться заблокировавшим бота.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :return: True, если пользователь новый
+        :rtype: bool
+        :raises sqlite3.Error: Если не удается сохранить пользователя
+        """
+        with self._write_connection() as conn:
+            if conn.execute(
+                'UPDATE users SET blocked_at = NULL WHERE user_id = ?', (user_id,)
+            ).rowcount:
+                return False
+            conn.execute(
+                'INSERT INTO users (user_id, joined_at) VALUES (?, ?)',
+                (user_id, int(time.time()))
+            )
+            return True
+
+    def create_broadcast(self, admin_id, text):
+        """
+        Создает рассылку всем пользователям, не заблокировавшим бота.
+
+        Получатели фиксируются при создании: пользователи, пришедшие
+        позже, в эту рассылку не попадают.
+
+        :param admin_id: ID администратора, автора рассылки
+        :type admin_id: int
+        :param text: Текст сообщения
+        :type text: str
+        :return: Созданная рассылка
+        :rtype: Broadcast
+        :raises sqlite3.Error: Если не удается создать рассылку
+        """
+        with self._write_connection() as conn:
+            broadcast_id = conn.execute(
+                'INSERT INTO broadcasts (admin_id, text, created_at) VALUES (?, ?, ?)',
+                (admin_id, text, int(time.time()))
+            ).lastrowid
+            conn.execute(
+                'INSERT INTO broadcast_recipients (broadcast_id, user_id) '
+                'SELECT ?, user_id FROM users WHERE blocked_at IS NULL',
+                (broadcast_id,)
+            )
+            return self._broadcast(conn, broadcast_id)
+
+    @staticmethod
+    def _broadcast(conn, broadcast_id):
+        row = conn.execute(f'''
+            SELECT b.id, b.admin_id, b.text, COUNT(r.user_id),
+                   COUNT(CASE WHEN r.status = {DELIVERY_PENDING} THEN 1 END),
+                   COUNT(CASE WHEN r.status = {DELIVERY_SENT} THEN 1 END),
+                   COUNT(CASE WHEN r.status = {DELIVERY_FAILED} THEN 1 END),
+                   COUNT(CASE WHEN r.status = {DELIVERY_BLOCKED} THEN 1 END),
+                   b.finished_at IS NOT NULL
+            FROM broadcasts b
+            LEFT JOIN broadcast_recipients r ON r.broadcast_id = b.id
+            WHERE b.id = ?
+            GROUP BY b.id
+        ''', (broadcast_id,)).fetchone()
+        return Broadcast(*row[:8], bool(row[8])) if row else None
+
+    def get_broadcast(self, broadcast_id):
+        """
+        Получает рассылку со сводкой доставки.
+
+        :param broadcast_id: ID рассылки
+        :type broadcast_id: int
+        :return: Рассылка или None
+        :rtype: Broadcast or None
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            return self._broadcast(conn, broadcast_id)
+
+    def get_unfinished_broadcasts(self):
+        """
+        Получает незавершенные рассылки, например прерванные остановкой бота.
+
+        :return: Рассылки в порядке создания
+        :rtype: list of Broadcast
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            ids = [row[0] for row in conn.execute(
+                'SELECT id FROM broadcasts WHERE finished_at IS NULL ORDER BY id'
+            )]
+            return [self._broadcast(conn, broadcast_id) for broadcast_id in ids]
+
+    def get_pending_recipients(self, broadcast_id, after=0, limit=100):
+        """
+        Получает следующую пачку получателей, которым рассылка еще не ушла.
+
+        Постраничная выборка по ключу (user_id > after) по частичному
+        индексу неотправленных получателей.
+
+        :param broadcast_id: ID рассылки
+        :type broadcast_id: int
+        :param after: ID последнего выданного получателя
+        :type after: int
+        :param limit: Размер пачки
+        :type limit: int
+        :return: ID пользователей по возрастанию
+        :rtype: list of int
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT user_id FROM broadcast_recipients '
+                f'WHERE broadcast_id = ? AND status = {DELIVERY_PENDING} AND user_id > ? '
+                'ORDER BY user_id LIMIT ?',
+                (broadcast_id, after, limit)
+            )]
+
+    def record_deliveries(self, broadcast_id, results):
+        """
+        Сохраняет итоги доставки пачки получателей.
+
+        Пользователи со статусом DELIVERY_BLOCKED помечаются в реестре
+        и не попадают в следующие рассылки.
+
+        :param broadcast_id: ID рассылки
+        :type broadcast_id: int
+        :param results: Пары (ID пользователя, статус DELIVERY_*)
+        :type results: list of tuple
+        :raises sqlite3.Error: Если не удается сохранить итоги
+        """
+        if not results:
+            return
+        now = int(time.time())
+        with self._write_connection() as conn:
+            conn.executemany(
+                'UPDATE broadcast_recipients SET status = ? '
+                'WHERE broadcast_id = ? AND user_id = ?',
+                [(status, broadcast_id, user_id) for user_id, status in results]
+            )
+            conn.executemany(
+                'UPDATE users SET blocked_at = ? WHERE user_id = ?',
+                [(now, user_id) for user_id, status in results
+                 if status == DELIVERY_BLOCKED]
+            )
+
+    def finish_broadcast(self, broadcast_id):
+        """
+        Отмечает рассылку завершенной.
+
+        :param broadcast_id: ID рассылки
+        :type broadcast_id: int
+        :return: Рассылка с итоговой сводкой
+        :rtype: Broadcast
+        :raises sqlite3.Error: Если не удается сохранить отметку
+        """
+        with self._write_connection() as conn:
+            conn.execute(
+                'UPDATE broadcasts SET finished_at = ? WHERE id = ?',
+                (int(time.time()), broadcast_id)
+            )
+            return self._broadcast(conn, broadcast_id)
+
+    def save_pending_updates(self, updates):
+        """
+        Сохраняет апдейты, не обработанные к остановке бота.
+
+        :param updates: Пары (update_id, апдейт в JSON)
+        :type updates: list of tuple
+        :raises sqlite3.Error: Если не удается сохранить апдейты
+        """
+        if not updates:
+            return
+        now = int(time.time())
+        with self._write_connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO pending_updates (update_id, payload, saved_at) '
+                'VALUES (?, ?, ?)',
+                [(update_id, payload, now) for update_id, payload in updates]
+            )
+
+    def pop_pending_updates(self):
+        """
+        Забирает сохраненные при остановке апдейты.
+
+        :return: Апдейты в JSON в порядке update_id
+        :rtype: list of str
+        :raises sqlite3.Error: Если не удается прочитать апдейты
+        """
+        with self._write_connection() as conn:
+            payloads = [row[0] for row in conn.execute(
+                'SELECT payload FROM pending_updates ORDER BY update_id'
+            )]
+            conn.execute('DELETE FROM pending_updates')
+        return payloads
+
+    def create_list(self, user_id, title):
+        """
+        Создает общий список; создатель становится его участником.
+
+        :param user_id: ID пользователя Telegram, владельца списка
+        :type user_id: int
+        :param title: Название списка
+        :type title: str
+        :return: Созданный список
+        :rtype: TaskList
+        :raises sqlite3.Error: Если не удается создать список
+        """
+        with self._write_connection() as conn:
+            return self._create_list(conn.cursor(), user_id, title)
+
+    def _create_list(self, cursor, user_id, title):
+        """
+        Создает общий список в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: Созданный список
+        :rtype: TaskList
+        """
+        code = secrets.token_urlsafe(8)
+        list_id = cursor.execute(
+            'INSERT INTO lists (id, user_id, title, invite_code) '
+            f"VALUES ({next_id('lists')}, ?, ?, ?)",
+            (user_id, title, code)
+        ).lastrowid
+        cursor.execute(
+            'INSERT INTO list_members (list_id, user_id) VALUES (?, ?)',
+            (list_id, user_id)
+        )
+        return TaskList(list_id, user_id, title, code, 1)
+
+    def join_list(self, user_id, invite_code):
+        """
+        Добавляет пользователя в общий список по коду приглашения.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param invite_code: Код приглашения
+        :type invite_code: str
+        :return: (список, вступил ли пользователь только что)
+            или (None, False), если код неверный
+        :rtype: tuple
+        :raises sqlite3.Error: Если не удается добавить участника
+        """
+        with self._write_connection() as conn:
+            return self._join_list(conn.cursor(), user_id, invite_code)
+
+    def _join_list(self, cursor, user_id, invite_code):
+        """
+        Добавляет участника списка в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: (список, вступил ли пользователь только что)
+        :rtype: tuple
+        """
+        row = cursor.execute(
+            'SELECT id FROM lists WHERE invite_code = ?', (invite_code,)
+        ).fetchone()
+        if row is None:
+            return None, False
+        joined = cursor.execute(
+            'INSERT OR IGNORE INTO list_members (list_id, user_id) VALUES (?, ?)',
+            (row[0], user_id)
+        ).rowcount > 0
+        task_list = TaskList(*cursor.execute('''
+            SELECT id, user_id, title, invite_code,
+                   (SELECT COUNT(*) FROM list_members WHERE list_id = lists.id)
+            FROM lists WHERE id = ?
+        ''', (row[0],)).fetchone())
+        return task_list, joined
+
+    def leave_list(self, user_id, list_id):
+        """
+        Убирает пользователя из общего списка.
+
+        Список без участников удаляется вместе с задачами.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param list_id: ID списка
+        :type list_id: int
+        :return: True если пользователь был участником
+        :rtype: bool
+        :raises sqlite3.Error: Если не удается выйти из списка
+        """
+        with self._write_connection() as conn:
+            return self._leave_list(conn.cursor(), user_id, list_id)
+
+    def _leave_list(self, cursor, user_id, list_id):
+        """
+        Убирает участника списка в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: True если пользователь был участником
+        :rtype: bool
+        """
+        left = cursor.execute(
+            'DELETE FROM list_members WHERE list_id = ? AND user_id = ?',
+            (list_id, user_id)
+        ).rowcount > 0
+        if left and cursor.execute(
+            'SELECT 1 FROM list_members WHERE list_id = ?', (list_id,)
+        ).fetchone() is None:
+            cursor.execute('DELETE FROM tasks WHERE list_id = ?', (list_id,))
+            cursor.execute('DELETE FROM tasks_archive WHERE list_id = ?', (list_id,))
+            cursor.execute('DELETE FROM lists WHERE id = ?', (list_id,))
+        return left
+
+    def get_list(self, user_id, list_id):
+        """
+        Получает общий список, если пользователь его участник.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param list_id: ID списка
+        :type list_id: int
+        :return: Список или None
+        :rtype: TaskList or None
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        lists = [task_list for task_list in self.get_lists(user_id)
+                 if task_list.id == list_id]
+        return lists[0] if lists else None
+
+    def get_lists(self, user_id):
+        """
+        Получает общие списки, в которых участвует пользователь.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :return: Списки в порядке создания
+        :rtype: list of TaskList
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            return [TaskList(*row) for row in conn.execute('''
+                SELECT l.id, l.user_id, l.title, l.invite_code,
+                       (SELECT COUNT(*) FROM list_members c WHERE c.list_id = l.id)
+                FROM list_members m JOIN lists l ON l.id = m.list_id
+                WHERE m.user_id = ?
+                ORDER BY l.id
+            ''', (user_id,))]
+
+    def get_list_members(self, list_id):
+        """
+        Получает участников общего списка.
+
+        :param list_id: ID списка
+        :type list_id: int
+        :return: ID участников
+        :rtype: list of int
+        :raises sqlite3.Error: Если не удается выполнить запрос
+        """
+        with self._read_connection() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT user_id FROM list_members WHERE list_id = ? ORDER BY user_id',
+                (list_id,)
+            )]
+
+    def get_archived_tasks(self, user_id, limit=10, offset=0):
+        """
+        Получает страницу архивных задач пользователя, новые первыми.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param limit: Размер страницы
+        :type limit: int
+        :param offset: Смещение страницы
+        :type offset: int
+        :return: Список архивных задач
+        :rtype: list of Task
+        :raises sqlite3.Error: Если не удается получить задачи
+        """
+        with self._read_connection() as conn:
+            return _fetch(conn, task_row, f'''
+                SELECT {TASK_COLUMNS}
+                FROM tasks_archive WHERE user_id = ?
+                ORDER BY id DESC LIMIT ? OFFSET ?
+            ''', (user_id, limit, offset))
 
     def mark_done(self, user_id, task_id):
         """
@@ -128,20 +1311,88 @@ class Database:
         :rtype: bool
         :raises sqlite3.Error: Если не удается обновить задачу
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        with self._write_connection() as conn:
+            return self._mark_done(conn.cursor(), user_id, task_id)
+
+    def _mark_done(self, cursor, user_id, task_id):
+        """
+        Отмечает задачу выполненной в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: True если задача была обновлена
+        :rtype: bool
+        """
+        return self._complete_task(cursor, user_id, task_id)[0]
+
+    def complete_task(self, user_id, task_id, today=None):
+        """
+        Отмечает задачу выполненной и создает следующее повторение.
+
+        У повторяющейся задачи в таблице хранится только ближайшее
+        повторение: следующее создается в той же транзакции,
+        когда выполнено текущее.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param task_id: ID задачи для отметки
+        :type task_id: int
+        :param today: Текущая дата, раньше нее повторение не назначается
+        :type today: datetime.date, optional
+        :return: (найдена ли задача, новое повторение или None)
+        :rtype: tuple
+        :raises sqlite3.Error: Если не удается обновить задачу
+        """
+        with self._write_connection() as conn:
+            return self._complete_task(conn.cursor(), user_id, task_id, today)
+
+    def _complete_task(self, cursor, user_id, task_id, today=None):
+        """
+        Отмечает задачу выполненной в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: (найдена ли задача, новое повторение или None)
+        :rtype: tuple
+        """
+        row = cursor.execute(
+            'SELECT task_text, category, done, deadline, recurrence, parent_id, list_id, '
+            f'reminders FROM tasks WHERE id = ? AND {TASK_ACCESS}', (task_id, user_id, user_id)
+        ).fetchone()
+        if row is None:
+            return False, None
+        task_text, category, done, deadline, recurrence, parent_id, list_id, reminders = row
+        if done:
+            return True, None
         cursor.execute(
-            'UPDATE tasks SET done = 1 WHERE id = ? AND user_id = ?',
-            (task_id, user_id)
+            'UPDATE tasks SET done = 1, done_at = ? WHERE id = ?',
+            (int(time.time()), task_id)
+        )
+        if not recurrence or deadline is None:
+            self._log_event(cursor, user_id, task_id, 'done')
+            return True, None
+        due = next_due(recurrence, from_epoch_day(deadline), today or date.today())
+        if parent_id is not None and cursor.execute(
+            'SELECT 1 FROM tasks WHERE id = ?', (parent_id,)
+        ).fetchone() is None:
+            # Родитель ушел в архив: повторение становится задачей
+            # верхнего уровня, как и сама подзадача в get_subtasks.
+            parent_id = None
+        new_id = self._add_task(
+            cursor, user_id, task_text, category, due, recurrence, parent_id, list_id,
+            reminders
+        )
+        self._log_event(cursor, user_id, task_id, 'done', {'next_id': new_id})
+        if new_id is None:
+            return True, None
+        return True, Task(
+            new_id, user_id, task_text, category, False, due, recurrence, parent_id,
+            list_id, reminders
         )
-        updated = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return updated
 
     def delete_task(self, user_id, task_id):
         """
-        Удаляет задачу пользователя.
+        Удаляет задачу пользователя вместе со всеми ее подзадачами.
 
         :param user_id: ID пользователя Telegram
         :type user_id: int
@@ -151,20 +1402,41 @@ class Database:
         :rtype: bool
         :raises sqlite3.Error: Если не удается удалить задачу
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        with self._write_connection() as conn:
+            return self._delete_task(conn.cursor(), user_id, task_id)
+
+    def _delete_task(self, cursor, user_id, task_id):
+        """
+        Удаляет задачу в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: True если задача была удалена
+        :rtype: bool
+        """
+        subtree = f'''
+            WITH RECURSIVE subtree (id) AS (
+                SELECT id FROM tasks WHERE id = ? AND {TASK_ACCESS}
+                UNION ALL
+                SELECT t.id FROM tasks t JOIN subtree ON t.parent_id = subtree.id
+            )
+            SELECT id FROM subtree
+        '''
+        snapshot = _snapshot(
+            cursor, f'SELECT * FROM tasks WHERE id IN ({subtree})', (task_id, user_id, user_id)
+        )
+        if not snapshot['rows']:
+            return False
         cursor.execute(
-            'DELETE FROM tasks WHERE id = ? AND user_id = ?',
-            (task_id, user_id)
+            f'DELETE FROM tasks WHERE id IN ({subtree})', (task_id, user_id, user_id)
         )
-        deleted = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return deleted
+        self._log_event(cursor, user_id, task_id, 'delete', {'tasks': snapshot})
+        return True
 
     def clear_all_tasks(self, user_id):
         """
-        Удаляет все задачи пользователя.
+        Удаляет все задачи личного списка пользователя, включая архивные.
+        Задачи общих списков остаются.
 
         :param user_id: ID пользователя Telegram
         :type user_id: int
@@ -172,10 +1444,242 @@ class Database:
         :rtype: int
         :raises sqlite3.Error: Если не удается удалить задачи
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM tasks WHERE user_id = ?', (user_id,))
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
-        return deleted_count
\ No newline at end of file
+        with self._write_connection() as conn:
+            return self._clear_all_tasks(conn.cursor(), user_id)
+
+    def _clear_all_tasks(self, cursor, user_id):
+        """
+        Удаляет все задачи пользователя в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: Количество удаленных задач
+        :rtype: int
+        """
+        payload = {
+            table: _snapshot(
+                cursor, f'SELECT * FROM {table} WHERE user_id = ? AND list_id IS NULL',
+                (user_id,)
+            )
+            for table in ('tasks', 'tasks_archive')
+        }
+        deleted = 0
+        for table in payload:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE user_id = ? AND list_id IS NULL', (user_id,)
+            )
+            deleted += cursor.rowcount
+        if deleted:
+            self._log_event(cursor, user_id, None, 'clear', payload)
+        return deleted
+
+    def _log_event(self, cursor, user_id, task_id, kind, payload=None):
+        """
+        Дописывает событие в журнал task_events в той же транзакции,
+        что и само изменение.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :param kind: вид события: add, done, delete, clear или undo
+        :type kind: str
+        :param payload: данные для отмены (JSON)
+        :type payload: dict, optional
+        """
+        cursor.execute(
+            'INSERT INTO task_events (seq, user_id, task_id, kind, payload, created_at) '
+            f"VALUES ({next_id('task_events')}, ?, ?, ?, ?, ?)",
+            (user_id, task_id, kind, None if payload is None else json.dumps(payload),
+             int(time.time()))
+        )
+
+    def changes_since(self, seq, batch_size=500):
+        """
+        Поток событий журнала task_events с номером больше seq.
+
+        События читаются пакетами через пул чтения, соединение между
+        пакетами не удерживается. Журнал общий для процессов, работающих
+        с одним файлом базы: потребитель запоминает seq последнего
+        события и продолжает с него, не перечитывая задачи.
+
+        :param seq: номер последнего обработанного события (0 - с начала)
+        :type seq: int
+        :param batch_size: размер пакета чтения
+        :type batch_size: int
+        :return: события в порядке seq
+        :rtype: iterator of TaskEvent
+        :raises sqlite3.Error: Если не удается прочитать журнал
+        """
+        while True:
+            with self._read_connection() as conn:
+                events = _fetch(conn, task_event_row, '''
+                    SELECT seq, user_id, task_id, kind, created_at
+                    FROM task_events WHERE seq > ? ORDER BY seq LIMIT ?
+                ''', (seq, batch_size))
+            yield from events
+            if len(events) < batch_size:
+                return
+            seq = events[-1].seq
+
+    def last_seq(self):
+        """
+        Номер последнего события журнала, 0 если журнал пуст.
+
+        :rtype: int
+        :raises sqlite3.Error: Если не удается прочитать журнал
+        """
+        with self._read_connection() as conn:
+            return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM task_events').fetchone()[0]
+
+    def undo_last(self, user_id):
+        """
+        Отменяет последнее действие пользователя по журналу событий.
+
+        Отменить можно одно, самое последнее действие; отмена сама
+        записывается в журнал событием undo. Действие не отменяется,
+        если у пользователя больше нет доступа к задаче (TASK_ACCESS)
+        или задачу либо ее подзадачи после него менял кто-то еще:
+        в общем списке отмена не должна стирать чужие изменения.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :return: вид отмененного события или None, если отменять нечего
+        :rtype: str or None
+        :raises sqlite3.Error: Если не удается отменить действие
+        """
+        with self._write_connection() as conn:
+            return self._undo_last(conn.cursor(), user_id)
+
+    def _undo_last(self, cursor, user_id):
+        """
+        Отменяет последнее действие в рамках открытой транзакции.
+
+        :param cursor: курсор соединения с открытой транзакцией
+        :type cursor: sqlite3.Cursor
+        :return: вид отмененного события или None
+        :rtype: str or None
+        """
+        row = cursor.execute(
+            'SELECT seq, task_id, kind, payload FROM task_events '
+            'WHERE user_id = ? ORDER BY seq DESC LIMIT 1', (user_id,)
+        ).fetchone()
+        if row is None or row[2] == 'undo':
+            return None
+        seq, task_id, kind, payload = row
+        data = json.loads(payload) if payload else {}
+        if kind in ('add', 'done'):
+            ids = [row[0] for row in cursor.execute(f'''
+                WITH RECURSIVE subtree (id) AS (
+                    SELECT id FROM tasks WHERE id = ? AND {TASK_ACCESS}
+                    UNION ALL
+                    SELECT t.id FROM tasks t JOIN subtree ON t.parent_id = subtree.id
+                )
+                SELECT id FROM subtree
+            ''', (task_id, user_id, user_id))]
+            if not ids:
+                return None
+            if data.get('next_id') is not None:
+                ids.append(data['next_id'])
+        elif kind == 'delete':
+            snapshot = data['tasks']
+            rows = [dict(zip(snapshot['columns'], row)) for row in snapshot['rows']]
+            root = next(row for row in rows if row['id'] == task_id)
+            if root['list_id'] is not None and cursor.execute(
+                'SELECT 1 FROM list_members WHERE list_id = ? AND user_id = ?',
+                (root['list_id'], user_id)
+            ).fetchone() is None:
+                return None
+            ids = [row['id'] for row in rows]
+            if root['parent_id'] is not None:
+                ids.append(root['parent_id'])
+        else:
+            ids = []
+        if ids and cursor.execute(
+            f'SELECT 1 FROM task_events WHERE seq > ? '
+            f'AND task_id IN ({", ".join("?" * len(ids))}) LIMIT 1',
+            (seq, *ids)
+        ).fetchone():
+            return None
+        if kind == 'add':
+            cursor.execute(
+                f'DELETE FROM tasks WHERE id IN ({", ".join("?" * len(ids))})', ids
+            )
+        elif kind == 'done':
+            cursor.execute(
+                'UPDATE tasks SET done = 0, done_at = NULL WHERE id = ?', (task_id,)
+            )
+            if data.get('next_id') is not None:
+                cursor.execute(
+                    'DELETE FROM tasks WHERE id = ? AND done = 0', (data['next_id'],)
+                )
+        else:
+            for table, snapshot in data.items():
+                _restore(cursor, table, snapshot)
+        self._log_event(cursor, user_id, task_id, 'undo', {'seq': seq})
+        return kind
+
+    def archive_done_tasks(self, older_than_days, batch_size=500, now=None):
+        """
+        Переносит задачи, выполненные больше N дней назад, в tasks_archive.
+
+        Перенос идет пакетами, каждый пакет - отдельной короткой
+        транзакцией, чтобы не задерживать обработчики бота.
+
+        :param older_than_days: Сколько дней задача должна быть выполнена
+        :type older_than_days: int
+        :param batch_size: Размер пакета
+        :type batch_size: int
+        :param now: Текущее время (unix-время), по умолчанию time.time()
+        :type now: float, optional
+        :return: Количество перенесенных задач
+        :rtype: int
+        :raises sqlite3.Error: Если перенос не удался
+        """
+        cutoff = int(time.time() if now is None else now) - older_than_days * 86400
+        moved = 0
+        while True:
+            with self._write_connection() as conn:
+                columns = ', '.join(
+                    row[1] for row in conn.execute('PRAGMA table_info(tasks_archive)')
+                )
+                ids = [row[0] for row in conn.execute(
+                    'SELECT id FROM tasks WHERE done = 1 AND done_at < ? LIMIT ?',
+                    (cutoff, batch_size)
+                )]
+                if ids:
+                    marks = ', '.join('?' * len(ids))
+                    conn.execute(
+                        f'INSERT INTO tasks_archive ({columns}) '
+                        f'SELECT {columns} FROM tasks WHERE id IN ({marks})', ids
+                    )
+                    conn.execute(f'DELETE FROM tasks WHERE id IN ({marks})', ids)
+            moved += len(ids)
+            if len(ids) < batch_size:
+                return moved
+
+    def compact(self, older_than_days, batch_size=500, vacuum_pages=1000):
+        """
+        Архивирует старые задачи, удаляет старые отметки напоминаний
+        и события журнала и возвращает освободившееся место.
+
+        PRAGMA incremental_vacuum действует только для баз, созданных
+        с auto_vacuum=INCREMENTAL (все новые базы); для старых баз
+        выполняется только PRAGMA optimize.
+
+        :param older_than_days: Сколько дней задача должна быть выполнена
+        :type older_than_days: int
+        :param batch_size: Размер пакета архивации
+        :type batch_size: int
+        :param vacuum_pages: Сколько свободных страниц вернуть за раз
+        :type vacuum_pages: int
+        :return: Количество перенесенных задач
+        :rtype: int
+        :raises sqlite3.Error: Если обслуживание не удалось
+        """
+        moved = self.archive_done_tasks(older_than_days, batch_size)
+        cutoff = int(time.time()) - older_than_days * 86400
+        with self._write_connection() as conn:
+            conn.execute('DELETE FROM sent_reminders WHERE sent_at < ?', (cutoff,))
+            conn.execute('DELETE FROM task_events WHERE created_at < ?', (cutoff,))
+            conn.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})').fetchall()
+            conn.execute('PRAGMA optimize')
+        return moved
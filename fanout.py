@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+
+from session import LANE_BACKGROUND, outbound_lane
+
+# Предел длины текста сообщения Bot API.
+MESSAGE_LIMIT = 4096
+
+
+def format_changes(header, lines, limit=MESSAGE_LIMIT):
+    '''
+    Собирает сообщение об изменениях, укладываясь в limit символов.
+
+    Не поместившиеся изменения заменяются строкой с их числом:
+    участник получает одно сообщение за окно, а не несколько.
+
+    :param header: заголовок сообщения
+    :type header: str
+    :param lines: описания изменений
+    :type lines: list of str
+    :param limit: предельная длина сообщения
+    :type limit: int
+    :rtype: str
+    '''
+    text = header + '\n'.join(lines)
+    if len(text) <= limit:
+        return text
+    width = limit - len(header) - 40
+    kept = []
+    size = len(header)
+    for index, line in enumerate(lines):
+        if len(line) > width:
+            line = line[:width - 1] + '…'
+        tail = f"\n…и еще изменений: {len(lines) - index}"
+        if size + len(line) + len(tail) > limit:
+            return header + '\n'.join(kept) + tail
+        kept.append(line)
+        size += len(line) + 1
+    return header + '\n'.join(kept)
+
+
+class ListNotifier:
+    '''
+    Уведомления участников общего списка об изменениях.
+
+    Изменения не рассылаются по одному: первое изменение списка
+    открывает окно накопления, и все изменения за окно уходят одним
+    сообщением каждому участнику. Так серия правок в списке на 1000
+    участников стоит 1000 сообщений, а не 1000 на каждую правку.
+    Автор правки не получает уведомление о своих изменениях, а
+    сообщение укладывается в предел Bot API (см. format_changes).
+    Сообщения участникам отправляются конкурентно; их число в полете
+    ограничивает сессия бота (TunedSession).
+
+    Переменные окружения:
+        LIST_NOTIFY_WINDOW: окно накопления изменений, сек (5)
+    '''
+
+    def __init__(self, bot, db, window=None):
+        '''
+        :param bot: бот для отправки уведомлений
+        :type bot: aiogram.Bot
+        :param db: хранилище задач
+        :type db: TaskStore
+        :param window: окно накопления, сек
+        :type window: float, optional
+        '''
+        if window is None:
+            window = float(os.getenv('LIST_NOTIFY_WINDOW', '5'))
+        self.bot = bot
+        self.db = db
+        self.window = window
+        self.sent = 0
+        self._pending = {}
+        self._tasks = {}
+
+    def notify(self, list_id, user_id, text):
+        '''
+        Добавляет изменение списка в очередь уведомлений.
+
+        :param list_id: ID общего списка
+        :type list_id: int
+        :param user_id: ID автора изменения
+        :type user_id: int
+        :param text: описание изменения
+        :type text: str
+        :returns: None
+        '''
+        self._pending.setdefault(list_id, []).append((user_id, text))
+        if list_id not in self._tasks:
+            self._tasks[list_id] = asyncio.create_task(self._flush_later(list_id))
+
+    async def _flush_later(self, list_id):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            if self._tasks.get(list_id) is asyncio.current_task():
+                del self._tasks[list_id]
+        await self.flush(list_id)
+
+    async def flush(self, list_id):
+        '''
+        Рассылает накопленные изменения списка участникам.
+
+        :param list_id: ID общего списка
+        :type list_id: int
+        :returns: число отправленных сообщений
+        :rtype: int
+        '''
+        changes = self._pending.pop(list_id, None)
+        if not changes:
+            return 0
+        members = await asyncio.to_thread(self.db.get_list_members, list_id)
+        if not members:
+            return 0
+        task_list = await asyncio.to_thread(self.db.get_list, members[0], list_id)
+        header = f"Изменения в списке '{task_list.title}':\n"
+        sends = []
+        for member in members:
+            lines = [text for user_id, text in changes if user_id != member]
+            if lines:
+                sends.append(self._send(member, list_id, format_changes(header, lines)))
+        sent = sum(await asyncio.gather(*sends))
+        self.sent += sent
+        return sent
+
+    async def _send(self, user_id, list_id, text):
+        try:
+            with outbound_lane(LANE_BACKGROUND):
+                await self.bot.send_message(user_id, text)
+        except Exception as e:
+            logging.warning('Ошибка уведомления user=%s list=%s: %s', user_id, list_id, e)
+            return False
+        return True
+
+    async def close(self):
+        '''
+        Отменяет ожидание окон и сразу рассылает накопленное.
+
+        :returns: None
+        '''
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        for list_id in list(self._pending):
+            await self.flush(list_id)
@@ -0,0 +1,250 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+
+from aiogram import BaseMiddleware
+
+_commit_marker = contextvars.ContextVar('inflight_commit_marker', default=None)
+
+
+def commit_marker():
+    '''
+    Отметка фиксации изменения для апдейта, который сейчас обрабатывается.
+
+    Запись в базу вызывает ее после фиксации изменения, даже если
+    обработчик к этому времени прерван: такой апдейт при остановке
+    не сохраняется для повторной обработки, чтобы изменение не
+    применилось дважды.
+
+    :returns: функция без аргументов или None вне обработчика апдейта
+    :rtype: callable or None
+    '''
+    return _commit_marker.get()
+
+
+class InFlightMiddleware(BaseMiddleware):
+    '''
+    Учет апдейтов, которые сейчас обрабатываются.
+
+    Нужен для плавной остановки: после остановки приема апдейтов
+    бот дожидается обработки уже полученных (drain). aiogram
+    подтверждает Telegram пачку апдейтов следующим getUpdates, не
+    дожидаясь обработчиков, и вернуть offset назад нельзя. Поэтому
+    апдейты, не обработанные к сроку остановки (unfinished), бот
+    сохраняет в базе и обрабатывает после запуска (redeliver), а
+    Telegram подтверждает все полученные (ack_offset), чтобы
+    обработанные не пришли повторно.
+
+    Апдейт, обработчик которого успел зафиксировать изменение в базе
+    (см. commit_marker), в written, и повторно он не обрабатывается:
+    иначе добавление или выполнение задачи применилось бы дважды.
+
+    Регистрируется outer middleware на dp.update раньше остальных;
+    перед ним стоит только запись апдейтов (RecordingMiddleware),
+    которая должна видеть все апдейты.
+    '''
+
+    def __init__(self):
+        self.active = {}
+        self.written = set()
+        self.last_update_id = None
+        self._tasks = {}
+        self._cancelled = set()
+        self._idle = None
+
+    async def __call__(self, handler, event, data):
+        update_id = event.update_id
+        self.active[update_id] = event
+        self._tasks[update_id] = asyncio.current_task()
+        if self.last_update_id is None or update_id > self.last_update_id:
+            self.last_update_id = update_id
+        if self._idle is not None:
+            self._idle.clear()
+        token = _commit_marker.set(lambda: self.written.add(update_id))
+        try:
+            return await handler(event, data)
+        finally:
+            _commit_marker.reset(token)
+            self.active.pop(update_id, None)
+            self._tasks.pop(update_id, None)
+            if update_id not in self._cancelled:
+                self.written.discard(update_id)
+            if not self.active and self._idle is not None:
+                self._idle.set()
+
+    async def drain(self, timeout):
+        '''
+        Ждет завершения обработки всех принятых апдейтов.
+
+        :param timeout: максимальное ожидание, сек
+        :type timeout: float
+        :returns: True, если все апдейты обработаны
+        :rtype: bool
+        '''
+        if not self.active:
+            return True
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def unfinished(self):
+        '''
+        Возвращает апдейты, которые еще обрабатываются, для сохранения.
+
+        :returns: пары (update_id, апдейт в JSON) в порядке update_id
+        :rtype: list of tuple
+        '''
+        return [
+            (update_id, self.active[update_id].model_dump_json(
+                by_alias=True, exclude_none=True
+            ))
+            for update_id in sorted(self.active)
+        ]
+
+    def cancel(self):
+        '''
+        Прерывает обработку апдейтов, сохраняемых через unfinished, чтобы
+        они не завершились второй раз уже после сохранения.
+
+        :returns: прерванные задачи обработчиков
+        :rtype: list of asyncio.Task
+        '''
+        current = asyncio.current_task()
+        tasks = []
+        for update_id, task in self._tasks.items():
+            if task is not None and task is not current:
+                self._cancelled.add(update_id)
+                task.cancel()
+                tasks.append(task)
+        return tasks
+
+    def ack_offset(self):
+        '''
+        Возвращает offset для getUpdates, подтверждающий все полученные
+        апдейты, в том числе еще обрабатываемые: их сохраняет
+        graceful_shutdown.
+
+        :returns: offset или None, если апдейтов не было
+        :rtype: int or None
+        '''
+        if self.last_update_id is None:
+            return None
+        return self.last_update_id + 1
+
+
+async def redeliver(dp, bot, db):
+    '''
+    Обрабатывает апдейты, сохраненные при прошлой остановке.
+
+    Вызывается при запуске до приема новых апдейтов, чтобы сохранить
+    их порядок. Сохраняются только апдейты, обработчики которых не
+    успели ничего записать в базу, поэтому изменения задач при
+    повторной обработке не применяются дважды.
+
+    :param dp: диспетчер бота
+    :type dp: aiogram.Dispatcher
+    :param bot: бот
+    :type bot: aiogram.Bot
+    :param db: хранилище с сохраненными апдейтами
+    :type db: TaskStore
+    :returns: число обработанных апдейтов
+    :rtype: int
+    '''
+    payloads = await asyncio.to_thread(db.pop_pending_updates)
+    for payload in payloads:
+        try:
+            await dp.feed_raw_update(bot, json.loads(payload))
+        except Exception:
+            logging.exception('Ошибка повторной обработки апдейта')
+    if payloads:
+        logging.info('Повторно обработано апдейтов: %s', len(payloads))
+    return len(payloads)
+
+
+async def graceful_shutdown(bot, inflight, scheduler, writer, db, timeout=None,
+                            notifier=None, broadcaster=None):
+    '''
+    Плавно останавливает бота после остановки приема апдейтов.
+
+    Порядок: дождаться обработки принятых апдейтов и прервать
+    не обработанные к сроку, дождаться начатых
+    рассылок напоминаний и остановить планировщик, разослать накопленные
+    уведомления общих списков, прервать рассылки администратора с записью
+    их хода (они продолжатся после запуска), подтвердить Telegram
+    полученные апдейты, записать очередь групповой записи (изменения
+    прерванных обработчиков, еще не ушедшие в транзакцию, отбрасываются),
+    сохранить в базе прерванные апдейты без зафиксированных изменений
+    (см. redeliver) и закрыть соединения с базой. Все ожидания, кроме
+    отмены обработчиков, укладываются в общий timeout.
+
+    Переменные окружения:
+        SHUTDOWN_TIMEOUT: общий срок остановки, сек (10)
+
+    :param bot: бот, через который подтверждаются апдейты
+    :type bot: aiogram.Bot
+    :param inflight: учет обрабатываемых апдейтов
+    :type inflight: InFlightMiddleware
+    :param scheduler: планировщик напоминаний
+    :type scheduler: ReminderScheduler
+    :param writer: групповая запись или None
+    :type writer: GroupCommitWriter or None
+    :param db: база данных
+    :type db: Database
+    :param timeout: общий срок остановки, сек
+    :type timeout: float, optional
+    :param notifier: уведомления участников общих списков
+    :type notifier: ListNotifier, optional
+    :param broadcaster: рассылки администратора
+    :type broadcaster: Broadcaster, optional
+    :returns: None
+    '''
+    if timeout is None:
+        timeout = float(os.getenv('SHUTDOWN_TIMEOUT', '10'))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    def left():
+        return max(0.0, deadline - loop.time())
+
+    unfinished = []
+    if not await inflight.drain(left()):
+        unfinished = inflight.unfinished()
+        cancelled = inflight.cancel()
+        if cancelled:
+            await asyncio.wait(cancelled)
+    await scheduler.stop(left())
+    if notifier is not None:
+        try:
+            await asyncio.wait_for(notifier.close(), left())
+        except asyncio.TimeoutError:
+            logging.warning('Не разосланы к остановке уведомления общих списков')
+    if broadcaster is not None:
+        await broadcaster.close()
+
+    offset = inflight.ack_offset()
+    if offset is not None:
+        try:
+            await bot.get_updates(offset=offset, limit=1, timeout=0)
+        except Exception as e:
+            logging.warning('Не удалось подтвердить апдейты до %s: %s', offset, e)
+
+    if writer is not None:
+        await writer.close()
+    if unfinished:
+        partial = [update_id for update_id, _ in unfinished if update_id in inflight.written]
+        if partial:
+            logging.warning('Прерваны после записи в базу, повторно не обрабатываются: %s',
+                            partial)
+        pending = [item for item in unfinished if item[0] not in inflight.written]
+        if pending:
+            logging.warning('Не обработаны к остановке апдейты: %s, будут обработаны '
+                            'после запуска', [update_id for update_id, _ in pending])
+            db.save_pending_updates(pending)
+    db.close()
+    logging.info('Бот остановлен')
@@ -0,0 +1,172 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+correlation_id = ContextVar('correlation_id', default='-')
+
+
+class _Listener(QueueListener):
+    '''
+    QueueListener, который можно останавливать повторно (например,
+    вручную и затем при выходе из процесса).
+    '''
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class _QueueHandler(QueueHandler):
+    '''
+    QueueHandler, сохраняющий трассировку исключения в exc_text.
+
+    Стандартный prepare() склеивает трассировку с текстом сообщения,
+    и форматтер на стороне QueueListener уже не видит исключения.
+    Здесь в запись подставляется только текст сообщения, а трассировка
+    форматируется отдельно: JsonFormatter кладет ее в поле exc.
+    '''
+
+    _traceback = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or \
+                self._traceback.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class CorrelationFilter(logging.Filter):
+    '''
+    Добавляет к записи correlation_id текущего апдейта.
+
+    Стоит на QueueHandler, то есть выполняется в потоке, который
+    пишет лог, пока контекст апдейта еще доступен.
+    '''
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Пропускает только часть частых записей уровня INFO и ниже.
+
+    Записи считаются по шаблону сообщения (record.msg): из каждых
+    every записей одного шаблона пропускается одна, поэтому редкие
+    события не теряются из-за частых. WARNING и выше проходят всегда.
+    '''
+
+    def __init__(self, rate):
+        '''
+        :param rate: доля пропускаемых записей, от 0 до 1
+        :type rate: float
+        :raises ValueError: если доля вне (0, 1]
+        '''
+        super().__init__()
+        if not 0 < rate <= 1:
+            raise ValueError('Доля сэмплирования должна быть в (0, 1]')
+        self.every = round(1 / rate)
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.every == 1:
+            return True
+        count = self.counts.get(record.msg, 0)
+        self.counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Форматирует запись одной строкой JSON.
+    '''
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'cid': getattr(record, 'correlation_id', '-'),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(level=logging.INFO, json_format=True, sample_rate=1.0,
+                      stream=None):
+    '''
+    Настраивает неблокирующий вывод логов.
+
+    Корневой логгер пишет только в очередь (QueueHandler), а в поток
+    вывода записи пишет отдельный поток QueueListener. Задержки диска
+    или stdout не останавливают цикл событий бота.
+
+    :param level: уровень корневого логгера
+    :type level: int
+    :param json_format: писать записи в JSON, иначе текстом
+    :type json_format: bool
+    :param sample_rate: доля пропускаемых записей INFO и ниже
+    :type sample_rate: float
+    :param stream: поток вывода (по умолчанию sys.stderr)
+    :returns: запущенный QueueListener
+    :rtype: logging.handlers.QueueListener
+    '''
+    output = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s'
+        ))
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(CorrelationFilter())
+    if sample_rate < 1:
+        handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = _Listener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_logging(stream=None):
+    '''
+    Настраивает логи по переменным окружения.
+
+    Переменные окружения:
+        LOG_LEVEL: уровень логов (INFO)
+        LOG_FORMAT: json или text (json)
+        LOG_SAMPLE_RATE: доля пропускаемых записей INFO и ниже (1.0)
+
+    :returns: запущенный QueueListener
+    :rtype: logging.handlers.QueueListener
+    '''
+    return configure_logging(
+        level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+        json_format=os.getenv('LOG_FORMAT', 'json').lower() != 'text',
+        sample_rate=float(os.getenv('LOG_SAMPLE_RATE', '1.0')),
+        stream=stream,
+    )
@@ -2,29 +2,68 @@ import asyncio
 import logging
 import os
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 from dotenv import load_dotenv
 
-from database import Database
-from scheduler import ReminderScheduler
-
-logging.basicConfig(level=logging.INFO)
+from backup import build_backup
+from broadcast import Broadcaster, format_report
+from fanout import ListNotifier
+from lifecycle import InFlightMiddleware, commit_marker, graceful_shutdown, redeliver
+from logconfig import setup_logging
+from profiling import build_profiler, parse_admin_ids
+from recurrence import FREQUENCIES, FREQUENCY_NAMES, describe, make_rule
+from replay import build_recorder
+from middlewares import (
+    CorrelationMiddleware, ThrottlingMiddleware, UserLockMiddleware,
+    parse_throttle_limits
+)
+from scheduler import (
+    REMINDER_LABELS, SNOOZE_OPTIONS, ReminderScheduler, utc_offset_minutes
+)
+from session import build_session
+from sharding import invite_shard
+from storage import build_store
+from writer import build_writer
 
 load_dotenv()
+log_listener = setup_logging()
+
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     raise ValueError("TOKEN не найден в .env")
-bot = Bot(token=TOKEN)
+bot = Bot(token=TOKEN, session=build_session())
 dp = Dispatcher()
-
-db = Database()
-
-scheduler = ReminderScheduler(bot, db)
+ADMIN_IDS = parse_admin_ids(os.getenv("ADMIN_IDS", ""))
+profiler = build_profiler()
+recorder = build_recorder()
+if recorder is not None:
+    dp.update.outer_middleware(recorder)
+inflight = InFlightMiddleware()
+dp.update.outer_middleware(inflight)
+dp.update.outer_middleware(CorrelationMiddleware())
+dp.update.outer_middleware(profiler)
+dp.update.outer_middleware(UserLockMiddleware())
+throttle_limits = os.getenv("THROTTLE_LIMITS")
+dp.callback_query.outer_middleware(ThrottlingMiddleware(
+    parse_throttle_limits(throttle_limits) if throttle_limits else None
+))
+
+db = build_store()
+writer = build_writer(db)
+
+scheduler = ReminderScheduler(bot, db, build_backup(db))
+notifier = ListNotifier(bot, db)
+broadcaster = Broadcaster(bot, db)
+# (базовое имя БД, число шардов, номер шарда) в воркере шардированного
+# режима, иначе None; задает воркер sharding.worker_main.
+shard_info = None
+DUE_SOON_DAYS = int(os.getenv("DUE_SOON_DAYS", "3"))
 
 
 class AddTaskStates(StatesGroup):
@@ -38,10 +77,38 @@ class AddTaskStates(StatesGroup):
         waiting_for_text: ожидание ввода текста задачи
         waiting_for_category: ожидание ввода категории задачи
         waiting_for_deadline: ожидание ввода дедлайна задачи
+        waiting_for_recurrence: ожидание выбора повторения задачи
+        waiting_for_subtask: ожидание ввода текста подзадачи
+        waiting_for_list_task: ожидание ввода задачи общего списка
     '''
     waiting_for_text = State()
     waiting_for_category = State()
     waiting_for_deadline = State()
+    waiting_for_recurrence = State()
+    waiting_for_subtask = State()
+    waiting_for_list_task = State()
+
+
+async def write(operation, *args):
+    '''
+    Выполняет изменение задач в БД.
+
+    Если включена групповая запись (DB_GROUP_COMMIT_MS), изменение
+    уходит в общий пакет и результат возвращается после его фиксации.
+    Зафиксированное изменение отмечается в учете апдейтов, чтобы
+    прерванный остановкой апдейт не обрабатывался повторно.
+
+    :param operation: имя метода TaskStore (add_task, mark_done, ...)
+    :type operation: str
+    :returns: результат метода TaskStore
+    '''
+    if writer is not None:
+        return await writer.submit(operation, *args)
+    result = getattr(db, operation)(*args)
+    marker = commit_marker()
+    if marker is not None:
+        marker()
+    return result
 
 
 def get_back_keyboard():
@@ -56,6 +123,27 @@ def get_back_keyboard():
     ])
 
 
+def get_undo_keyboard():
+    '''
+    Генерирует клавиатуру с кнопками "Отменить" и "Назад".
+
+    :returns: InlineKeyboardMarkup с двумя кнопками
+    :rtype: aiogram.types.InlineKeyboardMarkup
+    '''
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='↩️ Отменить', callback_data='undo')],
+        [InlineKeyboardButton(text='⬅️ Назад', callback_data='back_to_start')]
+    ])
+
+
+UNDO_NAMES = {
+    'add': 'добавление задачи',
+    'done': 'отметка выполнения',
+    'delete': 'удаление задачи',
+    'clear': 'очистка списка',
+}
+
+
 def get_choice_keyboard(yes_text, no_text, yes_callback, no_callback):
     '''
     Генерирует клавиатуру с двумя вариантами выбора.
@@ -77,34 +165,275 @@ def get_choice_keyboard(yes_text, no_text, yes_callback, no_callback):
     ])
 
 
-@dp.message(Command('start'))
-async def cmd_start(message: Message, state: FSMContext):
+def get_recurrence_keyboard():
     '''
-    Обработчик команды /start. Приветствует пользователя и показывает главное меню.
+    Генерирует клавиатуру выбора повторения задачи.
 
-    :param message: сообщение с командой /start
+    :returns: InlineKeyboardMarkup с частотами повторения и кнопкой "Не повторять"
+    :rtype: aiogram.types.InlineKeyboardMarkup
+    '''
+    keyboard = [
+        [InlineKeyboardButton(text=f"🔁 {name.capitalize()}", callback_data=f"repeat_{freq}")]
+        for freq, name in FREQUENCY_NAMES.items()
+    ]
+    keyboard.append([InlineKeyboardButton(text="Не повторять", callback_data="repeat_none")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def schedule_deadline_reminder(user_id, task_id, task_text, deadline):
+    '''
+    Планирует отдельное напоминание о задаче в отладочном режиме.
+
+    Обычные напоминания за день до дедлайна рассылают задания групп
+    часовых поясов планировщика, отдельное задание на задачу ставится
+    только если задан scheduler.reminder_seconds.
+
+    :param user_id: ID пользователя в Telegram
+    :type user_id: int
+    :param task_id: ID задачи в базе данных
+    :type task_id: int
+    :param task_text: текст задачи
+    :type task_text: str
+    :param deadline: дедлайн задачи
+    :type deadline: datetime.date
+    :returns: None
+    '''
+    seconds = getattr(scheduler, "reminder_seconds", 0)
+    if deadline and seconds > 0:
+        scheduler.add_reminder(
+            user_id,
+            task_id,
+            task_text,
+            datetime.now() + timedelta(seconds=seconds)
+        )
+
+
+def user_today(user_id):
+    '''
+    Возвращает сегодняшнюю дату в часовом поясе пользователя.
+
+    :param user_id: ID пользователя в Telegram
+    :type user_id: int
+    :rtype: datetime.date
+    '''
+    tz = db.get_user_tz(user_id) or scheduler.default_tz
+    return datetime.now(ZoneInfo(tz)).date()
+
+
+def format_progress(progress):
+    '''
+    Форматирует прогресс подзадач для списка задач.
+
+    :param progress: пара (выполнено, всего) или None
+    :type progress: tuple or None
+    :rtype: str
+    '''
+    if not progress:
+        return ""
+    done, total = progress
+    return f" | ☑️ {done}/{total}"
+
+
+def format_due_line(task, numbers):
+    '''
+    Форматирует задачу для экрана "Сроки".
+
+    Задача подписывается своим номером из списка задач, а подзадача -
+    номером родительской задачи; ID из базы пользователю не показывается.
+
+    :param task: задача с дедлайном
+    :type task: Task
+    :param numbers: номера задач списка {ID задачи: номер}
+    :type numbers: dict
+    :rtype: str
+    '''
+    if task.id in numbers:
+        label = f"ID: {numbers[task.id]}"
+    elif task.parent_id in numbers:
+        label = f"Подзадача к ID: {numbers[task.parent_id]}"
+    elif task.list_id is not None:
+        label = "Общий список"
+    else:
+        label = "Подзадача"
+    return f"{label} | {task.task_text} | Дедлайн: {task.deadline}\n"
+
+
+def format_offset(offset):
+    '''
+    Форматирует смещение от UTC: 180 -> UTC+03:00.
+
+    :param offset: смещение в минутах
+    :type offset: int
+    :rtype: str
+    '''
+    sign = '+' if offset >= 0 else '-'
+    hours, minutes = divmod(abs(offset), 60)
+    return f"UTC{sign}{hours:02d}:{minutes:02d}"
+
+
+async def send_main_menu(message):
+    '''
+    Показывает главное меню ответом на сообщение.
+
+    :param message: сообщение, на которое отвечает бот
     :type message: aiogram.types.Message
-    :param state: контекст состояния FSM
-    :type state: aiogram.fsm.context.FSMContext
     :returns: None
     '''
-    await state.clear()
-    user_id = message.from_user.id
     keyboard = [
         [InlineKeyboardButton(text="📝 Добавить задачу", callback_data="add")],
         [InlineKeyboardButton(text="📋 Список задач", callback_data="list")],
+        [InlineKeyboardButton(text="⏰ Сроки", callback_data="due")],
+        [InlineKeyboardButton(text="👥 Общие списки", callback_data="lists")],
         [InlineKeyboardButton(text="📊 Статистика", callback_data="stats")],
         [InlineKeyboardButton(text="🗑️ Очистить все", callback_data="clear_all")]
     ]
     markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
     await message.reply(
-        "Привет! Это to-do-list бота. Выбери действие:\n",
+        "Привет! Это to-do-list бота. Выбери действие:\n"
+        "Часовой пояс для напоминаний: /tz",
         reply_markup=markup
     )
+
+
+@dp.message(Command('start'))
+async def cmd_start(message: Message, state: FSMContext):
+    '''
+    Обработчик команды /start. Приветствует пользователя, показывает
+    главное меню и добавляет пользователя в реестр рассылок.
+
+    :param message: сообщение с командой /start
+    :type message: aiogram.types.Message
+    :param state: контекст состояния FSM
+    :type state: aiogram.fsm.context.FSMContext
+    :returns: None
+    '''
+    await state.clear()
+    user_id = message.from_user.id
+    await send_main_menu(message)
     db.create_table(user_id)
+    db.register_user(user_id)
+
+
+@dp.message(Command('tz'))
+async def cmd_tz(message: Message, command: CommandObject):
+    '''
+    Обработчик команды /tz. Показывает или задает часовой пояс пользователя.
+
+    Напоминания приходят в REMINDER_HOUR по времени этого пояса,
+    по нему же проверяются дедлайны.
+
+    :param message: сообщение с командой /tz [пояс IANA]
+    :type message: aiogram.types.Message
+    :param command: разобранная команда с аргументом
+    :type command: aiogram.filters.CommandObject
+    :returns: None
+    '''
+    user_id = message.from_user.id
+    if not command.args:
+        tz = db.get_user_tz(user_id) or scheduler.default_tz
+        await message.reply(
+            f"Твой часовой пояс: {tz} ({format_offset(utc_offset_minutes(tz))}).\n"
+            "Чтобы изменить, отправь /tz Europe/Moscow",
+            reply_markup=get_back_keyboard()
+        )
+        return
+    tz = command.args.strip()
+    try:
+        offset = utc_offset_minutes(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        await message.reply(
+            "Неизвестный часовой пояс. Пример: /tz Europe/Moscow",
+            reply_markup=get_back_keyboard()
+        )
+        return
+    try:
+        db.set_user_tz(user_id, tz, offset)
+        scheduler.ensure_bucket(offset)
+        await message.reply(
+            f"Часовой пояс сохранен: {tz} ({format_offset(offset)}).",
+            reply_markup=get_back_keyboard()
+        )
+    except Exception as e:
+        logging.error("Ошибка сохранения пояса: %s", e)
+        await message.reply(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+
+
+@dp.message(Command('profile'))
+async def cmd_profile(message: Message, command: CommandObject):
+    '''
+    Обработчик команды /profile (только для ADMIN_IDS).
+
+    /profile N запускает профилирование следующих N апдейтов (100 по
+    умолчанию), /profile off завершает его досрочно. Отчет с самыми
+    горячими функциями приходит в этот чат.
+
+    :param message: сообщение с командой /profile [N|off]
+    :type message: aiogram.types.Message
+    :param command: разобранная команда с аргументом
+    :type command: aiogram.filters.CommandObject
+    :returns: None
+    '''
+    if message.from_user.id not in ADMIN_IDS:
+        await unknown_command(message)
+        return
+    arg = (command.args or "").strip()
+    if arg == "off":
+        await profiler.stop(bot)
+        await message.reply("Профилирование остановлено.")
+        return
+    try:
+        updates = int(arg or 100)
+        profiler.start(updates, message.chat.id)
+    except (ValueError, RuntimeError) as e:
+        await message.reply(f"Не удалось запустить профилирование: {e}")
+        return
+    await message.reply(f"Профилирую следующие {updates} апдейтов.")
+
+
+@dp.message(Command('broadcast'))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    '''
+    Обработчик команды /broadcast (только для ADMIN_IDS).
+
+    /broadcast текст рассылает сообщение всем пользователям бота,
+    /broadcast без текста показывает ход незавершенных рассылок.
+    Итог рассылки приходит в этот чат.
 
+    В шардированном режиме рассылка отключена: воркер видит только
+    пользователей своего шарда и разослал бы сообщение их части.
 
-@dp.callback_query(lambda c: c.data in ["add", "list", "stats", "clear_all"])
+    :param message: сообщение с командой /broadcast [текст]
+    :type message: aiogram.types.Message
+    :param command: разобранная команда с аргументом
+    :type command: aiogram.filters.CommandObject
+    :returns: None
+    '''
+    if message.from_user.id not in ADMIN_IDS:
+        await unknown_command(message)
+        return
+    text = (command.args or "").strip()
+    if not text:
+        broadcasts = db.get_unfinished_broadcasts()
+        await message.reply(
+            "\n".join(format_report(broadcast) for broadcast in broadcasts)
+            or "Нет незавершенных рассылок. Чтобы начать: /broadcast текст"
+        )
+        return
+    if shard_info is not None and shard_info[1] > 1:
+        await message.reply(
+            "Рассылка недоступна в шардированном режиме: каждый сервер бота "
+            "знает только своих пользователей, и сообщение получила бы лишь "
+            "их часть."
+        )
+        return
+    broadcast = await broadcaster.start(message.from_user.id, text)
+    await message.reply(f"Рассылка #{broadcast.id} начата, получателей: {broadcast.total}.")
+
+
+@dp.callback_query(lambda c: c.data in ["add", "list", "lists", "due", "stats", "clear_all"])
 async def process_menu_callback(callback_query: types.CallbackQuery, state: FSMContext):
     '''
     Обработчик основных действий главного меню.
@@ -126,17 +455,22 @@ async def process_menu_callback(callback_query: types.CallbackQuery, state: FSMC
         await state.set_state(AddTaskStates.waiting_for_text)
     elif action == "list":
         await cmd_list_callback(callback_query)
+    elif action == "lists":
+        text, markup = render_lists(user_id)
+        await callback_query.message.edit_text(text, reply_markup=markup)
+    elif action == "due":
+        await show_due(callback_query)
     elif action == "stats":
         await show_statistics(callback_query)
     elif action == "clear_all":
         try:
-            deleted_count = db.clear_all_tasks(user_id)
+            deleted_count = await write('clear_all_tasks', user_id)
             await callback_query.message.edit_text(
                 f"Удалено {deleted_count} задач. Теперь список пуст.",
-                reply_markup=get_back_keyboard()
+                reply_markup=get_undo_keyboard() if deleted_count else get_back_keyboard()
             )
         except Exception as e:
-            logging.error(f"Ошибка при очистке: {e}")
+            logging.error("Ошибка при очистке: %s", e)
             await callback_query.message.edit_text(
                 "Произошла ошибка. Попробуй позже.",
                 reply_markup=get_back_keyboard()
@@ -269,7 +603,7 @@ async def process_deadline_text(message: Message, state: FSMContext):
     deadline_str = message.text.strip()
     try:
         deadline = datetime.strptime(deadline_str, '%Y-%m-%d').date()
-        today = datetime.now().date()
+        today = user_today(message.from_user.id)
         if deadline < today:
             await message.reply(
                 "Дедлайн не может быть в прошлом. Введи будущую дату (YYYY-MM-DD):",
@@ -283,7 +617,11 @@ async def process_deadline_text(message: Message, state: FSMContext):
             )
             return
         await state.update_data(deadline=deadline)
-        await finalize_add_task(message, state)
+        await state.set_state(AddTaskStates.waiting_for_recurrence)
+        await message.reply(
+            "Повторять задачу?",
+            reply_markup=get_recurrence_keyboard()
+        )
     except ValueError:
         await message.reply(
             "Неверный формат даты. Введи в формате YYYY-MM-DD (например, 2025-12-01):",
@@ -291,6 +629,51 @@ async def process_deadline_text(message: Message, state: FSMContext):
         )
 
 
+@dp.callback_query(
+    StateFilter(AddTaskStates.waiting_for_recurrence),
+    lambda c: c.data.startswith('repeat_')
+)
+async def process_recurrence_choice(callback_query: types.CallbackQuery, state: FSMContext):
+    '''
+    Обработчик выбора повторения задачи.
+
+    Правило строится от введенного дедлайна: в базе будет только
+    ближайшее повторение, следующее создается при его выполнении.
+    Кнопка работает только на шаге выбора повторения, частота из
+    callback data проверяется до построения правила.
+
+    :param callback_query: callback запрос с частотой (repeat_WEEKLY) или repeat_none
+    :type callback_query: aiogram.types.CallbackQuery
+    :param state: контекст состояния FSM
+    :type state: aiogram.fsm.context.FSMContext
+    :returns: None
+    '''
+    data = await state.get_data()
+    freq = callback_query.data.split('_', 1)[1]
+    if freq != 'none' and freq not in FREQUENCIES:
+        await callback_query.answer("Неизвестная частота повторения.")
+        return
+    if freq != 'none' and data.get('deadline'):
+        await state.update_data(recurrence=make_rule(freq, data['deadline']))
+    else:
+        await state.update_data(recurrence=None)
+    await finalize_add_task(callback_query, state)
+    await callback_query.answer()
+
+
+@dp.callback_query(lambda c: c.data.startswith('repeat_'))
+async def process_stale_recurrence(callback_query: types.CallbackQuery):
+    '''
+    Обработчик кнопок повторения вне шага выбора повторения: задача
+    уже добавлена или добавление отменено.
+
+    :param callback_query: callback запрос со старой кнопки повторения
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    await callback_query.answer("Эта кнопка уже не действует.")
+
+
 async def finalize_add_task(source, state: FSMContext):
     '''
     Завершает процесс добавления задачи в базу данных.
@@ -308,10 +691,11 @@ async def finalize_add_task(source, state: FSMContext):
     task_text = data.get('task_text')
     category = data.get('category')
     deadline = data.get('deadline')
+    recurrence = data.get('recurrence')
 
     logging.info(
-        f"finalize_add_task: user={user_id} text={task_text!r} "
-        f"category={category!r} deadline={deadline!r}"
+        "finalize_add_task: user=%s text=%r category=%r deadline=%r",
+        user_id, task_text, category, deadline
     )
 
     try:
@@ -323,7 +707,12 @@ async def finalize_add_task(source, state: FSMContext):
         logging.warning("Невалидный формат deadline — игнорируем.")
         deadline = None
     try:
-        task_id = db.add_task(user_id, task_text, category, deadline)
+        if not deadline:
+            recurrence = None
+        task_id = await write(
+            'add_task', user_id, task_text, category, deadline, recurrence,
+            None, None, scheduler.default_reminders
+        )
         if not task_id:
             raise RuntimeError("Не удалось добавить задачу в БД")
         parts = [f"Задача добавлена: {task_text}"]
@@ -331,25 +720,13 @@ async def finalize_add_task(source, state: FSMContext):
             parts.append(f"(Категория: {category})")
         if deadline:
             parts.append(f"(Дедлайн: {deadline.isoformat()})")
+        if recurrence:
+            parts.append(f"(Повтор: {describe(recurrence)})")
         response = " ".join(parts)
         if deadline:
-            reminder_time = datetime.combine(
-                deadline,
-                datetime.min.time()
-            ) - timedelta(days=1)
-            if getattr(scheduler, "reminder_seconds", 0) > 0:
-                reminder_time = datetime.now() + timedelta(
-                    seconds=scheduler.reminder_seconds
-                )
-            if reminder_time > datetime.now():
-                scheduler.add_reminder(
-                    user_id,
-                    task_id,
-                    task_text,
-                    reminder_time
-                )
+            schedule_deadline_reminder(user_id, task_id, task_text, deadline)
         await state.clear()
-        markup = InlineKeyboardMarkup(inline_keyboard=[
+        keyboard = [
             [
                 InlineKeyboardButton(
                     text="📋 Посмотреть список",
@@ -362,14 +739,21 @@ async def finalize_add_task(source, state: FSMContext):
                     callback_data="back_to_start"
                 )
             ]
-        ])
+        ]
+        if deadline:
+            keyboard.insert(1, [InlineKeyboardButton(
+                text="🔔 Напоминания",
+                callback_data=f"remind_{task_id}"
+            )])
+        keyboard.insert(-1, [InlineKeyboardButton(text="↩️ Отменить", callback_data="undo")])
+        markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         if isinstance(source, types.CallbackQuery):
             await source.message.edit_text(response, reply_markup=markup)
         else:
             await source.reply(response, reply_markup=markup)
-        logging.info(f"Task added id={task_id} for user={user_id}")
+        logging.info("Task added id=%s for user=%s", task_id, user_id)
     except Exception as e:
-        logging.exception(f"Ошибка при добавлении задачи: {e}")
+        logging.exception("Ошибка при добавлении задачи: %s", e)
         await state.clear()
         err = "Произошла ошибка при добавлении. Попробуй позже."
         if isinstance(source, types.CallbackQuery):
@@ -380,7 +764,8 @@ async def finalize_add_task(source, state: FSMContext):
 
 async def cmd_list_callback(callback_query: types.CallbackQuery):
     '''
-    Обработчик кнопки "Список задач". Выводит все задачи пользователя.
+    Обработчик кнопки "Список задач". Выводит задачи верхнего уровня
+    с прогрессом подзадач: два запроса к базе на весь список.
 
     :param callback_query: callback запрос от кнопки "Список задач"
     :type callback_query: aiogram.types.CallbackQuery
@@ -389,33 +774,53 @@ async def cmd_list_callback(callback_query: types.CallbackQuery):
     '''
     user_id = callback_query.from_user.id
     try:
-        tasks = db.get_tasks(user_id)
+        tasks = db.get_subtasks(user_id)
+        progress = db.get_progress(user_id, [task.id for task in tasks])
         if not tasks:
             await callback_query.message.edit_text(
-                "У тебя нет задач.",
-                reply_markup=get_back_keyboard()
+                "У тебя нет активных задач.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🗄 Архив", callback_data="archived_0")],
+                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_start")]
+                ])
             )
             return
         response = "Твои задачи:\n"
         keyboard = []
         for i, task in enumerate(tasks, start=1):
             local_id = i
-            status = "✅ Выполнена" if task[4] else "❌ Не выполнена"
-            cat = f" | Кат: {task[3]}" if task[3] else " | Кат: Нет"
-            dl = f" | Дедлайн: {task[5]}" if task[5] else " | Дедлайн: Нет"
-            response += f"ID: {local_id} | {task[2]}{cat}{dl} | {status}\n"
-            if not task[4]:
-                keyboard.append([
+            status = "✅ Выполнена" if task.done else "❌ Не выполнена"
+            cat = f" | Кат: {task.category}" if task.category else " | Кат: Нет"
+            dl = f" | Дедлайн: {task.deadline}" if task.deadline else " | Дедлайн: Нет"
+            repeat = f" | 🔁 {describe(task.recurrence)}" if task.recurrence else ""
+            checklist = format_progress(progress.get(task.id))
+            response += (
+                f"ID: {local_id} | {task.task_text}{cat}{dl}{repeat}{checklist} | {status}\n"
+            )
+            row = []
+            if not task.done:
+                row += [
                     InlineKeyboardButton(
                         text=f"✅ Выполнить {local_id}",
-                        callback_data=f"done_{task[0]}"
+                        callback_data=f"done_{task.id}"
                     ),
                     InlineKeyboardButton(
                         text=f"🗑️ Удалить {local_id}",
-                        callback_data=f"delete_{task[0]}"
+                        callback_data=f"delete_{task.id}"
                     )
-                ])
+                ]
+            if not task.done or task.id in progress:
+                row.append(InlineKeyboardButton(
+                    text=f"☑️ {local_id}",
+                    callback_data=f"checklist_{task.id}"
+                ))
+            if row:
+                keyboard.append(row)
         keyboard.append([
+            InlineKeyboardButton(
+                text="🗄 Архив",
+                callback_data="archived_0"
+            ),
             InlineKeyboardButton(
                 text="⬅️ Назад",
                 callback_data="back_to_start"
@@ -424,7 +829,617 @@ async def cmd_list_callback(callback_query: types.CallbackQuery):
         markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         await callback_query.message.edit_text(response, reply_markup=markup)
     except Exception as e:
-        logging.error(f"Ошибка при списке: {e}")
+        logging.error("Ошибка при списке: %s", e)
+        await callback_query.message.edit_text(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+
+
+@dp.callback_query(lambda c: c.data.startswith('checklist_'))
+async def show_checklist(callback_query: types.CallbackQuery):
+    '''
+    Показывает подзадачи задачи (чек-лист) с прогрессом по каждой.
+
+    Число запросов к базе не зависит от размера дерева: задача,
+    ее подзадачи и один рекурсивный запрос прогресса.
+
+    :param callback_query: callback запрос вида checklist_<ID задачи>
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    task_id = int(callback_query.data.split('_')[1])
+    try:
+        task = db.get_task(user_id, task_id)
+        if task is None:
+            await callback_query.answer("Задача не найдена.")
+            return
+        subtasks = db.get_subtasks(user_id, task_id)
+        progress = db.get_progress(user_id, [task_id] + [sub.id for sub in subtasks])
+        response = f"☑️ {task.task_text}{format_progress(progress.get(task_id))}\n"
+        if not subtasks:
+            response += "Подзадач пока нет.\n"
+        keyboard = []
+        for i, sub in enumerate(subtasks, start=1):
+            mark = "✅" if sub.done else "⬜"
+            response += f"{i}. {mark} {sub.task_text}{format_progress(progress.get(sub.id))}\n"
+            row = []
+            if not sub.done:
+                row += [
+                    InlineKeyboardButton(text=f"✅ {i}", callback_data=f"done_{sub.id}"),
+                    InlineKeyboardButton(text=f"🗑️ {i}", callback_data=f"delete_{sub.id}"),
+                ]
+            if not sub.done or sub.id in progress:
+                row.append(InlineKeyboardButton(
+                    text=f"☑️ {i}", callback_data=f"checklist_{sub.id}"
+                ))
+            if row:
+                keyboard.append(row)
+        if task.parent_id:
+            back = f"checklist_{task.parent_id}"
+        elif task.list_id:
+            back = f"slist_{task.list_id}"
+        else:
+            back = "list"
+        actions = [InlineKeyboardButton(text="➕ Подзадача", callback_data=f"addsub_{task_id}")]
+        if task.deadline and not task.done:
+            actions.append(InlineKeyboardButton(
+                text="🔔 Напоминания", callback_data=f"remind_{task_id}"
+            ))
+        keyboard.append(actions)
+        keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=back)])
+        await callback_query.message.edit_text(
+            response, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+        )
+    except Exception as e:
+        logging.error("Ошибка чек-листа: %s", e)
+        await callback_query.message.edit_text(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+    await callback_query.answer()
+
+
+@dp.callback_query(lambda c: c.data.startswith('addsub_'))
+async def process_add_subtask(callback_query: types.CallbackQuery, state: FSMContext):
+    '''
+    Обработчик кнопки "Подзадача": запрашивает текст подзадачи.
+
+    :param callback_query: callback запрос вида addsub_<ID задачи>
+    :type callback_query: aiogram.types.CallbackQuery
+    :param state: контекст состояния FSM
+    :type state: aiogram.fsm.context.FSMContext
+    :returns: None
+    '''
+    await state.clear()
+    await state.update_data(parent_id=int(callback_query.data.split('_')[1]))
+    await state.set_state(AddTaskStates.waiting_for_subtask)
+    await callback_query.message.edit_text(
+        "Введи текст подзадачи:",
+        reply_markup=get_back_keyboard()
+    )
+    await callback_query.answer()
+
+
+@dp.message(StateFilter(AddTaskStates.waiting_for_subtask))
+async def process_subtask_text(message: Message, state: FSMContext):
+    '''
+    Обработчик ввода текста подзадачи. Сохраняет подзадачу.
+
+    :param message: сообщение с текстом подзадачи
+    :type message: aiogram.types.Message
+    :param state: контекст состояния FSM
+    :type state: aiogram.fsm.context.FSMContext
+    :returns: None
+    '''
+    task_text = message.text.strip() if message.text else ""
+    if not task_text:
+        await message.reply(
+            "Текст не может быть пустым. Введи текст подзадачи:",
+            reply_markup=get_back_keyboard()
+        )
+        return
+    user_id = message.from_user.id
+    parent_id = (await state.get_data())['parent_id']
+    await state.clear()
+    try:
+        task_id = await write('add_task', user_id, task_text, None, None, None, parent_id)
+        if task_id is None:
+            await message.reply("Задача не найдена.", reply_markup=get_back_keyboard())
+            return
+        task = db.get_task(user_id, task_id)
+        if task.list_id:
+            notifier.notify(task.list_id, user_id,
+                            f"➕ {message.from_user.full_name}: {task_text}")
+        await message.reply(
+            "Подзадача добавлена!",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="➕ Еще подзадача",
+                                      callback_data=f"addsub_{parent_id}")],
+                [InlineKeyboardButton(text="☑️ К чек-листу",
+                                      callback_data=f"checklist_{parent_id}")],
+                [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_start")]
+            ])
+        )
+    except Exception as e:
+        logging.error("Ошибка при добавлении подзадачи: %s", e)
+        await message.reply("Произошла ошибка. Попробуй позже.",
+                            reply_markup=get_back_keyboard())
+
+
+def render_lists(user_id):
+    '''
+    Готовит экран общих списков пользователя.
+
+    :param user_id: ID пользователя в Telegram
+    :type user_id: int
+    :returns: текст и клавиатура
+    :rtype: tuple
+    '''
+    lists = db.get_lists(user_id)
+    keyboard = [
+        [InlineKeyboardButton(text=f"👥 {task_list.title} ({task_list.members})",
+                              callback_data=f"slist_{task_list.id}")]
+        for task_list in lists
+    ]
+    keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_start")])
+    if lists:
+        text = "Твои общие списки:"
+    else:
+        text = "У тебя нет общих списков."
+    text += "\nСоздать: /newlist Название\nВступить: /join код"
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+@dp.message(Command('lists'))
+async def cmd_lists(message: Message):
+    '''
+    Обработчик команды /lists. Показывает общие списки пользователя.
+
+    :param message: сообщение с командой /lists
+    :type message: aiogram.types.Message
+    :returns: None
+    '''
+    try:
+        text, markup = render_lists(message.from_user.id)
+        await message.reply(text, reply_markup=markup)
+    except Exception as e:
+        logging.error("Ошибка общих списков: %s", e)
+        await message.reply("Произошла ошибка. Попробуй позже.",
+                            reply_markup=get_back_keyboard())
+
+
+@dp.message(Command('newlist'))
+async def cmd_newlist(message: Message, command: CommandObject):
+    '''
+    Обработчик команды /newlist. Создает общий список и выдает код
+    приглашения для других участников.
+
+    :param message: сообщение с командой /newlist Название
+    :type message: aiogram.types.Message
+    :param command: разобранная команда с аргументом
+    :type command: aiogram.filters.CommandObject
+    :returns: None
+    '''
+    title = (command.args or "").strip()
+    if not title:
+        await message.reply("Укажи название: /newlist Покупки",
+                            reply_markup=get_back_keyboard())
+        return
+    try:
+        task_list = await write('create_list', message.from_user.id, title)
+        await message.reply(
+            f"Список '{task_list.title}' создан.\n"
+            f"Пригласи участников командой: /join {task_list.invite_code}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="👥 Открыть",
+                                      callback_data=f"slist_{task_list.id}")]
+            ])
+        )
+    except Exception as e:
+        logging.error("Ошибка создания списка: %s", e)
+        await message.reply("Произошла ошибка. Попробуй позже.",
+                            reply_markup=get_back_keyboard())
+
+
+@dp.message(Command('join'))
+async def cmd_join(message: Message, command: CommandObject):
+    '''
+    Обработчик команды /join. Добавляет пользователя в общий список
+    по коду приглашения.
+
+    В шардированном режиме общий список живет на шарде владельца и
+    доступен только пользователям этого шарда: если код найден на
+    другом шарде, пользователь получает объяснение, а не "не найден".
+
+    :param message: сообщение с командой /join код
+    :type message: aiogram.types.Message
+    :param command: разобранная команда с аргументом
+    :type command: aiogram.filters.CommandObject
+    :returns: None
+    '''
+    user_id = message.from_user.id
+    code = (command.args or "").strip()
+    try:
+        task_list, joined = await write('join_list', user_id, code)
+        if task_list is None:
+            text = "Список с таким кодом не найден."
+            if shard_info is not None and code:
+                db_name, shards, index = shard_info
+                owner = await asyncio.to_thread(invite_shard, db_name, shards, code)
+                if owner is not None and owner != index:
+                    text = (
+                        "Этот список хранится на другом сервере бота, а общие "
+                        "списки доступны только пользователям одного сервера. "
+                        "Можно создать свой список: /newlist Название"
+                    )
+            await message.reply(text, reply_markup=get_back_keyboard())
+            return
+        if joined:
+            notifier.notify(task_list.id, user_id,
+                            f"👋 {message.from_user.full_name} вступил(а) в список")
+        await message.reply(
+            f"Ты участник списка '{task_list.title}'.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="👥 Открыть",
+                                      callback_data=f"slist_{task_list.id}")]
+            ])
+        )
+    except Exception as e:
+        logging.error("Ошибка вступления в список: %s", e)
+        await message.reply("Произошла ошибка. Попробуй позже.",
+                            reply_markup=get_back_keyboard())
+
+
+@dp.callback_query(lambda c: c.data.startswith('slist_'))
+async def show_shared_list(callback_query: types.CallbackQuery):
+    '''
+    Показывает задачи общего списка с прогрессом подзадач.
+
+    :param callback_query: callback запрос вида slist_<ID списка>
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    list_id = int(callback_query.data.split('_')[1])
+    try:
+        task_list = db.get_list(user_id, list_id)
+        if task_list is None:
+            await callback_query.answer("Список не найден.")
+            return
+        tasks = db.get_subtasks(user_id, list_id=list_id)
+        progress = db.get_progress(user_id, [task.id for task in tasks])
+        response = (
+            f"👥 {task_list.title} | участников: {task_list.members}\n"
+            f"Код приглашения: {task_list.invite_code}\n"
+        )
+        if not tasks:
+            response += "Задач пока нет.\n"
+        keyboard = []
+        for i, task in enumerate(tasks, start=1):
+            mark = "✅" if task.done else "⬜"
+            dl = f" | Дедлайн: {task.deadline}" if task.deadline else ""
+            response += (
+                f"{i}. {mark} {task.task_text}{dl}{format_progress(progress.get(task.id))}\n"
+            )
+            row = []
+            if not task.done:
+                row += [
+                    InlineKeyboardButton(text=f"✅ {i}", callback_data=f"done_{task.id}"),
+                    InlineKeyboardButton(text=f"🗑️ {i}", callback_data=f"delete_{task.id}"),
+                ]
+            if not task.done or task.id in progress:
+                row.append(InlineKeyboardButton(
+                    text=f"☑️ {i}", callback_data=f"checklist_{task.id}"
+                ))
+            if row:
+                keyboard.append(row)
+        keyboard.append([
+            InlineKeyboardButton(text="➕ Задача", callback_data=f"sadd_{list_id}"),
+            InlineKeyboardButton(text="🚪 Выйти", callback_data=f"leave_{list_id}")
+        ])
+        keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="lists")])
+        await callback_query.message.edit_text(
+            response, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+        )
+    except Exception as e:
+        logging.error("Ошибка общего списка: %s", e)
+        await callback_query.message.edit_text(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+    await callback_query.answer()
+
+
+@dp.callback_query(lambda c: c.data.startswith('sadd_'))
+async def process_add_list_task(callback_query: types.CallbackQuery, state: FSMContext):
+    '''
+    Обработчик кнопки "Задача" общего списка: запрашивает текст задачи.
+
+    :param callback_query: callback запрос вида sadd_<ID списка>
+    :type callback_query: aiogram.types.CallbackQuery
+    :param state: контекст состояния FSM
+    :type state: aiogram.fsm.context.FSMContext
+    :returns: None
+    '''
+    await state.clear()
+    await state.update_data(list_id=int(callback_query.data.split('_')[1]))
+    await state.set_state(AddTaskStates.waiting_for_list_task)
+    await callback_query.message.edit_text(
+        "Введи текст задачи для общего списка:",
+        reply_markup=get_back_keyboard()
+    )
+    await callback_query.answer()
+
+
+@dp.message(StateFilter(AddTaskStates.waiting_for_list_task))
+async def process_list_task_text(message: Message, state: FSMContext):
+    '''
+    Обработчик ввода задачи общего списка. Сохраняет задачу
+    и уведомляет остальных участников.
+
+    :param message: сообщение с текстом задачи
+    :type message: aiogram.types.Message
+    :param state: контекст состояния FSM
+    :type state: aiogram.fsm.context.FSMContext
+    :returns: None
+    '''
+    task_text = message.text.strip() if message.text else ""
+    if not task_text:
+        await message.reply(
+            "Текст не может быть пустым. Введи текст задачи:",
+            reply_markup=get_back_keyboard()
+        )
+        return
+    user_id = message.from_user.id
+    list_id = (await state.get_data())['list_id']
+    await state.clear()
+    try:
+        task_id = await write('add_task', user_id, task_text, None, None, None, None, list_id)
+        if task_id is None:
+            await message.reply("Список не найден.", reply_markup=get_back_keyboard())
+            return
+        notifier.notify(list_id, user_id, f"➕ {message.from_user.full_name}: {task_text}")
+        await message.reply(
+            "Задача добавлена в общий список!",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="➕ Еще задача", callback_data=f"sadd_{list_id}")],
+                [InlineKeyboardButton(text="👥 К списку", callback_data=f"slist_{list_id}")]
+            ])
+        )
+    except Exception as e:
+        logging.error("Ошибка при добавлении в общий список: %s", e)
+        await message.reply("Произошла ошибка. Попробуй позже.",
+                            reply_markup=get_back_keyboard())
+
+
+@dp.callback_query(lambda c: c.data.startswith('leave_'))
+async def process_leave_list(callback_query: types.CallbackQuery):
+    '''
+    Обработчик кнопки "Выйти": выход из общего списка. Список,
+    из которого вышли все участники, удаляется вместе с задачами.
+
+    :param callback_query: callback запрос вида leave_<ID списка>
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    list_id = int(callback_query.data.split('_')[1])
+    try:
+        if await write('leave_list', user_id, list_id):
+            notifier.notify(list_id, user_id,
+                            f"👋 {callback_query.from_user.full_name} вышел(а) из списка")
+            await callback_query.message.edit_text(
+                "Ты вышел из списка.", reply_markup=get_back_keyboard()
+            )
+        else:
+            await callback_query.answer("Список не найден.")
+            return
+    except Exception as e:
+        logging.error("Ошибка выхода из списка: %s", e)
+        await callback_query.message.edit_text(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+    await callback_query.answer()
+
+
+def render_reminders(task):
+    '''
+    Готовит экран смещений напоминаний задачи с переключателями.
+
+    :param task: задача
+    :type task: Task
+    :returns: текст и клавиатура
+    :rtype: tuple
+    '''
+    keyboard = [
+        [InlineKeyboardButton(
+            text=f"{'✅' if task.reminders & bit else '⬜'} {label}",
+            callback_data=f"rtoggle_{task.id}_{bit}"
+        )]
+        for bit, label in REMINDER_LABELS.items()
+    ]
+    keyboard.append([
+        InlineKeyboardButton(text="⬅️ Назад", callback_data=f"checklist_{task.id}")
+    ])
+    text = f"🔔 Напоминания о задаче '{task.task_text}' (дедлайн {task.deadline}):"
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+@dp.callback_query(lambda c: c.data.startswith('remind_'))
+async def show_reminders(callback_query: types.CallbackQuery):
+    '''
+    Показывает смещения напоминаний задачи с переключателями.
+
+    :param callback_query: callback запрос вида remind_<ID задачи>
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    task_id = int(callback_query.data.split('_')[1])
+    try:
+        task = db.get_task(user_id, task_id)
+        if task is None:
+            await callback_query.answer("Задача не найдена.")
+            return
+        text, markup = render_reminders(task)
+        await callback_query.message.edit_text(text, reply_markup=markup)
+    except Exception as e:
+        logging.error("Ошибка напоминаний: %s", e)
+        await callback_query.message.edit_text(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+    await callback_query.answer()
+
+
+@dp.callback_query(lambda c: c.data.startswith('rtoggle_'))
+async def process_reminder_toggle(callback_query: types.CallbackQuery):
+    '''
+    Включает или выключает одно смещение напоминаний задачи.
+
+    :param callback_query: callback запрос вида rtoggle_<ID задачи>_<бит>
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    _, task_id, bit = callback_query.data.split('_')
+    try:
+        task = db.get_task(user_id, int(task_id))
+        reminders = None
+        if task is not None and int(bit) in REMINDER_LABELS:
+            reminders = await write('toggle_reminder', user_id, task.id, int(bit))
+        if reminders is None:
+            await callback_query.answer("Задача не найдена.")
+            return
+        text, markup = render_reminders(task._replace(reminders=reminders))
+        await callback_query.message.edit_text(text, reply_markup=markup)
+    except Exception as e:
+        logging.error("Ошибка напоминаний: %s", e)
+        await callback_query.message.edit_text(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+    await callback_query.answer()
+
+
+@dp.callback_query(lambda c: c.data.startswith('snooze_'))
+async def process_snooze(callback_query: types.CallbackQuery):
+    '''
+    Обработчик кнопки "отложить" под напоминанием.
+
+    :param callback_query: callback запрос вида snooze_<ID задачи>_<минуты>
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    _, task_id, minutes = callback_query.data.split('_')
+    labels = dict(SNOOZE_OPTIONS)
+    task = db.get_task(user_id, int(task_id))
+    if task is None or task.done or int(minutes) not in labels:
+        await callback_query.answer("Задача уже выполнена или удалена.")
+        return
+    scheduler.snooze(user_id, task.id, task.task_text, int(minutes))
+    await callback_query.answer(f"Напомню через {labels[int(minutes)]}.")
+
+
+ARCHIVE_PAGE_SIZE = 10
+
+
+@dp.callback_query(lambda c: c.data.startswith('archived_'))
+async def show_archived(callback_query: types.CallbackQuery):
+    '''
+    Обработчик кнопки "Архив". Выводит страницу архивных задач.
+
+    Архив читается только по запросу пользователя, поэтому обычный
+    список задач не растет вместе с историей.
+
+    :param callback_query: callback запрос с номером страницы (archived_N)
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    page = int(callback_query.data.split('_')[1])
+    try:
+        tasks = db.get_archived_tasks(
+            user_id, ARCHIVE_PAGE_SIZE + 1, page * ARCHIVE_PAGE_SIZE
+        )
+        to_list = [InlineKeyboardButton(text="📋 К списку", callback_data="list")]
+        if not tasks:
+            await callback_query.message.edit_text(
+                "Архив пуст.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[to_list])
+            )
+            await callback_query.answer()
+            return
+        response = f"🗄 Архив, страница {page + 1}:\n"
+        for task in tasks[:ARCHIVE_PAGE_SIZE]:
+            cat = f" | Кат: {task.category}" if task.category else ""
+            dl = f" | Дедлайн: {task.deadline}" if task.deadline else ""
+            response += f"✅ {task.task_text}{cat}{dl}\n"
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(
+                text="⬅️", callback_data=f"archived_{page - 1}"
+            ))
+        if len(tasks) > ARCHIVE_PAGE_SIZE:
+            navigation.append(InlineKeyboardButton(
+                text="➡️", callback_data=f"archived_{page + 1}"
+            ))
+        keyboard = [navigation, to_list] if navigation else [to_list]
+        await callback_query.message.edit_text(
+            response,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+        )
+    except Exception as e:
+        logging.error("Ошибка архива: %s", e)
+        await callback_query.message.edit_text(
+            "Произошла ошибка. Попробуй позже.",
+            reply_markup=get_back_keyboard()
+        )
+    await callback_query.answer()
+
+
+async def show_due(callback_query: types.CallbackQuery):
+    '''
+    Обработчик кнопки "Сроки". Выводит просроченные задачи и задачи
+    с дедлайном в ближайшие DUE_SOON_DAYS дней.
+
+    Оба списка читаются диапазонными запросами по индексу дедлайнов.
+    Задачи нумеруются так же, как в списке задач.
+
+    :param callback_query: callback запрос от нажатия кнопки "Сроки"
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    try:
+        today = user_today(user_id)
+        overdue = db.get_due(user_id, None, today - timedelta(days=1))
+        soon = db.get_due(user_id, today, today + timedelta(days=DUE_SOON_DAYS))
+        if not overdue and not soon:
+            response = "Нет просроченных задач и близких дедлайнов."
+        else:
+            numbers = {
+                task.id: i for i, task in enumerate(db.get_subtasks(user_id), start=1)
+            }
+            response = ""
+            if overdue:
+                response += "🔥 Просрочено:\n"
+                for task in overdue:
+                    response += format_due_line(task, numbers)
+            if soon:
+                response += f"⏰ Ближайшие {DUE_SOON_DAYS} дн.:\n"
+                for task in soon:
+                    response += format_due_line(task, numbers)
+        await callback_query.message.edit_text(
+            response,
+            reply_markup=get_back_keyboard()
+        )
+    except Exception as e:
+        logging.error("Ошибка сроков: %s", e)
         await callback_query.message.edit_text(
             "Произошла ошибка. Попробуй позже.",
             reply_markup=get_back_keyboard()
@@ -443,7 +1458,8 @@ async def back_to_start(callback_query: types.CallbackQuery, state: FSMContext):
     :returns: None
     '''
     await state.clear()
-    await cmd_start(callback_query.message, state)
+    await send_main_menu(callback_query.message)
+    db.register_user(callback_query.from_user.id)
     await callback_query.answer()
 
 
@@ -458,17 +1474,16 @@ async def show_statistics(callback_query: types.CallbackQuery):
     '''
     user_id = callback_query.from_user.id
     try:
-        tasks = db.get_tasks(user_id)
+        total, done = db.get_stats(user_id)
+        subtasks, subtasks_done = db.get_subtask_stats(user_id)
 
-        if not tasks:
+        if not total:
             await callback_query.message.edit_text(
                 "📊 У тебя еще нет задач",
                 reply_markup=get_back_keyboard()
             )
             await callback_query.answer()
             return
-        total = len(tasks)
-        done = sum(1 for task in tasks if task[4])
         percent = (done / total * 100) if total > 0 else 0
 
         bar_length = 10
@@ -497,6 +1512,8 @@ async def show_statistics(callback_query: types.CallbackQuery):
             f"📈 <b>Прогресс:</b> {percent:.1f}%\n\n"
             f"{progress_bar}"
         )
+        if subtasks:
+            message += f"\n\n☑️ <b>Подзадачи:</b> {subtasks_done} из {subtasks}"
 
         await callback_query.message.edit_text(
             message,
@@ -505,7 +1522,7 @@ async def show_statistics(callback_query: types.CallbackQuery):
         )
 
     except Exception as e:
-        logging.error(f"Ошибка статистики: {e}")
+        logging.error("Ошибка статистики: %s", e)
         await callback_query.message.edit_text(
             "⚠ Ошибка загрузки статистики",
             reply_markup=get_back_keyboard()
@@ -519,6 +1536,8 @@ async def process_done_callback(callback_query: types.CallbackQuery):
     '''
     Обработчик инлайн-кнопок для отметки выполненных задач.
 
+    Для повторяющейся задачи создается и планируется следующее повторение.
+
     :param callback_query: объект callback запроса от инлайн-кнопки
     :type callback_query: aiogram.types.CallbackQuery
     :returns: None
@@ -528,16 +1547,29 @@ async def process_done_callback(callback_query: types.CallbackQuery):
     task_id = int(callback_query.data.split('_')[1])
 
     try:
-        if db.mark_done(user_id, task_id):
+        task = db.get_task(user_id, task_id)
+        done, next_task = await write(
+            'complete_task', user_id, task_id, user_today(user_id)
+        )
+        if done:
+            if task is not None and task.list_id:
+                notifier.notify(task.list_id, user_id,
+                                f"✅ {callback_query.from_user.full_name}: {task.task_text}")
+            response = "Задача отмечена как выполненная!"
+            if next_task:
+                response += f"\nСледующее повторение: {next_task.deadline.isoformat()}"
+                schedule_deadline_reminder(
+                    user_id, next_task.id, next_task.task_text, next_task.deadline
+                )
             await callback_query.message.edit_text(
-                "Задача отмечена как выполненная!",
-                reply_markup=get_back_keyboard()
+                response,
+                reply_markup=get_undo_keyboard()
             )
             await callback_query.answer("Готово!")
         else:
             await callback_query.answer("Задача не найдена.")
     except Exception as e:
-        logging.error(f"Ошибка при отметке: {e}")
+        logging.error("Ошибка при отметке: %s", e)
         await callback_query.answer("Ошибка.")
 
 
@@ -555,16 +1587,49 @@ async def process_delete_callback(callback_query: types.CallbackQuery):
     task_id = int(callback_query.data.split('_')[1])
 
     try:
-        if db.delete_task(user_id, task_id):
+        task = db.get_task(user_id, task_id)
+        if await write('delete_task', user_id, task_id):
+            if task is not None and task.list_id:
+                notifier.notify(task.list_id, user_id,
+                                f"🗑️ {callback_query.from_user.full_name}: {task.task_text}")
             await callback_query.message.edit_text(
                 "Задача удалена! Используй /list для обновления.",
-                reply_markup=get_back_keyboard()
+                reply_markup=get_undo_keyboard()
             )
             await callback_query.answer("Удалено!")
         else:
             await callback_query.answer("Задача не найдена.")
     except Exception as e:
-        logging.error(f"Ошибка при удалении: {e}")
+        logging.error("Ошибка при удалении: %s", e)
+        await callback_query.answer("Ошибка.")
+
+
+@dp.callback_query(lambda c: c.data == "undo")
+async def process_undo_callback(callback_query: types.CallbackQuery):
+    '''
+    Обработчик кнопки "Отменить": отменяет последнее действие
+    пользователя по журналу изменений задач.
+
+    :param callback_query: объект callback запроса от инлайн-кнопки
+    :type callback_query: aiogram.types.CallbackQuery
+    :returns: None
+    '''
+    user_id = callback_query.from_user.id
+    try:
+        kind = await write('undo_last', user_id)
+        if kind is None:
+            await callback_query.answer("Нечего отменять.")
+            return
+        await callback_query.message.edit_text(
+            f"Отменено: {UNDO_NAMES[kind]}.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="📋 К списку", callback_data="list")],
+                [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_start")]
+            ])
+        )
+        await callback_query.answer("Отменено!")
+    except Exception as e:
+        logging.error("Ошибка отмены: %s", e)
         await callback_query.answer("Ошибка.")
 
 
@@ -583,13 +1648,37 @@ async def unknown_command(message: Message):
     )
 
 
+@dp.shutdown()
+async def on_shutdown():
+    '''
+    Плавная остановка после SIGTERM/SIGINT: aiogram уже прекратил
+    прием апдейтов, но еще не закрыл сессию бота.
+
+    :returns: None
+    '''
+    await graceful_shutdown(
+        bot, inflight, scheduler, writer, db, notifier=notifier, broadcaster=broadcaster
+    )
+    if recorder is not None:
+        recorder.close()
+
+
 async def main():
     '''
     Основная асинхронная функция для запуска бота.
 
+    При запуске планировщик досылает напоминания, пропущенные
+    за время остановки, прерванные рассылки продолжаются, а апдейты,
+    не обработанные к остановке, обрабатываются до приема новых.
+
     :returns: None
     '''
+    db.create_table(None)
     await scheduler.start()
+    if writer is not None:
+        writer.start()
+    await broadcaster.resume()
+    await redeliver(dp, bot, db)
     await dp.start_polling(bot)
 
 
@@ -0,0 +1,194 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from aiogram import BaseMiddleware
+
+from logconfig import correlation_id
+
+
+class KeyedLock:
+    '''
+    Набор asyncio-блокировок по ключу.
+
+    Блокировка удаляется, как только ее никто не держит и не ждет,
+    поэтому память пропорциональна числу активных ключей.
+    '''
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key):
+        '''
+        Захватывает блокировку ключа на время блока.
+
+        Ожидающие получают блокировку в порядке обращения.
+
+        :param key: ключ блокировки
+        '''
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+class CorrelationMiddleware(BaseMiddleware):
+    '''
+    Помечает логи обработки апдейта его correlation id.
+
+    Id берется из update_id и хранится в contextvar, поэтому виден
+    и в задачах, запущенных обработчиком. Регистрируется первым
+    outer middleware на dp.update.
+    '''
+
+    async def __call__(self, handler, event, data):
+        token = correlation_id.set(str(event.update_id))
+        try:
+            return await handler(event, data)
+        finally:
+            correlation_id.reset(token)
+
+
+class UserLockMiddleware(BaseMiddleware):
+    '''
+    Последовательная обработка апдейтов одного пользователя.
+
+    Апдейты одного пользователя выполняются строго по очереди
+    (например, быстрые нажатия "выполнить" и "удалить"), апдейты
+    разных пользователей - параллельно. Регистрируется как outer
+    middleware на dp.update после UserContextMiddleware.
+    '''
+
+    def __init__(self):
+        self.locks = KeyedLock()
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        async with self.locks.hold(user.id):
+            return await handler(event, data)
+
+
+DEFAULT_THROTTLE_LIMITS = {
+    'list': (5, 10),
+    'due': (3, 10),
+    'stats': (3, 10),
+    'add': (5, 10),
+    'clear_all': (2, 30),
+}
+
+
+def parse_throttle_limits(spec):
+    '''
+    Разбирает лимиты вида "list=5/10,stats=3/10".
+
+    Запись action=N/T означает не больше N нажатий за T секунд
+    (с возможностью всплеска до N).
+
+    :param spec: строка лимитов
+    :type spec: str
+    :returns: {действие: (емкость, период в секундах)}
+    :rtype: dict
+    :raises ValueError: при неверном формате строки
+    '''
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        action, _, value = item.partition('=')
+        capacity, _, period = value.partition('/')
+        limits[action.strip()] = (int(capacity), float(period))
+    return limits
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    '''
+    Ограничение частоты нажатий кнопок меню для каждого пользователя.
+
+    Для каждой пары (пользователь, действие) хранится token bucket
+    из двух чисел. Запись можно удалить, как только корзина полностью
+    восстановилась, поэтому словарь периодически чистится и остается
+    пропорционален числу недавно активных пользователей.
+
+    Отклоненные нажатия получают короткий ответ на callback без
+    обращения к базе данных. Регистрируется как outer middleware
+    на dp.callback_query.
+    '''
+
+    def __init__(self, limits=None, sweep_interval=60.0, clock=time.monotonic):
+        '''
+        :param limits: {действие: (емкость, период в секундах)}
+        :type limits: dict, optional
+        :param sweep_interval: как часто удалять восстановившиеся записи, сек
+        :type sweep_interval: float
+        :param clock: источник времени
+        :type clock: callable
+        '''
+        limits = DEFAULT_THROTTLE_LIMITS if limits is None else limits
+        self.limits = {
+            action: (float(capacity), capacity / period)
+            for action, (capacity, period) in limits.items()
+        }
+        self.buckets = {}
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._next_sweep = clock() + sweep_interval
+
+    def allow(self, user_id, action):
+        '''
+        Списывает токен из корзины пользователя.
+
+        :param user_id: ID пользователя Telegram
+        :type user_id: int
+        :param action: действие (callback data)
+        :type action: str
+        :returns: True если нажатие разрешено
+        :rtype: bool
+        '''
+        limit = self.limits.get(action)
+        if limit is None:
+            return True
+        capacity, rate = limit
+        now = self.clock()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        key = (user_id, action)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = (capacity - 1, now)
+            return True
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        if tokens < 1:
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        return True
+
+    def _sweep(self, now):
+        '''
+        Удаляет корзины, которые уже полностью восстановились.
+
+        :returns: None
+        '''
+        limits = self.limits
+        self.buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * limits[key[1]][1] < limits[key[1]][0]
+        }
+        self._next_sweep = now + self.sweep_interval
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None or self.allow(user.id, event.data):
+            return await handler(event, data)
+        await event.answer('Слишком часто. Подожди немного.')
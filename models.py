@@ -0,0 +1,92 @@
+from datetime import date
+from typing import NamedTuple, Optional
+
+# Смещения напоминаний о дедлайне - биты маски Task.reminders.
+REMIND_1W = 1
+REMIND_3D = 2
+REMIND_1D = 4
+REMIND_3H = 8
+REMIND_1H = 16
+REMINDER_CODES = {
+    REMIND_1W: '1w', REMIND_3D: '3d', REMIND_1D: '1d', REMIND_3H: '3h', REMIND_1H: '1h'
+}
+DEFAULT_REMINDERS = REMIND_1D
+
+# Состояния доставки рассылки одному получателю.
+DELIVERY_PENDING = 0
+DELIVERY_SENT = 1
+DELIVERY_FAILED = 2
+DELIVERY_BLOCKED = 3
+
+
+class Task(NamedTuple):
+    '''
+    Задача пользователя.
+
+    Подкласс tuple без __dict__ (__slots__ = ()): строка занимает
+    столько же памяти, сколько обычный кортеж, а поля доступны
+    по именам. Доступ по индексам сохраняется для совместимости.
+
+    Смещения напоминаний хранятся одним числом - битовой маской
+    из констант REMIND_*.
+    '''
+    id: int
+    user_id: int
+    task_text: str
+    category: Optional[str]
+    done: bool
+    deadline: Optional[date]
+    recurrence: Optional[str] = None
+    parent_id: Optional[int] = None
+    list_id: Optional[int] = None
+    reminders: int = DEFAULT_REMINDERS
+
+
+class TaskRef(NamedTuple):
+    '''
+    Проекция задачи для напоминаний: только нужные для отправки поля.
+    '''
+    id: int
+    user_id: int
+    task_text: str
+    deadline: date
+
+
+class TaskList(NamedTuple):
+    '''
+    Общий список задач нескольких пользователей.
+    '''
+    id: int
+    owner_id: int
+    title: str
+    invite_code: str
+    members: int
+
+
+class TaskEvent(NamedTuple):
+    '''
+    Событие журнала изменений задач.
+
+    kind - вид изменения: add, done, delete, clear (task_id - None)
+    или undo (отмена предыдущего действия пользователя).
+    '''
+    seq: int
+    user_id: int
+    task_id: Optional[int]
+    kind: str
+    created_at: int
+
+
+class Broadcast(NamedTuple):
+    '''
+    Рассылка администратора со сводкой доставки по получателям.
+    '''
+    id: int
+    admin_id: int
+    text: str
+    total: int
+    pending: int
+    sent: int
+    failed: int
+    blocked: int
+    finished: bool
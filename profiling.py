@@ -0,0 +1,212 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+from aiogram import BaseMiddleware
+
+
+def parse_admin_ids(text):
+    '''
+    Разбирает список ID администраторов: "123,456".
+
+    :param text: ID через запятую
+    :type text: str
+    :rtype: frozenset
+    :raises ValueError: если ID не число
+    '''
+    return frozenset(int(part) for part in text.split(',') if part.strip())
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    '''
+    Профилирование окна из N апдейтов по запросу.
+
+    Пока окно не запущено, middleware только проверяет счетчик
+    и сразу передает апдейт дальше. В окне каждый sample_every-й
+    апдейт выполняется под cProfile, а tracemalloc следит за
+    выделениями памяти на всем окне. Синхронные вызовы Database
+    из обработчиков попадают в профиль, так как выполняются в потоке
+    цикла событий; запись через GroupCommitWriter идет в рабочем
+    потоке и в профиль не попадает.
+
+    По завершении окна в out_dir пишутся файлы .pstats и
+    .snapshot (tracemalloc), а отчет с top самыми горячими функциями
+    уходит в лог и в чат администратора, запустившего окно.
+    '''
+
+    def __init__(self, out_dir='profiles', top=20, sample_every=1):
+        '''
+        :param out_dir: каталог для файлов профиля
+        :type out_dir: str
+        :param top: число функций в отчете
+        :type top: int
+        :param sample_every: профилировать каждый N-й апдейт окна
+        :type sample_every: int
+        '''
+        self.out_dir = out_dir
+        self.top = top
+        self.sample_every = sample_every
+        self.remaining = 0
+        self.task = None
+        self._seen = 0
+        self._inflight = 0
+        self._profile = None
+        self._chat_id = None
+        self._tracing = False
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self, updates, chat_id=None):
+        '''
+        Запускает окно профилирования.
+
+        :param updates: число апдейтов в окне
+        :type updates: int
+        :param chat_id: чат, куда отправить отчет
+        :type chat_id: int, optional
+        :returns: None
+        :raises RuntimeError: если окно уже идет
+        :raises ValueError: если updates не положительно
+        '''
+        if self.active:
+            raise RuntimeError('Профилирование уже идет')
+        if updates < 1:
+            raise ValueError('Число апдейтов должно быть положительным')
+        self._profile = cProfile.Profile()
+        self._chat_id = chat_id
+        self._seen = 0
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self.remaining = updates
+
+    async def stop(self, bot=None):
+        '''
+        Досрочно завершает окно: новые апдейты больше не профилируются.
+
+        Если профилируемых апдейтов в работе нет, отчет строится сразу,
+        иначе - после завершения последнего из них.
+
+        :param bot: бот для отправки отчета в чат администратора
+        :returns: текст отчета или None, если отчет будет позже
+        :rtype: str or None
+        '''
+        self.remaining = 0
+        if self.active and not self._inflight:
+            return await self._report(bot, *self._collect())
+        return None
+
+    async def __call__(self, handler, event, data):
+        if not self.remaining:
+            return await handler(event, data)
+        self.remaining -= 1
+        self._seen += 1
+        if (self._seen - 1) % self.sample_every:
+            result = await handler(event, data)
+        else:
+            if not self._inflight:
+                self._profile.enable()
+            self._inflight += 1
+            try:
+                result = await handler(event, data)
+            finally:
+                self._inflight -= 1
+                if not self._inflight:
+                    self._profile.disable()
+        if not self.remaining and not self._inflight and self.active:
+            self.task = asyncio.ensure_future(
+                self._report(data.get('bot'), *self._collect())
+            )
+        return result
+
+    def _collect(self):
+        '''
+        Закрывает окно: забирает профиль и снимок памяти.
+
+        :returns: (профиль, чат для отчета, снимок tracemalloc)
+        :rtype: tuple
+        '''
+        profile, chat_id = self._profile, self._chat_id
+        self._profile = None
+        snapshot = tracemalloc.take_snapshot()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        return profile, chat_id, snapshot
+
+    async def _report(self, bot, profile, chat_id, snapshot):
+        '''
+        Сохраняет профиль окна и отправляет отчет.
+
+        :param bot: бот для отправки отчета в чат администратора
+        :returns: текст отчета
+        :rtype: str
+        '''
+        report = await asyncio.to_thread(self._dump, profile, snapshot)
+        logging.info('Профиль окна:\n%s', report)
+        if chat_id is not None and bot is not None:
+            try:
+                await bot.send_message(chat_id, report[:4000])
+            except Exception as e:
+                logging.warning('Не удалось отправить профиль: %s', e)
+        return report
+
+    def _dump(self, profile, snapshot):
+        '''
+        Пишет файлы профиля и строит отчет (в рабочем потоке).
+
+        :rtype: str
+        '''
+        profile.create_stats()
+        if not profile.stats:
+            return 'Профиль пуст: ни один апдейт не попал в окно.'
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        stats_path = os.path.join(self.out_dir, f'profile-{stamp}.pstats')
+        snapshot_path = os.path.join(self.out_dir, f'alloc-{stamp}.snapshot')
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        stats.dump_stats(stats_path)
+        snapshot.dump(snapshot_path)
+
+        lines = [f'Профиль: {self._seen} апдейтов, файлы {stats_path}, {snapshot_path}',
+                 'cumtime    tottime  вызовы  функция']
+        hot = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in hot[:self.top]:
+            where = f'{os.path.basename(filename)}:{line}' if line else filename
+            lines.append(
+                f'{cumtime * 1000:8.1f}ms {tottime * 1000:8.1f}ms {calls:6d}  {name} ({where})'
+            )
+        lines.append('Выделения памяти:')
+        for stat in snapshot.statistics('lineno')[:5]:
+            lines.append(f'{stat.size / 1024:8.1f} KiB {stat.count:6d}  {stat.traceback}')
+        return '\n'.join(lines)
+
+
+def build_profiler():
+    '''
+    Создает middleware профилирования по переменным окружения.
+
+    Переменные окружения:
+        PROFILE_DIR: каталог для файлов профиля (profiles)
+        PROFILE_TOP: число функций в отчете (20)
+        PROFILE_SAMPLE: профилировать каждый N-й апдейт окна (1)
+        PROFILE_UPDATES: сразу запустить окно из N апдейтов (не задано - нет)
+
+    :rtype: ProfilingMiddleware
+    '''
+    profiler = ProfilingMiddleware(
+        out_dir=os.getenv('PROFILE_DIR', 'profiles'),
+        top=int(os.getenv('PROFILE_TOP', '20')),
+        sample_every=int(os.getenv('PROFILE_SAMPLE', '1')),
+    )
+    updates = os.getenv('PROFILE_UPDATES')
+    if updates:
+        profiler.start(int(updates))
+    return profiler
@@ -0,0 +1,167 @@
+import calendar
+from datetime import timedelta
+from functools import lru_cache
+from typing import NamedTuple
+
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+FREQUENCY_NAMES = {
+    'DAILY': 'каждый день',
+    'WEEKLY': 'каждую неделю',
+    'MONTHLY': 'каждый месяц',
+    'YEARLY': 'каждый год',
+}
+
+
+class Rule(NamedTuple):
+    '''
+    Правило повторения задачи, подмножество RRULE (RFC 5545).
+
+    Хранится в базе строкой вида FREQ=MONTHLY;INTERVAL=1;BYMONTHDAY=31.
+    BYMONTHDAY - исходный день месяца: если в месяце столько дней нет,
+    берется последний день, а в следующих месяцах снова исходный.
+    '''
+    freq: str
+    interval: int = 1
+    monthday: int = None
+
+
+@lru_cache(maxsize=1024)
+def parse_rule(text):
+    '''
+    Разбирает строку правила повторения.
+
+    Правил в базе немного разных, поэтому результат кешируется.
+
+    :param text: правило, например FREQ=WEEKLY;INTERVAL=2 (префикс RRULE: допустим)
+    :type text: str
+    :rtype: Rule
+    :raises ValueError: если правило некорректно или не поддерживается
+    '''
+    if text.upper().startswith('RRULE:'):
+        text = text[6:]
+    parts = {}
+    for part in text.split(';'):
+        key, sep, value = part.partition('=')
+        if not sep:
+            raise ValueError(f'Некорректная часть правила: {part!r}')
+        parts[key.strip().upper()] = value.strip().upper()
+    freq = parts.pop('FREQ', None)
+    if freq not in FREQUENCIES:
+        raise ValueError(f'Неподдерживаемая частота: {freq!r}')
+    try:
+        interval = int(parts.pop('INTERVAL', '1'))
+        monthday = parts.pop('BYMONTHDAY', None)
+        monthday = int(monthday) if monthday is not None else None
+    except ValueError:
+        raise ValueError(f'Некорректное число в правиле: {text!r}') from None
+    if parts:
+        raise ValueError(f'Неподдерживаемые части правила: {", ".join(parts)}')
+    if interval < 1:
+        raise ValueError('INTERVAL должен быть положительным')
+    if monthday is not None and not 1 <= monthday <= 31:
+        raise ValueError('BYMONTHDAY должен быть от 1 до 31')
+    return Rule(freq, interval, monthday)
+
+
+def format_rule(rule):
+    '''
+    Записывает правило строкой для хранения в базе.
+
+    :type rule: Rule
+    :rtype: str
+    '''
+    text = f'FREQ={rule.freq};INTERVAL={rule.interval}'
+    if rule.monthday is not None:
+        text += f';BYMONTHDAY={rule.monthday}'
+    return text
+
+
+def make_rule(freq, start, interval=1):
+    '''
+    Создает правило повторения от первой даты задачи.
+
+    Для месячных и годовых правил запоминается день месяца start,
+    чтобы задача на 31-е после короткого месяца вернулась на 31-е.
+
+    :param freq: частота из FREQUENCIES
+    :type freq: str
+    :param start: дата первого выполнения
+    :type start: datetime.date
+    :param interval: шаг повторения
+    :type interval: int
+    :returns: правило в виде строки
+    :rtype: str
+    :raises ValueError: если частота неизвестна
+    '''
+    if freq not in FREQUENCIES:
+        raise ValueError(f'Неподдерживаемая частота: {freq!r}')
+    monthday = start.day if freq in ('MONTHLY', 'YEARLY') else None
+    return format_rule(Rule(freq, interval, monthday))
+
+
+def describe(text):
+    '''
+    Возвращает описание правила для пользователя.
+
+    :param text: правило в виде строки
+    :type text: str
+    :rtype: str
+    '''
+    rule = parse_rule(text)
+    if rule.interval == 1:
+        return FREQUENCY_NAMES[rule.freq]
+    return f'{FREQUENCY_NAMES[rule.freq]} ×{rule.interval}'
+
+
+def _shift_months(day, months, monthday):
+    '''
+    Сдвигает дату на months месяцев, ограничивая день длиной месяца.
+
+    :rtype: datetime.date
+    '''
+    total = day.year * 12 + day.month - 1 + months
+    year, month = divmod(total, 12)
+    month += 1
+    return day.replace(
+        year=year, month=month,
+        day=min(monthday, calendar.monthrange(year, month)[1])
+    )
+
+
+def next_due(text, after, not_before=None):
+    '''
+    Вычисляет ближайшее повторение задачи.
+
+    Повторения не разворачиваются заранее: считается только одна
+    следующая дата, причем пропущенные повторения (задачу закрыли
+    с опозданием) перескакиваются арифметически, без перебора.
+
+    :param text: правило в виде строки
+    :type text: str
+    :param after: дата текущего повторения
+    :type after: datetime.date
+    :param not_before: самая ранняя допустимая дата (например, сегодня)
+    :type not_before: datetime.date, optional
+    :returns: дата следующего повторения (строго позже after)
+    :rtype: datetime.date
+    :raises ValueError: если правило некорректно
+    '''
+    rule = parse_rule(text)
+    if rule.freq in ('DAILY', 'WEEKLY'):
+        step = rule.interval * (7 if rule.freq == 'WEEKLY' else 1)
+        steps = 1
+        if not_before is not None and not_before > after:
+            steps = max(1, -(-(not_before - after).days // step))
+        return after + timedelta(days=step * steps)
+
+    step = rule.interval * (12 if rule.freq == 'YEARLY' else 1)
+    monthday = rule.monthday or after.day
+    steps = 1
+    if not_before is not None and not_before > after:
+        gap = (not_before.year - after.year) * 12 + not_before.month - after.month
+        steps = max(1, gap // step)
+    due = _shift_months(after, step * steps, monthday)
+    while not_before is not None and due < not_before:
+        steps += 1
+        due = _shift_months(after, step * steps, monthday)
+    return due
@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import tempfile
+import threading
+import time
+
+from aiogram import BaseMiddleware
+
+USER_KEYS = frozenset((
+    'from', 'chat', 'user', 'sender_chat', 'sender_user', 'forward_from',
+    'forward_from_chat', 'via_bot', 'new_chat_members', 'left_chat_member', 'contact'
+))
+PERSONAL_FIELDS = ('last_name', 'username', 'title', 'bio')
+NAME_FIELDS = frozenset(('first_name', 'sender_user_name', 'forward_sender_name'))
+DROPPED_FIELDS = frozenset(('author_signature', 'forward_signature', 'vcard'))
+
+_handler_queries = contextvars.ContextVar('replay_handler_queries', default=None)
+
+
+def anonymous_id(user_id, salt):
+    '''
+    Стабильный псевдоним ID пользователя или чата.
+
+    Один ID при одной соли всегда дает один псевдоним, поэтому порядок
+    и состояние FSM пользователя при воспроизведении сохраняются.
+    Знак сохраняется: у групповых чатов отрицательные ID.
+
+    :param user_id: ID пользователя или чата Telegram
+    :type user_id: int
+    :param salt: секретная соль
+    :type salt: bytes
+    :rtype: int
+    '''
+    digest = hmac.new(salt, str(abs(user_id)).encode(), hashlib.sha256).digest()
+    alias = int.from_bytes(digest[:6], 'big') + 1
+    return -alias if user_id < 0 else alias
+
+
+def _anonymize_user(user, salt):
+    '''
+    Обезличивает описание пользователя, чата или контакта.
+
+    :rtype: dict
+    '''
+    if isinstance(user, list):
+        return [_anonymize_user(item, salt) for item in user]
+    if not isinstance(user, dict):
+        return user
+    user = {field: item for field, item in user.items() if field not in PERSONAL_FIELDS}
+    for field in ('id', 'user_id'):
+        if isinstance(user.get(field), int):
+            user[field] = anonymous_id(user[field], salt)
+    if 'phone_number' in user:
+        user['phone_number'] = ''
+    return user
+
+
+def anonymize_update(update, salt):
+    '''
+    Заменяет ID пользователей и чатов в сыром апдейте псевдонимами
+    и убирает имена, username, названия чатов и телефоны.
+
+    Обезличиваются все места, где в апдейте бывает пользователь:
+    отправитель и чат, источник пересылки (forward_origin,
+    forward_from), бот inline-режима (via_bot), вошедшие и вышедшие
+    участники, присланный контакт. Подписи авторов и vCard удаляются.
+
+    Тексты сообщений и данные кнопок не меняются: без них
+    воспроизведение не пройдет по тем же обработчикам.
+
+    :param update: апдейт в виде JSON-словаря
+    :type update: dict
+    :param salt: секретная соль
+    :type salt: bytes
+    :returns: новый словарь
+    :rtype: dict
+    '''
+    if isinstance(update, list):
+        return [anonymize_update(item, salt) for item in update]
+    if not isinstance(update, dict):
+        return update
+    result = {}
+    for key, value in update.items():
+        if key in DROPPED_FIELDS:
+            continue
+        if key in NAME_FIELDS and isinstance(value, str):
+            value = 'user'
+        elif key in USER_KEYS:
+            value = _anonymize_user(value, salt)
+        result[key] = anonymize_update(value, salt)
+    return result
+
+
+class RecordingMiddleware(BaseMiddleware):
+    '''
+    Запись входящих апдейтов для офлайн-воспроизведения.
+
+    Обработчик только кладет апдейт в очередь. Обезличивание,
+    сериализация и сжатие идут в отдельном потоке: раз в flush_interval
+    секунд или по набору batch апдейтов пачка строк JSONL
+    {"ts": время, "update": апдейт} дописывается в файл отдельным
+    gzip-фрагментом. Файл только дописывается, склейка фрагментов -
+    обычный gzip-файл, а при аварийной остановке теряется только
+    последняя пачка. Каждая пачка пишется одним write в режиме
+    O_APPEND, поэтому воркеры шардированного режима могут писать
+    в один файл.
+
+    Регистрируется первым outer middleware на dp.update, чтобы
+    записывались и апдейты, отброшенные антифлудом.
+    '''
+
+    def __init__(self, path, salt, flush_interval=1.0, batch=1000):
+        '''
+        :param path: файл записи (.jsonl.gz)
+        :type path: str
+        :param salt: соль псевдонимов ID
+        :type salt: bytes
+        :param flush_interval: как часто дописывать файл, сек
+        :type flush_interval: float
+        :param batch: максимум апдейтов в одной пачке
+        :type batch: int
+        '''
+        self.path = path
+        self.salt = salt
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self.recorded = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='update-recorder', daemon=True)
+        self._thread.start()
+
+    async def __call__(self, handler, event, data):
+        self._queue.put((time.time(), event.model_dump(
+            mode='json', exclude_none=True, by_alias=True
+        )))
+        return await handler(event, data)
+
+    def _run(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            stopping = False
+            while not stopping:
+                items = []
+                deadline = time.monotonic() + self.flush_interval
+                while len(items) < self.batch:
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    items.append(item)
+                if items:
+                    self._write(fd, items)
+        finally:
+            os.close(fd)
+
+    def _write(self, fd, items):
+        lines = ''.join(
+            json.dumps({'ts': ts, 'update': anonymize_update(update, self.salt)},
+                       ensure_ascii=False, separators=(',', ':')) + '\n'
+            for ts, update in items
+        )
+        try:
+            os.write(fd, gzip.compress(lines.encode('utf-8')))
+            self.recorded += len(items)
+        except OSError:
+            logging.exception('Не удалось записать апдейты в %s', self.path)
+
+    def close(self):
+        '''
+        Дописывает накопленные апдейты и останавливает поток записи.
+
+        :returns: None
+        '''
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+def build_recorder():
+    '''
+    Создает middleware записи апдейтов, если запись включена в окружении.
+
+    Переменные окружения:
+        RECORD_UPDATES: файл записи, например updates.jsonl.gz (не задано - выключено)
+        RECORD_SALT: соль псевдонимов ID (не задано - случайная на запуск,
+            псевдонимы одного пользователя в разных запусках не совпадут)
+
+    :returns: middleware записи или None
+    :rtype: RecordingMiddleware or None
+    '''
+    path = os.getenv('RECORD_UPDATES')
+    if not path:
+        return None
+    salt = os.getenv('RECORD_SALT')
+    return RecordingMiddleware(
+        path, salt.encode() if salt else secrets.token_bytes(16)
+    )
+
+
+def read_updates(path):
+    '''
+    Читает запись апдейтов.
+
+    Оборванный последний фрагмент (процесс остановлен посреди записи)
+    пропускается с предупреждением.
+
+    :param path: файл записи
+    :type path: str
+    :returns: генератор пар (время записи, апдейт)
+    :rtype: iterator
+    '''
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                record = json.loads(line)
+                yield record['ts'], record['update']
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+            logging.warning('Запись %s оборвана: %s', path, e)
+
+
+def _percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))] * 1000
+
+
+class ReplayStats(BaseMiddleware):
+    '''
+    Статистика воспроизведения: задержки апдейтов и обработчиков
+    и число запросов к базе на обработчик.
+
+    Регистрируется inner middleware на наблюдателях событий, где
+    известен выбранный обработчик. Запросы считает trace, переданный
+    в Database(trace=...): он вызывается в потоке, выполняющем запрос,
+    и относит запрос к обработчику через contextvar. Запросы из рабочих
+    потоков (GroupCommitWriter) к обработчику не относятся.
+    '''
+
+    def __init__(self):
+        self.updates = []
+        self.errors = 0
+        self.queries = 0
+        self.handlers = {}
+        self.elapsed = 0.0
+
+    def attach(self, dp):
+        '''
+        Подключает сбор статистики к наблюдателям сообщений и кнопок.
+
+        :param dp: диспетчер
+        :type dp: aiogram.Dispatcher
+        :returns: None
+        '''
+        dp.message.middleware(self)
+        dp.callback_query.middleware(self)
+
+    def trace(self, statement):
+        '''
+        Обратный вызов sqlite3 set_trace_callback.
+
+        :param statement: текст запроса
+        :type statement: str
+        :returns: None
+        '''
+        self.queries += 1
+        counter = _handler_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        counter = [0]
+        token = _handler_queries.set(counter)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            latencies, queries = self.handlers.setdefault(name, ([], [0]))
+            latencies.append(time.perf_counter() - started)
+            queries[0] += counter[0]
+            _handler_queries.reset(token)
+
+    def report(self):
+        '''
+        Текст отчета: пропускная способность, перцентили задержек
+        и запросы к базе по обработчикам.
+
+        :rtype: str
+        '''
+        updates = sorted(self.updates)
+        if not updates:
+            return 'Нет апдейтов'
+        lines = [
+            f'updates={len(updates)}  errors={self.errors}  {self.elapsed:.2f} s  '
+            f'{len(updates) / max(self.elapsed, 1e-9):.0f} upd/s  '
+            f'p50={_percentile(updates, 50):.2f} ms  p95={_percentile(updates, 95):.2f} ms  '
+            f'p99={_percentile(updates, 99):.2f} ms  db_queries={self.queries}',
+            f'{"handler":32} {"calls":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+            f'{"queries/call":>12}',
+        ]
+        for name, (latencies, queries) in sorted(
+            self.handlers.items(), key=lambda item: -len(item[1][0])
+        ):
+            latencies.sort()
+            lines.append(
+                f'{name:32} {len(latencies):7d} {_percentile(latencies, 50):8.2f} '
+                f'{_percentile(latencies, 95):8.2f} {_percentile(latencies, 99):8.2f} '
+                f'{queries[0] / len(latencies):12.1f}'
+            )
+        return '\n'.join(lines)
+
+
+async def replay(dp, bot, path, speed=1.0, concurrency=100, stats=None):
+    '''
+    Воспроизводит запись апдейтов через диспетчер.
+
+    При speed > 0 апдейты подаются с исходными интервалами, ускоренными
+    в speed раз, при speed = 0 - без пауз, не более concurrency
+    одновременно. Апдейты одного пользователя упорядочивает
+    UserLockMiddleware, как и при polling. Без пауз антифлуд
+    (ThrottlingMiddleware) срабатывает чаще, чем в исходном трафике.
+
+    :param dp: диспетчер с обработчиками
+    :type dp: aiogram.Dispatcher
+    :param bot: бот, обычно с сессией-заглушкой StubSession
+    :type bot: aiogram.Bot
+    :param path: файл записи
+    :type path: str
+    :param speed: ускорение исходного темпа (0 - без пауз)
+    :type speed: float
+    :param concurrency: максимум одновременно обрабатываемых апдейтов
+    :type concurrency: int
+    :param stats: сборщик статистики, уже подключенный к dp
+    :type stats: ReplayStats, optional
+    :returns: статистика воспроизведения
+    :rtype: ReplayStats
+    '''
+    stats = stats or ReplayStats()
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+
+    async def feed(update):
+        started = time.perf_counter()
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            stats.errors += 1
+            logging.exception('Ошибка обработки апдейта %s', update.get('update_id'))
+        finally:
+            stats.updates.append(time.perf_counter() - started)
+            slots.release()
+
+    started = loop.time()
+    first = None
+    for ts, update in read_updates(path):
+        if speed:
+            first = ts if first is None else first
+            delay = (ts - first) / speed - (loop.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await slots.acquire()
+        task = asyncio.create_task(feed(update))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    if running:
+        await asyncio.gather(*running)
+    stats.elapsed = loop.time() - started
+    return stats
+
+
+def main():
+    '''
+    CLI воспроизведения записанного трафика.
+
+    python replay.py updates.jsonl.gz            # в исходном темпе
+    python replay.py updates.jsonl.gz --fast     # без пауз
+    python replay.py updates.jsonl.gz --speed 10 --db replay.db
+
+    Обработчики main.py работают с отдельной базой (по умолчанию -
+    временной) и сессией-заглушкой: сообщения никуда не отправляются,
+    планировщик напоминаний не запускается.
+    '''
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных апдейтов')
+    parser.add_argument('path', help='файл записи (.jsonl.gz)')
+    parser.add_argument('--speed', type=float, default=1.0, help='ускорение темпа записи')
+    parser.add_argument('--fast', action='store_true', help='без пауз между апдейтами')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--db', help='файл БД (по умолчанию - временный)')
+    args = parser.parse_args()
+
+    os.environ.setdefault('BOT_TOKEN', '42:REPLAY')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['DB_BACKEND'] = 'memory'
+    os.environ['RECORD_UPDATES'] = ''
+    import main as bot_main
+    from broadcast import Broadcaster
+    from database import Database
+    from fanout import ListNotifier
+    from scheduler import ReminderScheduler
+    from session import StubSession
+
+    stats = ReplayStats()
+    stats.attach(bot_main.dp)
+
+    async def run(db_name):
+        bot_main.bot.session = StubSession()
+        bot_main.db = Database(db_name, trace=stats.trace)
+        bot_main.db.create_table(None)
+        bot_main.writer = None
+        bot_main.scheduler = ReminderScheduler(bot_main.bot, bot_main.db)
+        bot_main.notifier = ListNotifier(bot_main.bot, bot_main.db)
+        bot_main.broadcaster = Broadcaster(bot_main.bot, bot_main.db)
+        await replay(bot_main.dp, bot_main.bot, args.path,
+                     0.0 if args.fast else args.speed, args.concurrency, stats)
+        await bot_main.notifier.close()
+        await bot_main.broadcaster.close()
+        bot_main.db.close()
+        print(stats.report())
+        calls = bot_main.bot.session.calls
+        print('Bot API: ' + ', '.join(f'{name}={count}' for name, count in sorted(calls.items())))
+
+    try:
+        if args.db:
+            asyncio.run(run(args.db))
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                asyncio.run(run(os.path.join(tmp, 'replay.db')))
+    finally:
+        bot_main.log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,37 @@
+import asyncio
+import logging
+import os
+import threading
+from zoneinfo import ZoneInfo
+
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from aiogram import Bot
-from database import Database
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from models import (
+    REMIND_1D, REMIND_1H, REMIND_1W, REMIND_3D, REMIND_3H, REMINDER_CODES
+)
+from storage import TaskStore
+from logconfig import correlation_id
+from session import LANE_BACKGROUND, outbound_lane
+
+REMINDER_LABELS = {
+    REMIND_1W: 'за неделю',
+    REMIND_3D: 'за 3 дня',
+    REMIND_1D: 'за день',
+    REMIND_3H: 'за 3 часа',
+    REMIND_1H: 'за час',
+}
+REMINDER_TEXTS = {
+    REMIND_1W: 'До дедлайна неделя.',
+    REMIND_3D: 'До дедлайна 3 дня.',
+    REMIND_1D: 'приближается к дедлайну! Завтра последний день.',
+    REMIND_3H: 'Сегодня последний день, осталось 3 часа.',
+    REMIND_1H: 'Сегодня последний день, остался час.',
+}
+SNOOZE_OPTIONS = ((60, '1 ч'), (180, '3 ч'), (24 * 60, '1 день'))
 
 
 class ReminderScheduler:
@@ -10,35 +39,303 @@ class ReminderScheduler:
     Класс для управления напоминаниями о задачах.
 
     Использует APScheduler для отправки уведомлений пользователям
-    о приближающихся дедлайнах задач.
+    о приближающихся дедлайнах задач. Также раз в сутки, в тихие
+    ночные часы, архивирует давно выполненные задачи и уплотняет базу.
+
+    Напоминания не планируются по одному на задачу: пользователи
+    группируются по смещению своего пояса от UTC, и для каждого
+    смещения есть одно ежедневное задание. В reminder_hour по местному
+    времени оно одним запросом по индексу дедлайнов выбирает задачи
+    этой группы со сроком на завтра.
+
+    У задачи может быть несколько напоминаний (маска Task.reminders):
+    за неделю, 3 дня и день - в reminder_hour, за 3 часа и за час - до
+    конца последнего дня. Поэтому задание группы срабатывает каждый час
+    и выбирает только смещения, чей час наступил (см. slots).
+
+    Отправленные напоминания отмечаются в базе пачками по MARK_BATCH
+    по мере отправки (при аварийном завершении повторно уйдет не больше
+    одной пачки группы): после перезапуска start() досылает пропущенные
+    за время простоя рассылки групп, не повторяя уже отправленные, а
+    stop() дожидается начатых рассылок.
+    Перед отправкой задача проверяется точечным запросом по ID: о
+    выполненной или удаленной задаче напоминание не приходит.
+
+    Кнопки под напоминанием откладывают его (snooze): отложенное
+    напоминание - одно задание snooze_<ID пользователя>_<ID задачи>,
+    повторное нажатие его переносит, а не добавляет второе.
+
+    Если передан менеджер резервных копий, раз в сутки в backup_hour
+    делается онлайн-снимок базы (см. backup.BackupManager).
     '''
 
-    def __init__(self, bot: Bot, db: Database):
+    MARK_BATCH = 20
+
+    def __init__(self, bot: Bot, db: TaskStore, backup=None):
         '''
         Инициализирует планировщик напоминаний.
 
         :param bot: объект бота для отправки сообщений
         :type bot: aiogram.Bot
         :param db: объект базы данных для работы с задачами
-        :type db: Database
+        :type db: TaskStore
+        :param backup: менеджер резервных копий
+        :type backup: backup.BackupManager, optional
         '''
         self.bot = bot
         self.db = db
+        self.backup = backup
         self.scheduler = AsyncIOScheduler()
+        self.archive_after_days = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+        self.compact_hour = int(os.getenv('COMPACT_HOUR', '4'))
+        self.backup_hour = int(os.getenv('BACKUP_HOUR', '3'))
+        self.reminder_hour = int(os.getenv('REMINDER_HOUR', '9'))
+        self.default_tz = os.getenv('DEFAULT_TZ', 'UTC')
+        self.default_offset = utc_offset_minutes(self.default_tz)
+        self.default_reminders = parse_reminders(os.getenv('REMINDER_OFFSETS', '1d'))
+        self.slots = (
+            (REMIND_1W, self.reminder_hour, 7),
+            (REMIND_3D, self.reminder_hour, 3),
+            (REMIND_1D, self.reminder_hour, 1),
+            (REMIND_3H, 21, 0),
+            (REMIND_1H, 23, 0),
+        )
+        self._fires = set()
+        self._maintenance = threading.Lock()
 
     async def start(self):
         '''
         Запускает планировщик напоминаний.
 
-        Должен быть вызван один раз при старте бота.
+        Должен быть вызван один раз при старте бота. Рассылки групп,
+        время которых сегодня уже прошло (бот был остановлен), запускаются
+        сразу.
 
         :returns: None
         '''
+        self.scheduler.add_job(
+            self._compact,
+            trigger=CronTrigger(hour=self.compact_hour),
+            id='compaction',
+            replace_existing=True
+        )
+        if self.backup is not None:
+            self.scheduler.add_job(
+                self._backup,
+                trigger=CronTrigger(hour=self.backup_hour),
+                id='backup',
+                replace_existing=True
+            )
+        self.scheduler.add_job(
+            self.sync_buckets,
+            trigger=CronTrigger(minute=0),
+            id='tz_sync',
+            replace_existing=True
+        )
+        offsets = self.sync_buckets()
         self.scheduler.start()
+        self.catch_up(offsets)
+
+    def catch_up(self, offsets, now=None):
+        '''
+        Запускает рассылки групп по смещениям, чей час сегодня уже наступил.
+
+        Уже отправленные напоминания база не вернет, поэтому повторный
+        запуск рассылки безопасен.
+
+        :param offsets: смещения групп в минутах
+        :type offsets: iterable
+        :param now: текущий момент (по умолчанию - сейчас)
+        :type now: datetime.datetime, optional
+        :returns: смещения групп, для которых запущена рассылка
+        :rtype: list
+        '''
+        now = now or datetime.now(timezone.utc)
+        started = []
+        for offset in sorted(offsets):
+            hour = (now + timedelta(minutes=offset)).hour
+            slots = [slot for slot in self.slots if slot[1] <= hour]
+            if slots:
+                self._fires.add(asyncio.ensure_future(self._fire_bucket(offset, now, slots)))
+                started.append(offset)
+        return started
+
+    async def stop(self, timeout=10.0):
+        '''
+        Останавливает планировщик, дождавшись начатых рассылок
+        и обслуживания базы.
+
+        Новые задания не запускаются. Рассылки, не успевшие за timeout,
+        отменяются: отправленные к этому моменту напоминания отмечаются
+        в базе, остальные будут отправлены после перезапуска.
+
+        :param timeout: сколько ждать завершения рассылок, сек
+        :type timeout: float
+        :returns: None
+        '''
+        if not self.scheduler.running:
+            return
+        self.scheduler.pause()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        fires = set(self._fires)
+        if fires:
+            _, pending = await asyncio.wait(fires, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if await asyncio.to_thread(
+            self._maintenance.acquire, timeout=max(0.0, deadline - loop.time())
+        ):
+            self._maintenance.release()
+        else:
+            logging.warning('Обслуживание базы не завершилось за %s с', timeout)
+        self.scheduler.shutdown(wait=False)
+
+    def sync_buckets(self, now=None):
+        '''
+        Пересчитывает смещения поясов и задания групп напоминаний.
+
+        Вызывается при старте и раз в час: смещение пояса меняется
+        при переходе на летнее время и обратно.
+
+        :param now: текущий момент (по умолчанию - сейчас)
+        :type now: datetime.datetime, optional
+        :returns: смещения групп в минутах
+        :rtype: set
+        '''
+        with self._maintenance:
+            return self._sync_buckets(now)
+
+    def _sync_buckets(self, now):
+        self.default_offset = utc_offset_minutes(self.default_tz, now)
+        current = {
+            tz: utc_offset_minutes(tz, now) for tz in self.db.get_timezones()
+        }
+        self.db.update_offsets(current)
+        offsets = set(current.values()) | {self.default_offset}
+        for job in self.scheduler.get_jobs():
+            if job.id.startswith('bucket_') and int(job.id[7:]) not in offsets:
+                job.remove()
+        for offset in offsets:
+            self.ensure_bucket(offset)
+        return offsets
+
+    def ensure_bucket(self, offset):
+        '''
+        Добавляет задание группы напоминаний для смещения, если его еще нет.
+
+        :param offset: смещение пояса от UTC в минутах
+        :type offset: int
+        :returns: None
+        '''
+        job_id = f'bucket_{offset}'
+        if self.scheduler.get_job(job_id) is not None:
+            return
+        self.scheduler.add_job(
+            self._fire_bucket,
+            trigger=CronTrigger(minute=-offset % 60, timezone=timezone.utc),
+            args=[offset],
+            id=job_id,
+            replace_existing=True,
+            coalesce=True,
+            misfire_grace_time=600
+        )
+
+    async def _fire_bucket(self, offset, now=None, slots=None):
+        '''
+        Рассылает напоминания группы по смещениям, чей час наступил.
+
+        Дата дедлайна для каждого смещения считается по местному
+        времени группы: для напоминания за день - завтра, за неделю -
+        через 7 дней, за 3 часа и за час - сегодня.
+
+        :param offset: смещение пояса группы от UTC в минутах
+        :type offset: int
+        :param now: текущий момент (по умолчанию - сейчас)
+        :type now: datetime.datetime, optional
+        :param slots: смещения напоминаний (по умолчанию - для текущего часа)
+        :type slots: list, optional
+        :returns: число разосланных напоминаний
+        :rtype: int
+        '''
+        current = asyncio.current_task()
+        self._fires.add(current)
+        try:
+            correlation_id.set(f'bucket_{offset}')
+            now = now or datetime.now(timezone.utc)
+            local = now + timedelta(minutes=offset)
+            if slots is None:
+                slots = [slot for slot in self.slots if slot[1] == local.hour]
+            total = 0
+            for kind, _, days in slots:
+                day = local.date() + timedelta(days=days)
+                tasks = await asyncio.to_thread(
+                    self.db.get_due_in_bucket, day, offset, self.default_offset, kind
+                )
+                sent = []
+
+                async def flush():
+                    done = sent[:]
+                    sent.clear()
+                    await asyncio.to_thread(self.db.mark_reminded, done, kind)
+
+                async def send(task):
+                    nonlocal total
+                    if await self._send_reminder(task.user_id, task.id, task.task_text, kind):
+                        sent.append(task)
+                        total += 1
+                        if len(sent) >= self.MARK_BATCH:
+                            await flush()
+
+                try:
+                    await asyncio.gather(*(send(task) for task in tasks))
+                finally:
+                    await asyncio.shield(flush())
+            if slots:
+                logging.info('Группа %s: отправлено напоминаний: %s', offset, total)
+            return total
+        finally:
+            self._fires.discard(current)
+
+    def _compact(self):
+        '''
+        Архивирует задачи, выполненные больше archive_after_days дней назад.
+
+        Синхронная функция: APScheduler выполняет ее в пуле потоков,
+        не блокируя цикл событий.
+
+        :returns: None
+        '''
+        try:
+            with self._maintenance:
+                moved = self.db.compact(self.archive_after_days)
+            logging.info('Архивировано задач: %s', moved)
+        except Exception:
+            logging.exception('Ошибка архивации')
+
+    def _backup(self):
+        '''
+        Делает снимок базы и удаляет устаревшие снимки.
+
+        Синхронная функция, как и _compact. Блокировку обслуживания
+        не берет: снимок читает базу через отдельное соединение и не
+        мешает ни записи, ни архивации, а многогигабайтная копия не
+        должна задерживать остановку бота.
+
+        :returns: None
+        '''
+        try:
+            self.backup.backup()
+        except Exception:
+            logging.exception('Ошибка резервного копирования')
 
     def add_reminder(self, user_id, task_id, task_text, reminder_time: datetime):
         '''
-        Добавляет напоминание о задаче в планировщик.
+        Добавляет отдельное напоминание о задаче в планировщик.
+
+        Используется для отладки (reminder_seconds), обычные напоминания
+        рассылают задания групп поясов.
 
         :param user_id: ID пользователя в Telegram
         :type user_id: int
@@ -54,14 +351,51 @@ class ReminderScheduler:
             self._send_reminder,
             trigger=DateTrigger(run_date=reminder_time),
             args=[user_id, task_id, task_text],
-            id=f'reminder_{user_id}_{task_id}'
+            id=f'reminder_{user_id}_{task_id}',
+            replace_existing=True
+        )
+
+    def snooze(self, user_id, task_id, task_text, minutes, now=None):
+        '''
+        Откладывает напоминание о задаче на minutes минут.
+
+        У задачи одно отложенное напоминание на пользователя: повторный
+        вызов переносит задание snooze_<ID пользователя>_<ID задачи>, а не
+        добавляет новое. Участники общего списка откладывают напоминание
+        о его задаче независимо друг от друга.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: int
+        :param task_id: ID задачи в базе данных
+        :type task_id: int
+        :param task_text: текст задачи для напоминания
+        :type task_text: str
+        :param minutes: на сколько отложить, мин
+        :type minutes: int
+        :param now: текущий момент (по умолчанию - сейчас)
+        :type now: datetime.datetime, optional
+        :returns: время отложенного напоминания
+        :rtype: datetime.datetime
+        '''
+        run_date = (now or datetime.now(timezone.utc)) + timedelta(minutes=minutes)
+        self.scheduler.add_job(
+            self._send_reminder,
+            trigger=DateTrigger(run_date=run_date),
+            args=[user_id, task_id, task_text, None],
+            id=f'snooze_{user_id}_{task_id}',
+            replace_existing=True,
+            misfire_grace_time=3600
         )
+        return run_date
 
-    async def _send_reminder(self, user_id, task_id, task_text):
+    async def _send_reminder(self, user_id, task_id, task_text, kind=REMIND_1D):
         '''
-        Отправляет напоминание пользователю.
+        Отправляет напоминание пользователю с кнопками "отложить".
 
         Внутренний метод, вызывается планировщиком автоматически.
+        Напоминание о выполненной или удаленной задаче не отправляется.
+        Отправка идет в фоновой полосе, чтобы не задерживать
+        ответы на действия пользователей.
 
         :param user_id: ID пользователя в Telegram
         :type user_id: int
@@ -69,14 +403,72 @@ class ReminderScheduler:
         :type task_id: int
         :param task_text: текст задачи для напоминания
         :type task_text: str
-        :returns: None
-        :raises Exception: при ошибках отправки сообщения
+        :param kind: смещение напоминания (REMIND_*), None - отложенное
+        :type kind: int or None
+        :returns: True, если напоминание отправлено
+        :rtype: bool
         '''
+        task = await asyncio.to_thread(self.db.get_task, user_id, task_id)
+        if task is None or task.done:
+            return False
+        note = REMINDER_TEXTS[kind] if kind else 'Отложенное напоминание.'
         try:
-            await self.bot.send_message(
-                user_id,
-                f"Напоминание: Задача '{task_text}' (ID: {task_id}) "
-                f"приближается к дедлайну! Завтра последний день."
-            )
+            with outbound_lane(LANE_BACKGROUND):
+                await self.bot.send_message(
+                    user_id,
+                    f"Напоминание: Задача '{task_text}' (ID: {task_id}) {note}",
+                    reply_markup=snooze_keyboard(task_id)
+                )
         except Exception as e:
-            print(f'Ошибка отправки напоминания: {e}')
\ No newline at end of file
+            logging.warning('Ошибка отправки напоминания user=%s task=%s: %s',
+                            user_id, task_id, e)
+            return False
+        return True
+
+
+def utc_offset_minutes(tz, now=None):
+    '''
+    Возвращает смещение пояса от UTC в минутах на заданный момент.
+
+    :param tz: имя пояса IANA
+    :type tz: str
+    :param now: момент времени (по умолчанию - сейчас)
+    :type now: datetime.datetime, optional
+    :rtype: int
+    :raises zoneinfo.ZoneInfoNotFoundError: если пояс неизвестен
+    '''
+    now = now or datetime.now(timezone.utc)
+    return int(now.astimezone(ZoneInfo(tz)).utcoffset().total_seconds() // 60)
+
+
+def parse_reminders(text):
+    '''
+    Разбирает список смещений напоминаний: "1w,1d,1h" -> маска REMIND_*.
+
+    :param text: коды смещений через запятую (1w, 3d, 1d, 3h, 1h)
+    :type text: str
+    :returns: маска смещений
+    :rtype: int
+    :raises ValueError: если код смещения неизвестен
+    '''
+    bits = {code: bit for bit, code in REMINDER_CODES.items()}
+    mask = 0
+    for code in filter(None, (part.strip() for part in text.split(','))):
+        if code not in bits:
+            raise ValueError(f'Неизвестное смещение напоминания: {code}')
+        mask |= bits[code]
+    return mask
+
+
+def snooze_keyboard(task_id):
+    '''
+    Кнопки "отложить" под напоминанием: snooze_<ID задачи>_<минуты>.
+
+    :param task_id: ID задачи
+    :type task_id: int
+    :rtype: aiogram.types.InlineKeyboardMarkup
+    '''
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=f"⏰ {label}", callback_data=f"snooze_{task_id}_{minutes}")
+        for minutes, label in SNOOZE_OPTIONS
+    ]])
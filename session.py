@@ -0,0 +1,419 @@
+import asyncio
+import bisect
+import contextvars
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, GetMe, SendMessage
+from aiogram.types import Chat, Message, User
+
+LANE_CALLBACK = 0
+LANE_INTERACTIVE = 1
+LANE_BACKGROUND = 2
+LANE_NAMES = ('callback', 'interactive', 'background')
+
+_current_lane = contextvars.ContextVar('bot_api_lane', default=None)
+
+
+@contextmanager
+def outbound_lane(lane):
+    '''
+    Назначает полосу приоритета всем запросам к Bot API внутри блока.
+
+    Пример: фоновые напоминания отправляются в LANE_BACKGROUND,
+    чтобы не отнимать пропускную способность у ответов пользователям.
+
+    :param lane: номер полосы (LANE_CALLBACK, LANE_INTERACTIVE, LANE_BACKGROUND)
+    :type lane: int
+    '''
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+class LatencyHistogram:
+    '''
+    Гистограмма задержек с фиксированными логарифмическими корзинами.
+
+    Хранит только счетчики корзин, поэтому занимает постоянную память
+    при любом числе наблюдений.
+    '''
+
+    BOUNDS = (
+        0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+        1.0, 2.0, 5.0, 10.0, 30.0, float('inf'),
+    )
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.count = 0
+
+    def observe(self, seconds):
+        '''
+        Учитывает одно наблюдение.
+
+        :param seconds: задержка, сек
+        :type seconds: float
+        :returns: None
+        '''
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        '''
+        Возвращает верхнюю границу корзины, в которую попадает перцентиль.
+
+        :param p: перцентиль от 0 до 100
+        :type p: float
+        :returns: задержка, сек (0 если наблюдений нет)
+        :rtype: float
+        '''
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for bound, n in zip(self.BOUNDS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.BOUNDS[-1]
+
+
+class PriorityLimiter:
+    '''
+    Ограничитель одновременных запросов с приоритетными очередями.
+
+    Свободный слот всегда отдается самой приоритетной ожидающей полосе.
+    Фоновая полоса дополнительно не может занять последние `reserved`
+    слотов, так что она использует только остаток емкости.
+    '''
+
+    def __init__(self, capacity, reserved=0, lanes=len(LANE_NAMES)):
+        '''
+        :param capacity: общее число слотов
+        :type capacity: int
+        :param reserved: слоты, недоступные фоновой полосе
+        :type reserved: int
+        :param lanes: число полос
+        :type lanes: int
+        '''
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity - 1)
+        self.busy = 0
+        self._waiters = [deque() for _ in range(lanes)]
+
+    def _limit(self, lane):
+        if lane >= LANE_BACKGROUND:
+            return self.capacity - self.reserved
+        return self.capacity
+
+    def pending(self, lane=None):
+        '''
+        Возвращает число ожидающих запросов в полосе или во всех полосах.
+
+        :rtype: int
+        '''
+        if lane is not None:
+            return len(self._waiters[lane])
+        return sum(len(queue) for queue in self._waiters)
+
+    async def acquire(self, lane):
+        '''
+        Занимает слот, дожидаясь своей очереди.
+
+        :param lane: номер полосы
+        :type lane: int
+        :returns: None
+        '''
+        ahead = any(self._waiters[i] for i in range(lane + 1))
+        if not ahead and self.busy < self._limit(lane):
+            self.busy += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но задача отменена до пробуждения:
+                # передаем его следующему ожидающему.
+                self.release()
+            else:
+                # release() мог успеть вынуть отмененный future из очереди.
+                try:
+                    self._waiters[lane].remove(future)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self):
+        '''
+        Освобождает слот и передает его следующему ожидающему.
+
+        :returns: None
+        '''
+        self.busy -= 1
+        for lane, queue in enumerate(self._waiters):
+            while queue and self.busy < self._limit(lane):
+                future = queue.popleft()
+                if future.done():
+                    continue
+                self.busy += 1
+                future.set_result(None)
+            if queue:
+                break
+
+
+class TunedSession(AiohttpSession):
+    '''
+    HTTP-сессия Bot API с настроенным пулом соединений.
+
+    Расширяет стандартную AiohttpSession:
+    - пул соединений фиксированного размера с keep-alive
+    - ограничение числа одновременных исходящих запросов с полосами
+      приоритета: ответы на callback, затем ответы пользователям,
+      затем фоновые рассылки
+    - склеивание одинаковых answerCallbackQuery/editMessageText
+      для одного сообщения в пределах короткого окна
+    '''
+
+    def __init__(self, limit=100, keepalive_timeout=30, timeout=30,
+                 max_concurrency=30, coalesce_window=0.5, reserved=5,
+                 **kwargs):
+        '''
+        Инициализирует сессию.
+
+        :param limit: размер пула TCP-соединений
+        :type limit: int
+        :param keepalive_timeout: время жизни простаивающего соединения, сек
+        :type keepalive_timeout: float
+        :param timeout: таймаут одного запроса, сек
+        :type timeout: float
+        :param max_concurrency: максимум одновременных запросов к Bot API
+        :type max_concurrency: int
+        :param coalesce_window: окно склеивания дублирующих запросов, сек
+        :type coalesce_window: float
+        :param reserved: слоты, которые фоновая полоса не может занять
+        :type reserved: int
+        '''
+        super().__init__(limit=limit, timeout=timeout, **kwargs)
+        self._connector_init['limit_per_host'] = limit
+        self._connector_init['keepalive_timeout'] = keepalive_timeout
+        self.max_concurrency = max_concurrency
+        self.coalesce_window = coalesce_window
+        self._limiter = PriorityLimiter(max_concurrency, reserved)
+        self._recent = OrderedDict()
+        self.histograms = [LatencyHistogram() for _ in LANE_NAMES]
+
+    @staticmethod
+    def _coalesce_key(method):
+        '''
+        Вычисляет ключ склеивания для запроса.
+
+        Повторный ответ на тот же callback всегда дублирует первый,
+        а правка сообщения считается дублем только при совпадении
+        всего содержимого.
+
+        :param method: метод Bot API
+        :type method: aiogram.methods.TelegramMethod
+        :returns: ключ склеивания или None, если запрос не склеивается
+        :rtype: tuple or None
+        '''
+        if isinstance(method, AnswerCallbackQuery):
+            return ('answerCallbackQuery', method.callback_query_id)
+        if isinstance(method, EditMessageText):
+            return (
+                'editMessageText',
+                method.chat_id,
+                method.message_id,
+                method.inline_message_id,
+                repr(method.model_dump(exclude_none=True, warnings=False)),
+            )
+        return None
+
+    def _prune(self, now):
+        '''
+        Удаляет завершенные запросы, окно склеивания которых истекло.
+
+        Записи упорядочены по времени создания, поэтому достаточно
+        снимать их с начала словаря.
+
+        :param now: текущее время цикла событий
+        :type now: float
+        :returns: None
+        '''
+        while self._recent:
+            task, created = next(iter(self._recent.values()))
+            if not task.done() or created + self.coalesce_window > now:
+                break
+            self._recent.popitem(last=False)
+
+    @staticmethod
+    def _lane_for(method):
+        '''
+        Определяет полосу приоритета запроса.
+
+        Явно заданная через outbound_lane полоса имеет приоритет,
+        иначе ответы на callback идут первыми, остальное - интерактивно.
+
+        :rtype: int
+        '''
+        lane = _current_lane.get()
+        if lane is not None:
+            return lane
+        if isinstance(method, AnswerCallbackQuery):
+            return LANE_CALLBACK
+        return LANE_INTERACTIVE
+
+    async def _limited_request(self, bot, method, timeout=None):
+        '''
+        Выполняет запрос, соблюдая лимит и приоритет полосы.
+
+        Задержка вместе с ожиданием в очереди попадает в гистограмму полосы.
+
+        :returns: результат метода Bot API
+        '''
+        lane = self._lane_for(method)
+        started = time.perf_counter()
+        await self._limiter.acquire(lane)
+        try:
+            return await super().make_request(bot, method, timeout)
+        finally:
+            self._limiter.release()
+            self.histograms[lane].observe(time.perf_counter() - started)
+
+    def latency_report(self):
+        '''
+        Сводка задержек по полосам.
+
+        :returns: {полоса: (число запросов, p50, p95, p99)}
+        :rtype: dict
+        '''
+        return {
+            name: (hist.count, hist.percentile(50), hist.percentile(95),
+                   hist.percentile(99))
+            for name, hist in zip(LANE_NAMES, self.histograms)
+        }
+
+    async def make_request(self, bot, method, timeout=None):
+        '''
+        Выполняет запрос к Bot API.
+
+        Дублирующие запросы в пределах окна получают результат
+        первого запроса вместо повторного обращения к серверу.
+
+        :param bot: объект бота
+        :type bot: aiogram.Bot
+        :param method: метод Bot API
+        :type method: aiogram.methods.TelegramMethod
+        :param timeout: таймаут запроса, сек
+        :type timeout: float, optional
+        :returns: результат метода Bot API
+        :raises aiogram.exceptions.TelegramAPIError: при ошибке Bot API
+        '''
+        key = self._coalesce_key(method) if self.coalesce_window > 0 else None
+        if key is None:
+            return await self._limited_request(bot, method, timeout)
+
+        now = asyncio.get_running_loop().time()
+        self._prune(now)
+        entry = self._recent.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(
+                self._limited_request(bot, method, timeout)
+            )
+            task.add_done_callback(lambda t: self._forget_failed(key, t))
+            self._recent[key] = (task, now)
+        else:
+            task = entry[0]
+        return await asyncio.shield(task)
+
+    def _forget_failed(self, key, task):
+        '''
+        Не дает закешировать неудачный запрос: следующий дубль
+        будет отправлен заново.
+
+        :returns: None
+        '''
+        if task.cancelled() or task.exception() is not None:
+            entry = self._recent.get(key)
+            if entry is not None and entry[0] is task:
+                del self._recent[key]
+
+
+class StubSession(BaseSession):
+    '''
+    Сессия-заглушка для бенчмарков и офлайн-прогонов.
+
+    Не обращается к сети и возвращает правдоподобные результаты,
+    считая вызовы по методам Bot API.
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        '''
+        Имитирует запрос к Bot API.
+
+        :returns: результат, совместимый с типом ответа метода
+        '''
+        name = method.__api_method__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(
+                message_id=getattr(method, 'message_id', None) or 1,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id or 0, type='private'),
+                text=method.text,
+            )
+        if isinstance(method, GetMe):
+            return User(id=42, is_bot=True, first_name='stub')
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30,
+                             chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+def build_session():
+    '''
+    Создает сессию Bot API с параметрами из переменных окружения.
+
+    Переменные окружения:
+        BOT_API_SERVER: базовый URL сервера Bot API (для локального сервера)
+        BOT_API_POOL_SIZE: размер пула соединений (100)
+        BOT_API_KEEPALIVE: keep-alive простаивающих соединений, сек (30)
+        BOT_API_TIMEOUT: таймаут запроса, сек (30)
+        BOT_API_CONCURRENCY: максимум одновременных запросов (30)
+        BOT_API_RESERVED: слоты, недоступные фоновым рассылкам (5)
+        BOT_API_COALESCE_MS: окно склеивания дублей, мс (500, 0 - выключено)
+
+    :returns: настроенная сессия
+    :rtype: TunedSession
+    '''
+    kwargs = {}
+    server = os.getenv('BOT_API_SERVER')
+    if server:
+        kwargs['api'] = TelegramAPIServer.from_base(server)
+    return TunedSession(
+        limit=int(os.getenv('BOT_API_POOL_SIZE', '100')),
+        keepalive_timeout=float(os.getenv('BOT_API_KEEPALIVE', '30')),
+        timeout=float(os.getenv('BOT_API_TIMEOUT', '30')),
+        max_concurrency=int(os.getenv('BOT_API_CONCURRENCY', '30')),
+        coalesce_window=int(os.getenv('BOT_API_COALESCE_MS', '500')) / 1000,
+        reserved=int(os.getenv('BOT_API_RESERVED', '5')),
+        **kwargs
+    )
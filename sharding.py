@@ -0,0 +1,488 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import sqlite3
+import zlib
+from urllib.parse import quote
+
+from database import Database
+
+SHARDED_TABLES = (
+    'tasks', 'tasks_archive', 'users', 'sent_reminders', 'lists', 'list_members'
+)
+ID_RANGE_TABLES = (('tasks', 'id'), ('lists', 'id'))
+ID_RANGE_BITS = 40
+
+
+def shard_for(user_id, shards):
+    '''
+    Возвращает номер шарда для пользователя.
+
+    Хеш стабилен между запусками и процессами, в отличие от hash().
+
+    :param user_id: ID пользователя Telegram
+    :type user_id: int
+    :param shards: число шардов
+    :type shards: int
+    :rtype: int
+    '''
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def shard_db_name(db_name, index):
+    '''
+    Возвращает имя файла БД шарда: todo_bot.db -> todo_bot.shard0.db.
+
+    :rtype: str
+    '''
+    root, ext = os.path.splitext(db_name)
+    return f'{root}.shard{index}{ext}'
+
+
+def update_user_id(update):
+    '''
+    Достает ID пользователя из сырого апдейта Bot API.
+
+    :param update: апдейт в виде словаря
+    :type update: dict
+    :returns: ID пользователя или чата, 0 если определить нельзя
+    :rtype: int
+    '''
+    for key, event in update.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user') or event.get('chat')
+        if user:
+            return user['id']
+    return 0
+
+
+def invite_shard(db_name, shards, invite_code):
+    '''
+    Ищет шард, на котором создан общий список с кодом приглашения.
+
+    Базы шардов открываются только для чтения.
+
+    :param db_name: базовое имя файла БД
+    :type db_name: str
+    :param shards: число шардов
+    :type shards: int
+    :param invite_code: код приглашения
+    :type invite_code: str
+    :returns: номер шарда или None, если код не найден
+    :rtype: int or None
+    '''
+    for index in range(shards):
+        path = os.path.abspath(shard_db_name(db_name, index))
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True)
+        try:
+            found = conn.execute(
+                'SELECT 1 FROM lists WHERE invite_code = ?', (invite_code,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if found:
+            return index
+    return None
+
+
+def prepare_shard(db_name, index):
+    '''
+    Создает схему шарда и резервирует ему диапазон ID задач.
+
+    Диапазоны шардов не пересекаются, поэтому при перебалансировке
+    задачи переносятся со своими ID и старые кнопки продолжают работать.
+
+    :param db_name: имя файла БД шарда
+    :type db_name: str
+    :param index: номер шарда
+    :type index: int
+    :returns: объект базы данных шарда
+    :rtype: Database
+    '''
+    db = Database(db_name)
+    db.create_table(None)
+    conn = sqlite3.connect(db_name)
+    with conn:
+        reserve_id_range(conn, index)
+    conn.close()
+    return db
+
+
+def reserve_id_range(conn, index, schema='main', seqs=None):
+    '''
+    Выставляет счетчики AUTOINCREMENT шарда в его диапазон ID.
+
+    Счетчик становится наибольшим из начала диапазона, наибольшего ID
+    внутри диапазона и прежнего значения seqs (если оно в диапазоне).
+    Строки с ID из чужих диапазонов, перенесенные перебалансировкой,
+    на счетчик не влияют, хотя SQLite при их вставке поднимает его.
+
+    :param conn: соединение с БД шарда
+    :type conn: sqlite3.Connection
+    :param index: номер шарда
+    :type index: int
+    :param schema: схема БД шарда в соединении (main или имя ATTACH)
+    :type schema: str
+    :param seqs: счетчики до вставки чужих строк {таблица: seq}
+    :type seqs: dict, optional
+    :returns: None
+    '''
+    floor = index << ID_RANGE_BITS
+    ceiling = floor + (1 << ID_RANGE_BITS)
+    seqs = seqs if seqs is not None else dict(
+        conn.execute(f'SELECT name, seq FROM {schema}.sqlite_sequence')
+    )
+    for table, column in ID_RANGE_TABLES:
+        seq = conn.execute(
+            f'SELECT coalesce(max({column}), 0) FROM {schema}.{table} '
+            f'WHERE {column} >= ? AND {column} < ?', (floor, ceiling)
+        ).fetchone()[0]
+        old = seqs.get(table, 0)
+        seq = max(seq, floor, old if floor <= old < ceiling else 0)
+        updated = conn.execute(
+            f'UPDATE {schema}.sqlite_sequence SET seq = ? WHERE name = ?', (seq, table)
+        ).rowcount
+        if not updated and seq:
+            conn.execute(
+                f'INSERT INTO {schema}.sqlite_sequence (name, seq) VALUES (?, ?)',
+                (table, seq)
+            )
+
+
+def worker_main(index, inbox, db_name, done=None, stub=False, ready=None, shards=1):
+    '''
+    Точка входа процесса-воркера шарда.
+
+    Воркер владеет своим файлом БД и своим ReminderScheduler,
+    а обработчики main.py работают с ними через глобальные db и scheduler;
+    уведомления списков и рассылки тоже пересоздаются поверх базы шарда.
+
+    :param index: номер шарда
+    :type index: int
+    :param inbox: очередь сырых апдейтов (JSON-строки, None - остановка)
+    :type inbox: multiprocessing.Queue
+    :param db_name: базовое имя файла БД
+    :type db_name: str
+    :param done: очередь для отчета о числе обработанных апдейтов
+    :type done: multiprocessing.Queue, optional
+    :param stub: использовать сессию-заглушку вместо Bot API
+    :type stub: bool
+    :param ready: семафор, отпускаемый после инициализации воркера
+    :type ready: multiprocessing.Semaphore, optional
+    :param shards: число шардов
+    :type shards: int
+    :returns: None
+    '''
+    import main as bot_main
+    from broadcast import Broadcaster
+    from fanout import ListNotifier
+    from scheduler import ReminderScheduler
+    from session import StubSession
+    from writer import build_writer
+
+    if stub:
+        bot_main.bot.session = StubSession()
+    bot_main.db = prepare_shard(shard_db_name(db_name, index), index)
+    bot_main.writer = build_writer(bot_main.db)
+    bot_main.scheduler = ReminderScheduler(bot_main.bot, bot_main.db)
+    bot_main.notifier = ListNotifier(bot_main.bot, bot_main.db)
+    bot_main.broadcaster = Broadcaster(bot_main.bot, bot_main.db)
+    bot_main.shard_info = (db_name, shards, index)
+    if ready is not None:
+        ready.release()
+    processed = asyncio.run(_worker_loop(bot_main, inbox))
+    if done is not None:
+        done.put((index, processed))
+
+
+async def _worker_loop(bot_main, inbox):
+    '''
+    Читает апдейты из очереди и обрабатывает их.
+
+    Апдейты разных пользователей обрабатываются параллельно, а порядок
+    апдейтов одного пользователя сохраняет UserLockMiddleware диспетчера.
+
+    :returns: число обработанных апдейтов
+    :rtype: int
+    '''
+    await bot_main.scheduler.start()
+    if bot_main.writer is not None:
+        bot_main.writer.start()
+    await bot_main.broadcaster.resume()
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    processed = 0
+    stopping = False
+    while not stopping:
+        batch = [await loop.run_in_executor(None, inbox.get)]
+        try:
+            while len(batch) < 1000:
+                batch.append(inbox.get_nowait())
+        except queue.Empty:
+            pass
+        for raw in batch:
+            if raw is None:
+                stopping = True
+                break
+            task = asyncio.ensure_future(
+                bot_main.dp.feed_raw_update(bot_main.bot, json.loads(raw))
+            )
+            running.add(task)
+            task.add_done_callback(running.discard)
+            processed += 1
+        await asyncio.sleep(0)
+    if running:
+        await asyncio.gather(*running, return_exceptions=True)
+    await bot_main.broadcaster.close()
+    await bot_main.notifier.close()
+    await bot_main.scheduler.stop()
+    if bot_main.writer is not None:
+        await bot_main.writer.close()
+    await bot_main.bot.session.close()
+    return processed
+
+
+class ShardRouter:
+    '''
+    Фронтовой маршрутизатор апдейтов по N процессам-воркерам.
+
+    Апдейт попадает в очередь шарда по хешу user_id. У каждого шарда
+    одна очередь и один производитель, поэтому порядок апдейтов
+    одного пользователя сохраняется.
+    '''
+
+    def __init__(self, shards, db_name='todo_bot.db', stub=False):
+        '''
+        :param shards: число воркеров
+        :type shards: int
+        :param db_name: базовое имя файла БД
+        :type db_name: str
+        :param stub: запускать воркеры с сессией-заглушкой
+        :type stub: bool
+        '''
+        self.shards = shards
+        self.db_name = db_name
+        self.stub = stub
+        self._ctx = multiprocessing.get_context('spawn')
+        self.inboxes = [self._ctx.Queue() for _ in range(shards)]
+        self.done = self._ctx.Queue()
+        self.ready = self._ctx.Semaphore(0)
+        self.processes = []
+
+    def start(self, wait=True):
+        '''
+        Запускает процессы-воркеры.
+
+        :param wait: дождаться инициализации всех воркеров
+        :type wait: bool
+        :returns: None
+        '''
+        for index, inbox in enumerate(self.inboxes):
+            process = self._ctx.Process(
+                target=worker_main,
+                args=(index, inbox, self.db_name, self.done, self.stub,
+                      self.ready, self.shards),
+                name=f'shard-{index}',
+            )
+            process.start()
+            self.processes.append(process)
+        if wait:
+            for _ in self.processes:
+                self.ready.acquire()
+
+    def route(self, update):
+        '''
+        Отправляет сырой апдейт воркеру его шарда.
+
+        :param update: апдейт в виде словаря
+        :type update: dict
+        :returns: номер шарда
+        :rtype: int
+        '''
+        index = shard_for(update_user_id(update), self.shards)
+        self.inboxes[index].put(json.dumps(update, ensure_ascii=False))
+        return index
+
+    def stop(self):
+        '''
+        Останавливает воркеры, дождавшись обработки очередей.
+
+        :returns: {номер шарда: число обработанных апдейтов}
+        :rtype: dict
+        '''
+        for inbox in self.inboxes:
+            inbox.put(None)
+        stats = dict(self.done.get() for _ in self.processes)
+        for process in self.processes:
+            process.join()
+        return stats
+
+
+async def run_polling(router, bot):
+    '''
+    Получает апдейты long polling'ом и раздает их по шардам.
+
+    :returns: None
+    '''
+    offset = None
+    while True:
+        updates = await bot.get_updates(offset=offset, timeout=30)
+        for update in updates:
+            router.route(update.model_dump(
+                mode='json', by_alias=True, exclude_none=True
+            ))
+            offset = update.update_id + 1
+
+
+async def run_webhook(router, bot, url, host, port):
+    '''
+    Принимает апдейты через webhook и раздает их по шардам.
+
+    :returns: None
+    '''
+    from aiohttp import web
+
+    async def handle(request):
+        router.route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post('/webhook', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    await bot.set_webhook(url)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def rebalance(db_name, old_shards, new_shards):
+    '''
+    Переносит данные пользователей между шардами при смене их числа.
+
+    Бот на время перебалансировки должен быть остановлен. Строки
+    переносятся со своими ID, каждая пара шардов - одной транзакцией;
+    счетчики ID шарда-получателя возвращаются в его диапазон.
+
+    Общие списки переносятся на шард владельца, членство и задачи -
+    на шарды своих пользователей: общий список работает только
+    для участников, попавших на один шард с владельцем.
+
+    Журнал task_events не переносится: у каждого шарда свой журнал
+    со своей нумерацией seq, на которую опираются changes_since и
+    отмена. События перенесенных пользователей удаляются с исходного
+    шарда, и отменить действие, сделанное до перебалансировки, нельзя.
+
+    :param db_name: базовое имя файла БД
+    :type db_name: str
+    :param old_shards: текущее число шардов
+    :type old_shards: int
+    :param new_shards: новое число шардов
+    :type new_shards: int
+    :returns: число перенесенных строк по таблицам
+    :rtype: dict
+    '''
+    for index in range(max(old_shards, new_shards)):
+        path = shard_db_name(db_name, index)
+        if index < new_shards or os.path.exists(path):
+            prepare_shard(path, index).close()
+    moved = dict.fromkeys(SHARDED_TABLES, 0)
+    for src in range(old_shards):
+        path = shard_db_name(db_name, src)
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        conn.create_function(
+            'shard_of', 1, lambda uid: shard_for(uid, new_shards),
+            deterministic=True
+        )
+        for dst in range(new_shards):
+            if dst == src:
+                continue
+            conn.execute('ATTACH DATABASE ? AS dst', (shard_db_name(db_name, dst),))
+            with conn:
+                seqs = dict(conn.execute('SELECT name, seq FROM dst.sqlite_sequence'))
+                for table in SHARDED_TABLES:
+                    columns = ', '.join(
+                        row[1] for row in
+                        conn.execute(f'PRAGMA main.table_info({table})')
+                    )
+                    conn.execute(
+                        f'INSERT INTO dst.{table} ({columns}) '
+                        f'SELECT {columns} FROM main.{table} '
+                        f'WHERE shard_of(user_id) = ?', (dst,)
+                    )
+                    moved[table] += conn.execute(
+                        f'DELETE FROM main.{table} WHERE shard_of(user_id) = ?',
+                        (dst,)
+                    ).rowcount
+                conn.execute(
+                    'DELETE FROM main.task_events WHERE shard_of(user_id) = ?', (dst,)
+                )
+                reserve_id_range(conn, dst, 'dst', seqs)
+            conn.execute('DETACH DATABASE dst')
+        conn.close()
+    return moved
+
+
+def main():
+    '''
+    CLI шардированного режима.
+
+    python sharding.py run --shards 4 [--webhook-url URL]
+    python sharding.py rebalance --from 4 --to 8
+    '''
+    parser = argparse.ArgumentParser(description='Шардированный запуск бота')
+    parser.add_argument('--db', default='todo_bot.db', help='базовое имя файла БД')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='запустить фронт и воркеры')
+    run.add_argument('--shards', type=int, default=os.cpu_count())
+    run.add_argument('--webhook-url')
+    run.add_argument('--host', default='0.0.0.0')
+    run.add_argument('--port', type=int, default=8080)
+    move = commands.add_parser('rebalance', help='перераспределить данные')
+    move.add_argument('--from', dest='old', type=int, required=True)
+    move.add_argument('--to', dest='new', type=int, required=True)
+    args = parser.parse_args()
+
+    if args.command == 'rebalance':
+        moved = rebalance(args.db, args.old, args.new)
+        for table, count in moved.items():
+            print(f'{table}: перенесено {count} строк')
+        return
+
+    from aiogram import Bot
+    from dotenv import load_dotenv
+    from logconfig import setup_logging
+    from session import build_session
+
+    load_dotenv()
+    setup_logging()
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        raise ValueError('TOKEN не найден в .env')
+    router = ShardRouter(args.shards, args.db)
+    router.start()
+    bot = Bot(token=token, session=build_session())
+    try:
+        if args.webhook_url:
+            asyncio.run(run_webhook(router, bot, args.webhook_url, args.host, args.port))
+        else:
+            asyncio.run(run_polling(router, bot))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.stop()
+
+
+if __name__ == '__main__':
+    main()
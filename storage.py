@@ -0,0 +1,952 @@
+import bisect
+import os
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import date
+
+from models import (
+    DEFAULT_REMINDERS, DELIVERY_BLOCKED, DELIVERY_FAILED, DELIVERY_PENDING, DELIVERY_SENT,
+    REMIND_1D, Broadcast, Task, TaskEvent, TaskList, TaskRef
+)
+from recurrence import next_due
+
+
+class TaskStore(ABC):
+    '''
+    Интерфейс хранилища задач.
+
+    От него зависят обработчики main.py и ReminderScheduler.
+    Реализации: Database (SQLite) и MemoryTaskStore (в памяти,
+    для тестов и бенчмарков). Обе проверяются одним набором тестов
+    StoreConformance в test_main.py.
+
+    Задачи возвращаются как Task, напоминания - как TaskRef,
+    общие списки - как TaskList, дедлайны - как datetime.date.
+    Задачи общего списка доступны всем его участникам.
+    '''
+
+    @abstractmethod
+    def close(self):
+        '''Освобождает ресурсы хранилища.'''
+
+    @abstractmethod
+    def create_table(self, user_id):
+        '''Готовит хранилище к работе (схема, миграции).'''
+
+    @abstractmethod
+    def add_task(self, user_id, task_text, category=None, deadline=None,
+                 recurrence=None, parent_id=None, list_id=None,
+                 reminders=DEFAULT_REMINDERS):
+        '''
+        Добавляет задачу (с parent_id - подзадачу, с list_id - задачу
+        общего списка; подзадача наследует список родителя).
+        reminders - маска смещений напоминаний из констант REMIND_*.
+
+        :returns: ID задачи или None, если родительская задача не найдена
+            или пользователь не участник списка
+        :rtype: int or None
+        '''
+
+    @abstractmethod
+    def get_task(self, user_id, task_id):
+        '''
+        Задача пользователя или его общего списка по ID, иначе None.
+
+        :rtype: Task or None
+        '''
+
+    @abstractmethod
+    def get_subtasks(self, user_id, parent_id=None, list_id=None):
+        '''
+        Подзадачи одного уровня в порядке ID; без parent_id - задачи
+        верхнего уровня личного или общего (list_id) списка, включая
+        подзадачи, чей родитель ушел в архив.
+
+        :rtype: list of Task
+        '''
+
+    @abstractmethod
+    def get_progress(self, user_id, task_ids):
+        '''
+        Прогресс поддеревьев: {ID задачи: (выполнено, всего подзадач)}
+        для задач, у которых есть подзадачи.
+
+        :rtype: dict
+        '''
+
+    @abstractmethod
+    def get_subtask_stats(self, user_id):
+        '''
+        Пара (всего подзадач, выполнено).
+
+        :rtype: tuple
+        '''
+
+    @abstractmethod
+    def get_tasks(self, user_id):
+        '''
+        Задачи пользователя в порядке ID.
+
+        :rtype: list of Task
+        '''
+
+    @abstractmethod
+    def get_due(self, user_id, start, end):
+        '''
+        Невыполненные задачи пользователя с дедлайном в [start, end]
+        (start=None - без нижней границы), по дедлайну и ID.
+
+        :rtype: list of Task
+        '''
+
+    @abstractmethod
+    def get_stats(self, user_id):
+        '''
+        Пара (всего задач, выполнено) с учетом архива.
+
+        :rtype: tuple
+        '''
+
+    @abstractmethod
+    def get_due_in_bucket(self, day, utc_offset, default_offset, kind=REMIND_1D):
+        '''
+        Невыполненные задачи с дедлайном day у пользователей со смещением
+        utc_offset, с включенным напоминанием kind, о которых с этим
+        смещением еще не напоминали.
+
+        :rtype: list of TaskRef
+        '''
+
+    @abstractmethod
+    def mark_reminded(self, tasks, kind=REMIND_1D):
+        '''Запоминает отправленные напоминания со смещением kind.'''
+
+    @abstractmethod
+    def set_reminders(self, user_id, task_id, reminders):
+        '''
+        Задает маску смещений напоминаний задачи.
+
+        :returns: True, если задача найдена
+        :rtype: bool
+        '''
+
+    @abstractmethod
+    def toggle_reminder(self, user_id, task_id, kind):
+        '''
+        Атомарно переключает одно смещение напоминаний задачи.
+
+        :returns: новая маска или None, если задача не найдена
+        :rtype: int or None
+        '''
+
+    @abstractmethod
+    def set_user_tz(self, user_id, tz, utc_offset):
+        '''Сохраняет часовой пояс пользователя.'''
+
+    @abstractmethod
+    def get_user_tz(self, user_id):
+        '''
+        Пояс пользователя или None.
+
+        :rtype: str or None
+        '''
+
+    @abstractmethod
+    def get_timezones(self):
+        '''
+        Словарь {имя пояса: смещение от UTC в минутах}.
+
+        :rtype: dict
+        '''
+
+    @abstractmethod
+    def update_offsets(self, offsets):
+        '''
+        Обновляет смещения поясов.
+
+        :returns: число обновленных пользователей
+        :rtype: int
+        '''
+
+    @abstractmethod
+    def register_user(self, user_id):
+        '''
+        Добавляет пользователя в реестр и снимает отметку о блокировке.
+
+        :returns: новый ли пользователь
+        :rtype: bool
+        '''
+
+    @abstractmethod
+    def create_broadcast(self, admin_id, text):
+        '''
+        Создает рассылку всем пользователям, не заблокировавшим бота.
+
+        :rtype: Broadcast
+        '''
+
+    @abstractmethod
+    def get_broadcast(self, broadcast_id):
+        '''
+        Рассылка со сводкой доставки или None.
+
+        :rtype: Broadcast or None
+        '''
+
+    @abstractmethod
+    def get_unfinished_broadcasts(self):
+        '''
+        Незавершенные рассылки в порядке создания.
+
+        :rtype: list of Broadcast
+        '''
+
+    @abstractmethod
+    def get_pending_recipients(self, broadcast_id, after=0, limit=100):
+        '''
+        Следующие limit получателей с ID больше after, которым
+        рассылка еще не ушла.
+
+        :rtype: list of int
+        '''
+
+    @abstractmethod
+    def record_deliveries(self, broadcast_id, results):
+        '''
+        Сохраняет пары (ID пользователя, статус DELIVERY_*); заблокировавшие
+        бота помечаются в реестре.
+        '''
+
+    @abstractmethod
+    def finish_broadcast(self, broadcast_id):
+        '''
+        Отмечает рассылку завершенной.
+
+        :rtype: Broadcast
+        '''
+
+    @abstractmethod
+    def save_pending_updates(self, updates):
+        '''
+        Сохраняет пары (update_id, апдейт в JSON), не обработанные
+        к остановке бота.
+        '''
+
+    @abstractmethod
+    def pop_pending_updates(self):
+        '''
+        Забирает сохраненные апдейты в порядке update_id.
+
+        :rtype: list of str
+        '''
+
+    @abstractmethod
+    def create_list(self, user_id, title):
+        '''
+        Создает общий список; создатель становится участником.
+
+        :rtype: TaskList
+        '''
+
+    @abstractmethod
+    def join_list(self, user_id, invite_code):
+        '''
+        Вступает в общий список по коду приглашения.
+
+        :returns: (список, вступил ли только что) или (None, False)
+        :rtype: tuple
+        '''
+
+    @abstractmethod
+    def leave_list(self, user_id, list_id):
+        '''
+        Выходит из общего списка; список без участников удаляется.
+
+        :rtype: bool
+        '''
+
+    @abstractmethod
+    def get_list(self, user_id, list_id):
+        '''
+        Общий список, если пользователь его участник, иначе None.
+
+        :rtype: TaskList or None
+        '''
+
+    @abstractmethod
+    def get_lists(self, user_id):
+        '''
+        Общие списки пользователя в порядке создания.
+
+        :rtype: list of TaskList
+        '''
+
+    @abstractmethod
+    def get_list_members(self, list_id):
+        '''
+        ID участников общего списка.
+
+        :rtype: list of int
+        '''
+
+    @abstractmethod
+    def get_archived_tasks(self, user_id, limit=10, offset=0):
+        '''
+        Страница архивных задач, новые первыми.
+
+        :rtype: list of Task
+        '''
+
+    @abstractmethod
+    def mark_done(self, user_id, task_id):
+        '''
+        Отмечает задачу выполненной.
+
+        :rtype: bool
+        '''
+
+    @abstractmethod
+    def complete_task(self, user_id, task_id, today=None):
+        '''
+        Отмечает задачу выполненной и создает следующее повторение.
+
+        :returns: (найдена ли задача, новое повторение или None)
+        :rtype: tuple
+        '''
+
+    @abstractmethod
+    def delete_task(self, user_id, task_id):
+        '''
+        Удаляет задачу вместе с подзадачами.
+
+        :rtype: bool
+        '''
+
+    @abstractmethod
+    def clear_all_tasks(self, user_id):
+        '''
+        Удаляет все задачи личного списка пользователя, включая архивные.
+
+        :returns: число удаленных задач
+        :rtype: int
+        '''
+
+    @abstractmethod
+    def archive_done_tasks(self, older_than_days, batch_size=500, now=None):
+        '''
+        Переносит давно выполненные задачи в архив.
+
+        :returns: число перенесенных задач
+        :rtype: int
+        '''
+
+    @abstractmethod
+    def changes_since(self, seq, batch_size=500):
+        '''
+        События журнала изменений с номером больше seq в порядке seq.
+
+        Журнал пополняется в той же транзакции, что и изменение:
+        add_task (add), complete_task (done), delete_task (delete),
+        clear_all_tasks (clear) и undo_last (undo).
+
+        :rtype: iterator of TaskEvent
+        '''
+
+    @abstractmethod
+    def last_seq(self):
+        '''
+        Номер последнего события журнала, 0 если журнал пуст.
+
+        :rtype: int
+        '''
+
+    @abstractmethod
+    def undo_last(self, user_id):
+        '''
+        Отменяет последнее действие пользователя (одно).
+
+        Действие не отменяется, если у пользователя нет доступа к задаче
+        или ее поддерево менялось более поздними событиями.
+
+        :returns: вид отмененного события или None
+        :rtype: str or None
+        '''
+
+    @abstractmethod
+    def compact(self, older_than_days, batch_size=500, vacuum_pages=1000):
+        '''
+        Архивирует старые задачи и удаляет старые отметки напоминаний
+        и события журнала.
+
+        :returns: число перенесенных задач
+        :rtype: int
+        '''
+
+
+class MemoryTaskStore(TaskStore):
+    '''
+    Хранилище задач в памяти процесса.
+
+    Задачи лежат в словаре по ID, рядом поддерживаются индексы:
+    задачи пользователя и общего списка (в порядке ID), невыполненные
+    задачи по дате дедлайна, подзадачи по родителю и списки по участнику -
+    аналоги индексов SQLite. Данные теряются при остановке процесса,
+    поэтому хранилище предназначено для тестов, бенчмарков и локального
+    запуска (DB_BACKEND=memory).
+
+    Одинаковые дедлайны хранятся одним объектом date, как и в Database.
+    Методы потокобезопасны: планировщик вызывает их из рабочих потоков.
+    Журнал изменений виден только внутри процесса.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._next_id = 1
+        self._next_list_id = 1
+        self._tasks = {}
+        self._done_at = {}
+        self._by_user = {}
+        self._by_list = {}
+        self._pending_by_day = {}
+        self._children = {}
+        self._archive = {}
+        self._archive_by_user = {}
+        self._users = {}
+        self._blocked = {}
+        self._broadcasts = {}
+        self._recipients = {}
+        self._pending_updates = {}
+        self._sent = {}
+        self._days = {}
+        self._lists = {}
+        self._codes = {}
+        self._members = {}
+        self._memberships = {}
+        self._next_seq = 1
+        self._events = []
+        self._last_event = {}
+        self._undo = {}
+
+    def close(self):
+        pass
+
+    def create_table(self, user_id):
+        pass
+
+    @staticmethod
+    def _drop(index, key, value):
+        items = index.get(key)
+        if items is not None:
+            items.pop(value, None)
+            if not items:
+                del index[key]
+
+    def _unindex(self, task):
+        self._drop(self._by_user, task.user_id, task.id)
+        self._drop(self._by_list, task.list_id, task.id)
+        self._drop(self._pending_by_day, task.deadline, task.id)
+        self._drop(self._children, task.parent_id, task.id)
+
+    @staticmethod
+    def _put(index, key, task_id):
+        items = index.setdefault(key, {})
+        restored = bool(items) and task_id < next(reversed(items))
+        items[task_id] = None
+        if restored:
+            index[key] = dict.fromkeys(sorted(items))
+
+    def _insert(self, task):
+        self._tasks[task.id] = task
+        self._put(self._by_user, task.user_id, task.id)
+        if task.list_id is not None:
+            self._put(self._by_list, task.list_id, task.id)
+        if task.deadline is not None and not task.done:
+            self._put(self._pending_by_day, task.deadline, task.id)
+        if task.parent_id is not None:
+            self._put(self._children, task.parent_id, task.id)
+
+    def _log_event(self, user_id, task_id, kind, undo=None):
+        event = TaskEvent(self._next_seq, user_id, task_id, kind, int(time.time()))
+        self._next_seq += 1
+        self._events.append(event)
+        self._last_event[user_id] = event
+        if undo is not None:
+            self._undo[event.seq] = undo
+
+    def _accessible(self, user_id, task_id):
+        task = self._tasks.get(task_id)
+        if task is None:
+            return None
+        if task.list_id is None:
+            return task if task.user_id == user_id else None
+        if task.list_id in self._memberships.get(user_id, ()):
+            return task
+        return None
+
+    def _subtree(self, task_id):
+        ids = [task_id]
+        for current in ids:
+            ids.extend(self._children.get(current, ()))
+        return ids
+
+    def add_task(self, user_id, task_text, category=None, deadline=None,
+                 recurrence=None, parent_id=None, list_id=None,
+                 reminders=DEFAULT_REMINDERS):
+        if isinstance(deadline, str):
+            deadline = date.fromisoformat(deadline)
+        with self._lock:
+            if parent_id is not None:
+                parent = self._accessible(user_id, parent_id)
+                if parent is None:
+                    return None
+                list_id = parent.list_id
+            elif list_id is not None and user_id not in self._members.get(list_id, ()):
+                return None
+            if deadline is not None:
+                deadline = self._days.setdefault(deadline, deadline)
+            task = Task(self._next_id, user_id, task_text, category, False,
+                        deadline, recurrence, parent_id, list_id, reminders)
+            self._next_id += 1
+            self._insert(task)
+            self._log_event(user_id, task.id, 'add')
+            return task.id
+
+    def get_tasks(self, user_id):
+        with self._lock:
+            return [self._tasks[task_id] for task_id in self._by_user.get(user_id, ())]
+
+    def get_task(self, user_id, task_id):
+        with self._lock:
+            return self._accessible(user_id, task_id)
+
+    def get_subtasks(self, user_id, parent_id=None, list_id=None):
+        with self._lock:
+            if parent_id is not None:
+                if self._accessible(user_id, parent_id) is None:
+                    return []
+                return [self._tasks[task_id] for task_id in self._children.get(parent_id, ())]
+            if list_id is not None:
+                if user_id not in self._members.get(list_id, ()):
+                    return []
+                tasks = [self._tasks[task_id] for task_id in self._by_list.get(list_id, ())]
+            else:
+                tasks = [task for task in self.get_tasks(user_id) if task.list_id is None]
+            return [task for task in tasks
+                    if task.parent_id is None or task.parent_id not in self._tasks]
+
+    def get_progress(self, user_id, task_ids):
+        with self._lock:
+            progress = {}
+            for task_id in task_ids:
+                if self._accessible(user_id, task_id) is None:
+                    continue
+                subtree = self._subtree(task_id)[1:]
+                if subtree:
+                    done = sum(self._tasks[sub_id].done for sub_id in subtree)
+                    progress[task_id] = (done, len(subtree))
+            return progress
+
+    def get_subtask_stats(self, user_id):
+        with self._lock:
+            subtasks = [task for task in self.get_tasks(user_id) if task.parent_id is not None]
+            return len(subtasks), sum(task.done for task in subtasks)
+
+    def get_due(self, user_id, start, end):
+        with self._lock:
+            tasks = [self._tasks[task_id] for task_id in self._by_user.get(user_id, ())]
+        return sorted(
+            (task for task in tasks
+             if not task.done and task.deadline is not None
+             and (start is None or task.deadline >= start) and task.deadline <= end),
+            key=lambda task: (task.deadline, task.id)
+        )
+
+    def get_stats(self, user_id):
+        with self._lock:
+            tasks = self._by_user.get(user_id, ())
+            done = sum(1 for task_id in tasks if self._tasks[task_id].done)
+            archived = len(self._archive_by_user.get(user_id, ()))
+            return len(tasks) + archived, done + archived
+
+    def get_due_in_bucket(self, day, utc_offset, default_offset, kind=REMIND_1D):
+        with self._lock:
+            due = []
+            for task_id in self._pending_by_day.get(day, ()):
+                task = self._tasks[task_id]
+                if not task.reminders & kind:
+                    continue
+                user = self._users.get(task.user_id)
+                offset = user[1] if user is not None and user[1] is not None \
+                    else default_offset
+                if offset == utc_offset and (task.id, task.deadline, kind) not in self._sent:
+                    due.append(TaskRef(task.id, task.user_id, task.task_text, task.deadline))
+            return due
+
+    def mark_reminded(self, tasks, kind=REMIND_1D):
+        now = int(time.time())
+        with self._lock:
+            for task in tasks:
+                self._sent.setdefault((task.id, task.deadline, kind), now)
+
+    def set_reminders(self, user_id, task_id, reminders):
+        with self._lock:
+            task = self._accessible(user_id, task_id)
+            if task is None:
+                return False
+            self._tasks[task_id] = task._replace(reminders=reminders)
+            return True
+
+    def toggle_reminder(self, user_id, task_id, kind):
+        with self._lock:
+            task = self._accessible(user_id, task_id)
+            if task is None:
+                return None
+            self._tasks[task_id] = task._replace(reminders=task.reminders ^ kind)
+            return task.reminders ^ kind
+
+    def set_user_tz(self, user_id, tz, utc_offset):
+        with self._lock:
+            self._users[user_id] = (tz, utc_offset)
+
+    def get_user_tz(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            return user[0] if user is not None else None
+
+    def get_timezones(self):
+        with self._lock:
+            zones = {}
+            for tz, offset in self._users.values():
+                if tz is None:
+                    continue
+                if tz not in zones or offset < zones[tz]:
+                    zones[tz] = offset
+            return zones
+
+    def update_offsets(self, offsets):
+        with self._lock:
+            updated = 0
+            for user_id, (tz, offset) in self._users.items():
+                if tz in offsets and offsets[tz] != offset:
+                    self._users[user_id] = (tz, offsets[tz])
+                    updated += 1
+            return updated
+
+    def register_user(self, user_id):
+        with self._lock:
+            self._blocked.pop(user_id, None)
+            if user_id in self._users:
+                return False
+            self._users[user_id] = (None, None)
+            return True
+
+    def _broadcast(self, broadcast_id):
+        admin_id, text, finished = self._broadcasts[broadcast_id]
+        counts = [0] * 4
+        for status in self._recipients[broadcast_id].values():
+            counts[status] += 1
+        return Broadcast(
+            broadcast_id, admin_id, text, len(self._recipients[broadcast_id]),
+            counts[DELIVERY_PENDING], counts[DELIVERY_SENT], counts[DELIVERY_FAILED],
+            counts[DELIVERY_BLOCKED], finished
+        )
+
+    def create_broadcast(self, admin_id, text):
+        with self._lock:
+            broadcast_id = len(self._broadcasts) + 1
+            self._broadcasts[broadcast_id] = (admin_id, text, False)
+            self._recipients[broadcast_id] = dict.fromkeys(
+                sorted(user_id for user_id in self._users if user_id not in self._blocked),
+                DELIVERY_PENDING
+            )
+            return self._broadcast(broadcast_id)
+
+    def get_broadcast(self, broadcast_id):
+        with self._lock:
+            if broadcast_id not in self._broadcasts:
+                return None
+            return self._broadcast(broadcast_id)
+
+    def get_unfinished_broadcasts(self):
+        with self._lock:
+            return [self._broadcast(broadcast_id)
+                    for broadcast_id, (_, _, finished) in self._broadcasts.items()
+                    if not finished]
+
+    def get_pending_recipients(self, broadcast_id, after=0, limit=100):
+        with self._lock:
+            recipients = self._recipients[broadcast_id]
+            ids = list(recipients)
+            pending = []
+            for user_id in ids[bisect.bisect_right(ids, after):]:
+                if recipients[user_id] == DELIVERY_PENDING:
+                    pending.append(user_id)
+                    if len(pending) == limit:
+                        break
+            return pending
+
+    def record_deliveries(self, broadcast_id, results):
+        now = int(time.time())
+        with self._lock:
+            recipients = self._recipients[broadcast_id]
+            for user_id, status in results:
+                recipients[user_id] = status
+                if status == DELIVERY_BLOCKED:
+                    self._blocked[user_id] = now
+
+    def finish_broadcast(self, broadcast_id):
+        with self._lock:
+            admin_id, text, _ = self._broadcasts[broadcast_id]
+            self._broadcasts[broadcast_id] = (admin_id, text, True)
+            return self._broadcast(broadcast_id)
+
+    def save_pending_updates(self, updates):
+        with self._lock:
+            self._pending_updates.update(updates)
+
+    def pop_pending_updates(self):
+        with self._lock:
+            payloads = [self._pending_updates[update_id]
+                        for update_id in sorted(self._pending_updates)]
+            self._pending_updates.clear()
+            return payloads
+
+    def _task_list(self, list_id):
+        owner_id, title, code = self._lists[list_id]
+        return TaskList(list_id, owner_id, title, code, len(self._members[list_id]))
+
+    def create_list(self, user_id, title):
+        with self._lock:
+            list_id = self._next_list_id
+            self._next_list_id += 1
+            code = secrets.token_urlsafe(8)
+            self._lists[list_id] = (user_id, title, code)
+            self._codes[code] = list_id
+            self._members[list_id] = {user_id: None}
+            self._memberships.setdefault(user_id, {})[list_id] = None
+            return self._task_list(list_id)
+
+    def join_list(self, user_id, invite_code):
+        with self._lock:
+            list_id = self._codes.get(invite_code)
+            if list_id is None:
+                return None, False
+            joined = user_id not in self._members[list_id]
+            self._members[list_id][user_id] = None
+            self._memberships.setdefault(user_id, {})[list_id] = None
+            return self._task_list(list_id), joined
+
+    def leave_list(self, user_id, list_id):
+        with self._lock:
+            if user_id not in self._members.get(list_id, ()):
+                return False
+            self._drop(self._members, list_id, user_id)
+            self._drop(self._memberships, user_id, list_id)
+            if list_id not in self._members:
+                for task_id in list(self._by_list.get(list_id, ())):
+                    self._remove(task_id)
+                for task_id in [task_id for task_id, task in self._archive.items()
+                                if task.list_id == list_id]:
+                    task = self._archive.pop(task_id)
+                    self._archive_by_user[task.user_id].remove(task_id)
+                self._codes.pop(self._lists.pop(list_id)[2])
+            return True
+
+    def get_list(self, user_id, list_id):
+        with self._lock:
+            if user_id not in self._members.get(list_id, ()):
+                return None
+            return self._task_list(list_id)
+
+    def get_lists(self, user_id):
+        with self._lock:
+            return [self._task_list(list_id)
+                    for list_id in sorted(self._memberships.get(user_id, ()))]
+
+    def get_list_members(self, list_id):
+        with self._lock:
+            return sorted(self._members.get(list_id, ()))
+
+    def get_archived_tasks(self, user_id, limit=10, offset=0):
+        with self._lock:
+            ids = self._archive_by_user.get(user_id, [])
+            page = ids[::-1][offset:offset + limit]
+            return [self._archive[task_id] for task_id in page]
+
+    def mark_done(self, user_id, task_id):
+        return self.complete_task(user_id, task_id)[0]
+
+    def complete_task(self, user_id, task_id, today=None):
+        with self._lock:
+            task = self._accessible(user_id, task_id)
+            if task is None:
+                return False, None
+            if task.done:
+                return True, None
+            self._done_at[task_id] = int(time.time())
+            self._drop(self._pending_by_day, task.deadline, task.id)
+            self._tasks[task_id] = task = task._replace(done=True)
+            if not task.recurrence or task.deadline is None:
+                self._log_event(user_id, task_id, 'done', {})
+                return True, None
+            due = next_due(task.recurrence, task.deadline, today or date.today())
+            parent_id = task.parent_id if task.parent_id in self._tasks else None
+            new_id = self.add_task(user_id, task.task_text, task.category, due,
+                                   task.recurrence, parent_id, task.list_id,
+                                   task.reminders)
+            self._log_event(user_id, task_id, 'done', {'next_id': new_id})
+            return True, self._tasks.get(new_id)
+
+    def _remove(self, task_id):
+        self._unindex(self._tasks.pop(task_id))
+        self._done_at.pop(task_id, None)
+
+    def delete_task(self, user_id, task_id):
+        with self._lock:
+            if self._accessible(user_id, task_id) is None:
+                return False
+            removed = []
+            for sub_id in self._subtree(task_id):
+                removed.append((self._tasks[sub_id], self._done_at.get(sub_id)))
+                self._remove(sub_id)
+            self._log_event(user_id, task_id, 'delete', {'tasks': removed})
+            return True
+
+    def clear_all_tasks(self, user_id):
+        with self._lock:
+            removed = []
+            for task_id in list(self._by_user.get(user_id, ())):
+                if self._tasks[task_id].list_id is None:
+                    removed.append((self._tasks[task_id], self._done_at.get(task_id)))
+                    self._remove(task_id)
+            archived = self._archive_by_user.pop(user_id, [])
+            removed_archive = []
+            for task_id in archived:
+                if self._archive[task_id].list_id is None:
+                    removed_archive.append(self._archive.pop(task_id))
+            shared = [task_id for task_id in archived if task_id in self._archive]
+            if shared:
+                self._archive_by_user[user_id] = shared
+            deleted = len(removed) + len(removed_archive)
+            if deleted:
+                self._log_event(user_id, None, 'clear',
+                                {'tasks': removed, 'archive': removed_archive})
+            return deleted
+
+    def changes_since(self, seq, batch_size=500):
+        with self._lock:
+            start = bisect.bisect_right(self._events, seq, key=lambda event: event.seq)
+            events = self._events[start:]
+        yield from events
+
+    def last_seq(self):
+        with self._lock:
+            return self._events[-1].seq if self._events else 0
+
+    def _changed_since(self, seq, ids):
+        ids = set(ids)
+        start = bisect.bisect_right(self._events, seq, key=lambda event: event.seq)
+        return any(event.task_id in ids for event in self._events[start:])
+
+    def undo_last(self, user_id):
+        with self._lock:
+            event = self._last_event.get(user_id)
+            if event is None or event.kind == 'undo':
+                return None
+            undo = self._undo.get(event.seq, {})
+            if event.kind in ('add', 'done'):
+                if self._accessible(user_id, event.task_id) is None:
+                    return None
+                ids = self._subtree(event.task_id)
+                if undo.get('next_id') is not None:
+                    ids.append(undo['next_id'])
+            elif event.kind == 'delete':
+                root = undo['tasks'][0][0]
+                if (root.list_id is not None
+                        and root.list_id not in self._memberships.get(user_id, ())):
+                    return None
+                ids = [task.id for task, _ in undo['tasks']]
+                if root.parent_id is not None:
+                    ids.append(root.parent_id)
+            else:
+                ids = []
+            if self._changed_since(event.seq, ids):
+                return None
+            self._undo.pop(event.seq, None)
+            if event.kind == 'add':
+                for sub_id in ids:
+                    self._remove(sub_id)
+            elif event.kind == 'done':
+                task = self._tasks.get(event.task_id)
+                if task is not None and task.done:
+                    self._done_at.pop(task.id, None)
+                    self._unindex(task)
+                    self._insert(task._replace(done=False))
+                next_task = self._tasks.get(undo.get('next_id'))
+                if next_task is not None and not next_task.done:
+                    self._remove(next_task.id)
+            else:
+                for task, done_at in undo['tasks']:
+                    if task.id not in self._tasks:
+                        self._insert(task)
+                        if done_at is not None:
+                            self._done_at[task.id] = done_at
+                for task in undo.get('archive', ()):
+                    if task.id not in self._archive:
+                        self._archive[task.id] = task
+                        ids = self._archive_by_user.setdefault(task.user_id, [])
+                        bisect.insort(ids, task.id)
+            self._log_event(user_id, event.task_id, 'undo')
+            return event.kind
+
+    def archive_done_tasks(self, older_than_days, batch_size=500, now=None):
+        cutoff = int(time.time() if now is None else now) - older_than_days * 86400
+        with self._lock:
+            old = [task_id for task_id, done_at in self._done_at.items()
+                   if done_at < cutoff]
+            for task_id in sorted(old):
+                task = self._tasks.pop(task_id)
+                del self._done_at[task_id]
+                self._unindex(task)
+                self._archive[task_id] = task
+                self._archive_by_user.setdefault(task.user_id, []).append(task_id)
+            for ids in self._archive_by_user.values():
+                ids.sort()
+            return len(old)
+
+    def compact(self, older_than_days, batch_size=500, vacuum_pages=1000):
+        moved = self.archive_done_tasks(older_than_days, batch_size)
+        cutoff = int(time.time()) - older_than_days * 86400
+        with self._lock:
+            self._sent = {key: sent_at for key, sent_at in self._sent.items()
+                          if sent_at >= cutoff}
+            old = bisect.bisect_left(self._events, cutoff, key=lambda event: event.created_at)
+            for event in self._events[:old]:
+                self._undo.pop(event.seq, None)
+                if self._last_event.get(event.user_id) is event:
+                    del self._last_event[event.user_id]
+            del self._events[:old]
+        return moved
+
+
+def build_store(db_name='todo_bot.db'):
+    '''
+    Создает хранилище задач по переменным окружения.
+
+    Переменные окружения:
+        DB_BACKEND: sqlite или memory (sqlite)
+
+    :param db_name: имя файла БД для SQLite
+    :type db_name: str
+    :rtype: TaskStore
+    :raises ValueError: если хранилище неизвестно
+    '''
+    backend = os.getenv('DB_BACKEND', 'sqlite').lower()
+    if backend == 'memory':
+        return MemoryTaskStore()
+    if backend == 'sqlite':
+        from database import Database
+        return Database(db_name)
+    raise ValueError(f'Неизвестное хранилище DB_BACKEND: {backend}')
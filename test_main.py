@@ -1,38 +1,87 @@
-import unittest
-from datetime import datetime, date, timedelta
+import asyncio
+import io
+import json
+import logging
 import os
-from database import Database
-
-
-class DatabaseTest(unittest.TestCase):
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from unittest import mock
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendMessage
+from aiogram.types import Update, User
+
+from backup import (
+    BackupError, BackupManager, build_backup, copy_database, restore, verify_snapshot
+)
+from broadcast import Broadcaster
+from database import TASK_ACCESS, Database
+from fanout import MESSAGE_LIMIT, ListNotifier
+from lifecycle import InFlightMiddleware, graceful_shutdown, redeliver
+from logconfig import SamplingFilter, configure_logging, correlation_id
+from middlewares import (
+    CorrelationMiddleware, KeyedLock, ThrottlingMiddleware, UserLockMiddleware, parse_throttle_limits
+)
+from models import (
+    DELIVERY_BLOCKED, DELIVERY_FAILED, DELIVERY_SENT, REMIND_1D, REMIND_1H, REMIND_1W,
+    Task, TaskRef
+)
+from profiling import ProfilingMiddleware, parse_admin_ids
+from recurrence import describe, make_rule, next_due, parse_rule
+from replay import (
+    RecordingMiddleware, ReplayStats, anonymize_update, anonymous_id, read_updates, replay
+)
+from scheduler import ReminderScheduler, parse_reminders, utc_offset_minutes
+from session import (
+    LANE_BACKGROUND, LANE_CALLBACK, LANE_INTERACTIVE, LatencyHistogram,
+    PriorityLimiter, StubSession, TunedSession
+)
+from sharding import (
+    ID_RANGE_BITS, invite_shard, prepare_shard, rebalance, shard_db_name, shard_for,
+    update_user_id
+)
+from storage import MemoryTaskStore, build_store
+from writer import GroupCommitWriter, build_writer
+
+
+class StoreConformance:
     """
-    Тесты для работы с базой данных.
+    Общие тесты хранилища задач (интерфейс TaskStore).
 
+    Подмешиваются в тесты каждой реализации, которая задает make_store().
     Проверяет основные CRUD операции: создание, чтение,
-    обновление и удаление задач в базе данных.
+    обновление и удаление задач, а также архив, сроки и напоминания.
     """
 
+    def make_store(self):
+        """
+        Создает проверяемое хранилище.
+
+        :rtype: TaskStore
+        """
+        raise NotImplementedError
+
     def setUp(self):
         """
         Настройка тестового окружения перед каждым тестом.
-
-        Создает временную базу данных и объект Database для тестирования.
         """
-        self.test_db = 'test_todo.db'
-        self.db = Database(self.test_db)
+        self.db = self.make_store()
         self.user_id = 123456
 
     def tearDown(self):
         """
         Очистка после каждого теста.
-
-        Удаляет временную базу данных, созданную во время теста.
         """
-        if os.path.exists(self.test_db):
-            try:
-                os.remove(self.test_db)
-            except:
-                pass
+        self.db.close()
 
     def test_1_add_and_get_tasks(self):
         """
@@ -145,6 +194,639 @@ class DatabaseTest(unittest.TestCase):
         deleted = self.db.clear_all_tasks(self.user_id)
         self.assertEqual(deleted, 0)
 
+    def test_6_stats(self):
+        """
+        Тест подсчета статистики средствами SQL.
+
+        :assert: Возвращается пара (всего, выполнено)
+        """
+        self.db.create_table(self.user_id)
+        self.assertEqual(self.db.get_stats(self.user_id), (0, 0))
+        task_id = self.db.add_task(self.user_id, "Задача 1")
+        self.db.add_task(self.user_id, "Задача 2")
+        self.db.mark_done(self.user_id, task_id)
+        self.assertEqual(self.db.get_stats(self.user_id), (2, 1))
+
+    def test_8_archive_done_tasks(self):
+        """
+        Тест архивации давно выполненных задач.
+
+        :assert: Перенесены только выполненные задачи старше порога
+        :assert: Архив доступен постранично, статистика его учитывает
+        :assert: Очистка удаляет и архивные задачи
+        """
+        self.db.create_table(self.user_id)
+        first = self.db.add_task(self.user_id, "Старая 1")
+        second = self.db.add_task(self.user_id, "Старая 2")
+        self.db.add_task(self.user_id, "Активная")
+        self.db.mark_done(self.user_id, first)
+        self.db.mark_done(self.user_id, second)
+
+        self.assertEqual(self.db.archive_done_tasks(30), 0)
+        month_later = datetime.now().timestamp() + 31 * 86400
+        moved = self.db.archive_done_tasks(30, batch_size=1, now=month_later)
+
+        self.assertEqual(moved, 2)
+        self.assertEqual([task[2] for task in self.db.get_tasks(self.user_id)], ["Активная"])
+        archived = self.db.get_archived_tasks(self.user_id, limit=1)
+        self.assertEqual([task[0] for task in archived], [second])
+        self.assertEqual(self.db.get_stats(self.user_id), (3, 2))
+        self.assertEqual(self.db.clear_all_tasks(self.user_id), 3)
+
+    def test_10_due_ranges(self):
+        """
+        Тест выборки задач по диапазону дедлайнов.
+
+        :assert: get_due возвращает только невыполненные задачи пользователя в диапазоне
+        :assert: get_due без начала диапазона возвращает просроченные задачи
+        """
+        self.db.create_table(self.user_id)
+        today = date(2030, 6, 10)
+        overdue = self.db.add_task(self.user_id, "Просрочена", None, today - timedelta(days=2))
+        soon = self.db.add_task(self.user_id, "Скоро", None, today + timedelta(days=1))
+        later = self.db.add_task(self.user_id, "Потом", None, today + timedelta(days=30))
+        finished = self.db.add_task(self.user_id, "Сделана", None, today)
+        self.db.mark_done(self.user_id, finished)
+        self.db.add_task(self.user_id, "Без срока")
+        self.db.add_task(self.user_id + 1, "Чужая", None, today)
+
+        due = self.db.get_due(self.user_id, today, today + timedelta(days=3))
+        self.assertEqual([task[0] for task in due], [soon])
+        self.assertEqual(due[0][5], today + timedelta(days=1))
+        late = self.db.get_due(self.user_id, None, today - timedelta(days=1))
+        self.assertEqual([task[0] for task in late], [overdue])
+
+    def test_11_complete_recurring_task(self):
+        """
+        Тест выполнения повторяющейся задачи.
+
+        :assert: При выполнении создается только следующее повторение
+        :assert: Повторное выполнение той же задачи не создает дубликат
+        :assert: Обычная задача не порождает повторений
+        """
+        self.db.create_table(self.user_id)
+        rule = make_rule('MONTHLY', date(2030, 1, 31))
+        task_id = self.db.add_task(self.user_id, "Оплатить счета", None,
+                                   date(2030, 1, 31), rule)
+        plain_id = self.db.add_task(self.user_id, "Разовая", None, date(2030, 1, 31))
+
+        done, next_task = self.db.complete_task(self.user_id, task_id, date(2030, 1, 31))
+        self.assertTrue(done)
+        self.assertEqual(next_task[5], date(2030, 2, 28))
+        self.assertEqual(next_task[6], rule)
+        self.assertEqual(self.db.complete_task(self.user_id, task_id), (True, None))
+        self.assertEqual(self.db.complete_task(self.user_id, plain_id), (True, None))
+        self.assertEqual(self.db.complete_task(self.user_id, 999), (False, None))
+
+        done, after = self.db.complete_task(self.user_id, next_task[0], date(2030, 2, 28))
+        self.assertEqual(after[5], date(2030, 3, 31))
+        pending = [task for task in self.db.get_tasks(self.user_id) if not task[4]]
+        self.assertEqual([task[0] for task in pending], [after[0]])
+
+    def test_12_task_model(self):
+        """
+        Тест модели Task, которую возвращают запросы задач.
+
+        :assert: Поля доступны по именам, дедлайн - date, done - bool
+        :assert: Доступ по индексам работает, у Task нет __dict__
+        :assert: Задачи с одним дедлайном ссылаются на один объект date
+        :assert: Напоминания получают проекцию TaskRef без лишних полей
+        """
+        self.db.create_table(self.user_id)
+        self.db.add_task(self.user_id, "Первая", "Работа", date(2030, 5, 1))
+        self.db.add_task(self.user_id, "Вторая", None, date(2030, 5, 1))
+
+        first, second = self.db.get_tasks(self.user_id)
+        self.assertIsInstance(first, Task)
+        self.assertEqual(first.task_text, "Первая")
+        self.assertEqual(first.category, "Работа")
+        self.assertIs(first.done, False)
+        self.assertEqual(first.deadline, date(2030, 5, 1))
+        self.assertEqual(first[2], first.task_text)
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertIs(first.deadline, second.deadline)
+
+        refs = self.db.get_due_in_bucket(date(2030, 5, 1), 0, 0)
+        self.assertEqual([ref.id for ref in refs], [first.id, second.id])
+        self.assertIsInstance(refs[0], TaskRef)
+        self.assertEqual(refs[0]._fields, ('id', 'user_id', 'task_text', 'deadline'))
+
+    def test_13_timezones_and_reminders(self):
+        """
+        Тест поясов пользователей и отметок напоминаний.
+
+        :assert: Пояс сохраняется и перезаписывается
+        :assert: Задачи пользователей без пояса попадают в группу смещения по умолчанию
+        :assert: Отмеченные напоминания больше не выбираются
+        :assert: update_offsets меняет только устаревшие смещения
+        """
+        self.db.create_table(self.user_id)
+        other = self.user_id + 1
+        self.assertIsNone(self.db.get_user_tz(self.user_id))
+        self.db.set_user_tz(self.user_id, 'Europe/Berlin', 60)
+        self.db.set_user_tz(self.user_id, 'Europe/Moscow', 180)
+        self.db.set_user_tz(other, 'Europe/Moscow', 180)
+        self.assertEqual(self.db.get_user_tz(self.user_id), 'Europe/Moscow')
+        self.assertEqual(self.db.get_timezones(), {'Europe/Moscow': 180})
+
+        day = date(2030, 5, 1)
+        mine = self.db.add_task(self.user_id, "Моя", None, day)
+        stranger = self.db.add_task(other + 1, "Без пояса", None, day)
+        self.assertEqual([ref.id for ref in self.db.get_due_in_bucket(day, 180, 0)], [mine])
+        self.assertEqual([ref.id for ref in self.db.get_due_in_bucket(day, 0, 0)], [stranger])
+
+        self.db.mark_reminded(self.db.get_due_in_bucket(day, 180, 0))
+        self.assertEqual(self.db.get_due_in_bucket(day, 180, 0), [])
+        self.assertEqual(self.db.update_offsets({'Europe/Moscow': 180}), 0)
+        self.assertEqual(self.db.update_offsets({'Europe/Moscow': 240}), 2)
+        self.assertEqual(self.db.get_timezones(), {'Europe/Moscow': 240})
+
+    def test_15_subtasks_progress(self):
+        """
+        Тест подзадач и прогресса по поддереву.
+
+        :assert: Прогресс учитывает все уровни вложенности
+        :assert: Верхний уровень не содержит подзадач, кроме осиротевших после архивации
+        :assert: Нельзя добавить подзадачу к чужой или несуществующей задаче
+        :assert: Удаление задачи удаляет все ее подзадачи
+        """
+        self.db.create_table(self.user_id)
+        root = self.db.add_task(self.user_id, "Переезд")
+        pack = self.db.add_task(self.user_id, "Собрать вещи", parent_id=root)
+        books = self.db.add_task(self.user_id, "Книги", parent_id=pack)
+        dishes = self.db.add_task(self.user_id, "Посуда", parent_id=pack)
+        call = self.db.add_task(self.user_id, "Заказать машину", parent_id=root)
+        alone = self.db.add_task(self.user_id, "Отдельная")
+        self.db.mark_done(self.user_id, books)
+        self.db.mark_done(self.user_id, call)
+
+        top = self.db.get_subtasks(self.user_id)
+        self.assertEqual([task.id for task in top], [root, alone])
+        self.assertEqual([task.id for task in self.db.get_subtasks(self.user_id, root)],
+                         [pack, call])
+        self.assertEqual(self.db.get_task(self.user_id, pack).parent_id, root)
+        self.assertEqual(
+            self.db.get_progress(self.user_id, [root, pack, alone]),
+            {root: (2, 4), pack: (1, 2)}
+        )
+        self.assertEqual(self.db.get_subtask_stats(self.user_id), (4, 2))
+        self.assertEqual(self.db.get_progress(self.user_id + 1, [root]), {})
+        self.assertIsNone(self.db.add_task(self.user_id + 1, "Чужая", parent_id=root))
+        self.assertIsNone(self.db.add_task(self.user_id, "Потерянная", parent_id=999))
+
+        self.db.mark_done(self.user_id, pack)
+        month_later = datetime.now().timestamp() + 31 * 86400
+        self.assertEqual(self.db.archive_done_tasks(30, now=month_later), 3)
+        self.assertEqual([task.id for task in self.db.get_subtasks(self.user_id)],
+                         [root, dishes, alone])
+
+        self.db.mark_done(self.user_id, root)
+        orphan = self.db.add_task(self.user_id, "Разобрать", parent_id=alone)
+        self.assertEqual(self.db.archive_done_tasks(30, now=month_later), 1)
+        self.assertTrue(self.db.delete_task(self.user_id, alone))
+        self.assertIsNone(self.db.get_task(self.user_id, orphan))
+        self.assertEqual([task.id for task in self.db.get_tasks(self.user_id)], [dishes])
+
+    def test_17_shared_lists(self):
+        """
+        Тест общих списков задач.
+
+        :assert: Задачи списка видят и меняют все участники, но не посторонние
+        :assert: Подзадача наследует список родителя
+        :assert: Задачи списка не попадают в личный список и не удаляются его очисткой
+        :assert: Список без участников удаляется вместе с задачами
+        """
+        self.db.create_table(self.user_id)
+        owner, member, stranger = self.user_id, self.user_id + 1, self.user_id + 2
+        shared = self.db.create_list(owner, "Покупки")
+        self.assertEqual(shared.members, 1)
+        self.assertEqual(self.db.join_list(member, "неверный"), (None, False))
+        joined, new = self.db.join_list(member, shared.invite_code)
+        self.assertTrue(new)
+        self.assertEqual((joined.id, joined.members), (shared.id, 2))
+        self.assertFalse(self.db.join_list(member, shared.invite_code)[1])
+        self.assertEqual(self.db.get_list_members(shared.id), [owner, member])
+        self.assertEqual([item.title for item in self.db.get_lists(member)], ["Покупки"])
+        self.assertIsNone(self.db.get_list(stranger, shared.id))
+
+        milk = self.db.add_task(owner, "Молоко", list_id=shared.id)
+        bread = self.db.add_task(member, "Хлеб", list_id=shared.id)
+        crust = self.db.add_task(member, "Бородинский", parent_id=bread)
+        personal = self.db.add_task(owner, "Личная")
+        self.assertIsNone(self.db.add_task(stranger, "Чужая", list_id=shared.id))
+        self.assertEqual(self.db.get_task(member, crust).list_id, shared.id)
+        self.assertEqual([task.id for task in self.db.get_subtasks(owner, list_id=shared.id)],
+                         [milk, bread])
+        self.assertEqual(self.db.get_subtasks(stranger, list_id=shared.id), [])
+        self.assertEqual([task.id for task in self.db.get_subtasks(owner)], [personal])
+        self.assertIsNone(self.db.get_task(stranger, milk))
+        self.assertFalse(self.db.mark_done(stranger, milk))
+        self.assertTrue(self.db.mark_done(member, milk))
+        self.assertEqual(self.db.get_progress(owner, [bread]), {bread: (0, 1)})
+        self.assertFalse(self.db.delete_task(stranger, bread))
+
+        self.assertEqual(self.db.clear_all_tasks(owner), 1)
+        self.assertTrue(self.db.get_task(owner, milk).done)
+        self.assertTrue(self.db.leave_list(owner, shared.id))
+        self.assertIsNone(self.db.get_task(owner, milk))
+        self.assertIsNotNone(self.db.get_task(member, milk))
+        self.assertFalse(self.db.leave_list(owner, shared.id))
+        self.assertTrue(self.db.leave_list(member, shared.id))
+        self.assertEqual(self.db.get_lists(member), [])
+        self.assertEqual(self.db.get_tasks(member), [])
+        self.assertEqual(self.db.join_list(owner, shared.invite_code), (None, False))
+
+    def test_18_reminder_offsets(self):
+        """
+        Тест масок смещений напоминаний.
+
+        :assert: Задача выбирается только для включенных у нее смещений
+        :assert: Отметки отправки разных смещений не мешают друг другу
+        :assert: Смещения меняет только пользователь с доступом к задаче
+        :assert: toggle_reminder переключает один бит, не трогая остальные
+        """
+        self.db.create_table(self.user_id)
+        day = date(2030, 5, 1)
+        both = self.db.add_task(self.user_id, "Оба", None, day,
+                                reminders=REMIND_1D | REMIND_1H)
+        default = self.db.add_task(self.user_id, "По умолчанию", None, day)
+        self.assertEqual(self.db.get_task(self.user_id, default).reminders, REMIND_1D)
+        self.assertEqual([ref.id for ref in self.db.get_due_in_bucket(day, 0, 0)],
+                         [both, default])
+        self.assertEqual([ref.id for ref in self.db.get_due_in_bucket(day, 0, 0, REMIND_1H)],
+                         [both])
+
+        self.db.mark_reminded(self.db.get_due_in_bucket(day, 0, 0))
+        self.assertEqual(self.db.get_due_in_bucket(day, 0, 0), [])
+        self.assertEqual(len(self.db.get_due_in_bucket(day, 0, 0, REMIND_1H)), 1)
+
+        self.assertFalse(self.db.set_reminders(self.user_id + 1, default, REMIND_1W))
+        self.assertTrue(self.db.set_reminders(self.user_id, default, REMIND_1W | REMIND_1H))
+        self.assertEqual([ref.id for ref in self.db.get_due_in_bucket(day, 0, 0, REMIND_1H)],
+                         [both, default])
+
+        self.assertIsNone(self.db.toggle_reminder(self.user_id + 1, both, REMIND_1W))
+        self.assertEqual(self.db.toggle_reminder(self.user_id, both, REMIND_1W),
+                         REMIND_1W | REMIND_1D | REMIND_1H)
+        self.assertEqual(self.db.toggle_reminder(self.user_id, both, REMIND_1D),
+                         REMIND_1W | REMIND_1H)
+        self.assertEqual(self.db.get_task(self.user_id, both).reminders, REMIND_1W | REMIND_1H)
+
+    def test_19_event_log_and_undo(self):
+        """
+        Тест журнала изменений и отмены последнего действия.
+
+        :assert: Каждое изменение пишет событие с растущим seq
+        :assert: changes_since возвращает только события после seq
+        :assert: Отмена возвращает удаленные задачи с их ID и снимает отметку выполнения
+        :assert: Отменить можно только последнее действие и только один раз
+        """
+        self.db.create_table(self.user_id)
+        self.assertEqual(self.db.last_seq(), 0)
+        self.assertIsNone(self.db.undo_last(self.user_id))
+        root = self.db.add_task(self.user_id, "Ремонт")
+        sub = self.db.add_task(self.user_id, "Обои", parent_id=root)
+        start = self.db.last_seq()
+        weekly = self.db.add_task(self.user_id, "Полив", None, date(2030, 1, 1), 'FREQ=WEEKLY')
+        self.db.complete_task(self.user_id, weekly, date(2030, 1, 1))
+        self.assertTrue(self.db.delete_task(self.user_id, root))
+
+        events = list(self.db.changes_since(start))
+        self.assertEqual([event.kind for event in events], ['add', 'add', 'done', 'delete'])
+        self.assertEqual(events[-1].task_id, root)
+        self.assertEqual([event.seq for event in events], sorted({e.seq for e in events}))
+        self.assertTrue(all(event.seq > start for event in events))
+        self.assertEqual(self.db.last_seq(), events[-1].seq)
+
+        self.assertEqual(self.db.undo_last(self.user_id + 1), None)
+        self.assertEqual(self.db.undo_last(self.user_id), 'delete')
+        self.assertEqual(self.db.get_task(self.user_id, sub).parent_id, root)
+        self.assertIsNone(self.db.undo_last(self.user_id))
+        self.assertEqual([event.kind for event in self.db.changes_since(events[-1].seq)],
+                         ['undo'])
+
+        self.db.complete_task(self.user_id, root)
+        self.assertEqual(self.db.undo_last(self.user_id), 'done')
+        self.assertFalse(self.db.get_task(self.user_id, root).done)
+        self.assertEqual(self.db.clear_all_tasks(self.user_id), 4)
+        self.assertEqual(self.db.undo_last(self.user_id), 'clear')
+        self.assertEqual([task.id for task in self.db.get_tasks(self.user_id)],
+                         [root, sub, weekly, weekly + 1])
+        self.assertEqual(self.db.get_stats(self.user_id), (4, 1))
+
+        self.db.mark_done(self.user_id, weekly + 1)
+        self.assertEqual(self.db.undo_last(self.user_id), 'done')
+        self.assertEqual(len(self.db.get_tasks(self.user_id)), 4)
+        self.db.add_task(self.user_id, "Лишняя")
+        self.assertEqual(self.db.undo_last(self.user_id), 'add')
+        self.assertEqual(len(self.db.get_tasks(self.user_id)), 4)
+
+    def test_20_broadcast_registry_and_progress(self):
+        """
+        Тест реестра пользователей и хода рассылки.
+
+        :assert: Повторная регистрация не создает пользователя заново
+        :assert: Получатели выдаются пачками по возрастанию ID, без уже отправленных
+        :assert: Заблокировавшие бота не попадают в следующую рассылку
+        :assert: Пользователь без пояса получает напоминания по поясу по умолчанию
+        """
+        self.db.create_table(self.user_id)
+        for user_id in (30, 10, 20, 40):
+            self.assertTrue(self.db.register_user(user_id))
+        self.assertFalse(self.db.register_user(10))
+        self.db.set_user_tz(50, 'Europe/Moscow', 180)
+        self.assertEqual(self.db.get_timezones(), {'Europe/Moscow': 180})
+        self.assertIsNone(self.db.get_user_tz(10))
+        task_id = self.db.add_task(10, "Отчет", None, date(2030, 1, 2))
+        self.assertEqual([t.id for t in self.db.get_due_in_bucket(date(2030, 1, 2), 0, 0)],
+                         [task_id])
+
+        broadcast = self.db.create_broadcast(1, "Новости")
+        self.assertEqual((broadcast.total, broadcast.pending, broadcast.finished), (5, 5, False))
+        self.assertEqual(self.db.get_pending_recipients(broadcast.id, 0, 2), [10, 20])
+        self.db.record_deliveries(broadcast.id, [(10, DELIVERY_SENT), (20, DELIVERY_BLOCKED)])
+        self.assertEqual(self.db.get_pending_recipients(broadcast.id, 0, 10), [30, 40, 50])
+        self.assertEqual(self.db.get_pending_recipients(broadcast.id, 30, 10), [40, 50])
+        self.assertEqual([b.id for b in self.db.get_unfinished_broadcasts()], [broadcast.id])
+        self.db.record_deliveries(broadcast.id, [(30, DELIVERY_SENT), (40, DELIVERY_FAILED),
+                                                 (50, DELIVERY_SENT)])
+        done = self.db.finish_broadcast(broadcast.id)
+        self.assertEqual(done, broadcast._replace(
+            pending=0, sent=3, failed=1, blocked=1, finished=True
+        ))
+        self.assertEqual(self.db.get_unfinished_broadcasts(), [])
+
+        self.assertEqual(self.db.create_broadcast(1, "Еще").total, 4)
+        self.db.register_user(20)
+        self.assertEqual(self.db.create_broadcast(1, "Снова").total, 5)
+
+    def test_21_pending_updates(self):
+        """
+        Тест сохранения апдейтов, не обработанных к остановке.
+
+        :assert: Апдейты возвращаются в порядке update_id и только один раз
+        :assert: Повторное сохранение апдейта заменяет прежнее
+        """
+        self.db.create_table(self.user_id)
+        self.db.save_pending_updates([(12, '{"update_id": 12}'), (11, '{"update_id": 11}')])
+        self.db.save_pending_updates([(12, '{"update_id": 12, "x": 1}')])
+        self.assertEqual(self.db.pop_pending_updates(),
+                         ['{"update_id": 11}', '{"update_id": 12, "x": 1}'])
+        self.assertEqual(self.db.pop_pending_updates(), [])
+
+    def test_22_recurring_subtask_of_archived_parent(self):
+        """
+        Тест выполнения повторяющейся подзадачи, чей родитель ушел в архив.
+
+        :assert: Следующее повторение создается задачей верхнего уровня
+        :assert: Оно видно в списке задач
+        """
+        self.db.create_table(self.user_id)
+        parent = self.db.add_task(self.user_id, "Ремонт")
+        rule = make_rule('WEEKLY', date(2030, 1, 7))
+        sub = self.db.add_task(self.user_id, "Полить цветы", None, date(2030, 1, 7), rule,
+                               parent)
+        self.db.mark_done(self.user_id, parent)
+        month_later = datetime.now().timestamp() + 31 * 86400
+        self.assertEqual(self.db.archive_done_tasks(30, now=month_later), 1)
+
+        done, next_task = self.db.complete_task(self.user_id, sub, date(2030, 1, 7))
+        self.assertTrue(done)
+        self.assertIsNotNone(next_task.id)
+        self.assertIsNone(next_task.parent_id)
+        self.assertEqual(next_task.deadline, date(2030, 1, 14))
+        self.assertIn(next_task.id, [task.id for task in self.db.get_subtasks(self.user_id)])
+
+    def test_23_undo_respects_shared_changes(self):
+        """
+        Тест отмены действий над задачами общего списка.
+
+        :assert: Отмена не трогает задачу, чье поддерево потом менял другой участник
+        :assert: Вышедший из списка не может отменить свое действие в нем
+        :assert: Удаленная подзадача не возвращается, если родителя потом удалили
+        :assert: Без чужих изменений отмена работает как прежде
+        """
+        owner, member = self.user_id, self.user_id + 1
+        self.db.create_table(owner)
+        shared = self.db.create_list(owner, "Дача")
+        self.db.join_list(member, shared.invite_code)
+
+        root = self.db.add_task(owner, "Забор", list_id=shared.id)
+        sub = self.db.add_task(member, "Купить краску", parent_id=root)
+        self.db.complete_task(member, sub)
+        self.assertIsNone(self.db.undo_last(owner))
+        self.assertTrue(self.db.leave_list(owner, shared.id))
+        self.assertIsNone(self.db.undo_last(owner))
+        self.assertEqual([task.id for task in self.db.get_subtasks(member, root)], [sub])
+        self.assertIsNotNone(self.db.get_task(member, root))
+
+        self.assertTrue(self.db.delete_task(member, sub))
+        self.db.join_list(owner, shared.invite_code)
+        self.assertTrue(self.db.delete_task(owner, root))
+        self.assertTrue(self.db.leave_list(owner, shared.id))
+        self.assertIsNone(self.db.undo_last(owner))
+        self.assertIsNone(self.db.get_task(member, root))
+
+        self.assertIsNone(self.db.undo_last(member))
+        self.assertIsNone(self.db.get_task(member, sub))
+        other = self.db.add_task(member, "Калитка", list_id=shared.id)
+        self.assertEqual(self.db.undo_last(member), 'add')
+        self.assertIsNone(self.db.get_task(member, other))
+
+    def test_24_repeated_completion_keeps_done_at(self):
+        """
+        Тест повторного выполнения уже выполненной задачи.
+
+        :assert: Повторное выполнение не сдвигает время выполнения
+        :assert: Задача уходит в архив по времени первого выполнения
+        """
+        self.db.create_table(self.user_id)
+        task_id = self.db.add_task(self.user_id, "Позвонить")
+        start = time.time()
+        with mock.patch('time.time', return_value=start):
+            self.assertEqual(self.db.complete_task(self.user_id, task_id), (True, None))
+        with mock.patch('time.time', return_value=start + 20 * 86400):
+            self.assertEqual(self.db.complete_task(self.user_id, task_id), (True, None))
+        self.assertEqual(self.db.archive_done_tasks(30, now=start + 31 * 86400), 1)
+
+
+class DatabaseTest(StoreConformance, unittest.TestCase):
+    """
+    Тесты хранилища задач в SQLite.
+
+    Кроме общих тестов хранилища проверяет то, что есть только
+    у SQLite: пул чтения, миграции схемы и планы запросов.
+    """
+
+    def make_store(self):
+        """
+        Создает временную базу данных и объект Database для тестирования.
+        """
+        self.test_db = 'test_todo.db'
+        return Database(self.test_db)
+
+    def tearDown(self):
+        """
+        Очистка после каждого теста.
+
+        Удаляет временную базу данных, созданную во время теста.
+        """
+        super().tearDown()
+        for path in (self.test_db, self.test_db + '-wal', self.test_db + '-shm'):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def test_7_reads_not_blocked_by_writer(self):
+        """
+        Тест чтения во время открытой транзакции писателя.
+
+        :assert: Чтение не ждет писателя и видит только зафиксированные данные
+        :assert: Соединения пула чтения не позволяют писать
+        """
+        self.db.create_table(self.user_id)
+        self.db.add_task(self.user_id, "Зафиксирована")
+        with self.db._write_connection() as conn:
+            self.db._add_task(conn.cursor(), self.user_id, "Не зафиксирована")
+            tasks = self.db.get_tasks(self.user_id)
+            self.assertEqual([task[2] for task in tasks], ["Зафиксирована"])
+        self.assertEqual(len(self.db.get_tasks(self.user_id)), 2)
+        with self.db._read_connection() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM tasks")
+
+    def test_9_migrates_baseline_schema(self):
+        """
+        Тест миграции базы, созданной до появления архива.
+
+        :assert: Выполненные задачи получают done_at
+        :assert: Версия схемы равна числу миграций
+        :assert: Владельцы задач попадают в реестр пользователей
+        """
+        conn = sqlite3.connect(self.test_db)
+        conn.execute('''
+            CREATE TABLE tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                task_text TEXT NOT NULL,
+                category TEXT,
+                done INTEGER DEFAULT 0,
+                deadline DATE
+            )
+        ''')
+        conn.execute("INSERT INTO tasks (user_id, task_text, done) VALUES (?, 'Старая', 1)",
+                     (self.user_id,))
+        conn.execute("INSERT INTO tasks (user_id, task_text, deadline) "
+                     "VALUES (?, 'Со сроком', '2030-01-15')", (self.user_id,))
+        conn.commit()
+        conn.close()
+
+        self.db.create_table(self.user_id)
+
+        with self.db._read_connection() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            done_at = conn.execute('SELECT done_at FROM tasks').fetchone()[0]
+            stored = conn.execute(
+                'SELECT deadline FROM tasks WHERE deadline IS NOT NULL'
+            ).fetchone()[0]
+        self.assertEqual(version, len(Database.MIGRATIONS))
+        self.assertIsNotNone(done_at)
+        self.assertEqual(stored, (date(2030, 1, 15) - date(1970, 1, 1)).days)
+        self.assertEqual(self.db.get_tasks(self.user_id)[1][5], date(2030, 1, 15))
+        self.assertEqual(self.db.create_broadcast(1, "Новости").total, 1)
+
+    def test_14_due_query_plans(self):
+        """
+        Тест планов запросов по дедлайнам.
+
+        :assert: Запросы используют частичные индексы дедлайнов
+        """
+        self.db.create_table(self.user_id)
+        with self.db._read_connection() as conn:
+            user_plan = str(conn.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM tasks WHERE user_id = ? AND done = 0 '
+                'AND deadline IS NOT NULL AND deadline BETWEEN ? AND ?', (1, 0, 1)
+            ).fetchall())
+            all_plan = str(conn.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM tasks WHERE done = 0 '
+                'AND deadline IS NOT NULL AND deadline BETWEEN ? AND ?', (0, 1)
+            ).fetchall())
+        self.assertIn('idx_tasks_user_pending_deadline', user_plan)
+        self.assertIn('idx_tasks_pending_deadline', all_plan)
+
+    def test_16_progress_query_plan(self):
+        """
+        Тест плана рекурсивного запроса прогресса.
+
+        :assert: Спуск по дереву идет по индексу idx_tasks_parent
+        :assert: Членство в общих списках проверяется по индексу
+        """
+        self.db.create_table(self.user_id)
+        with self.db._read_connection() as conn:
+            plan = str(conn.execute(f'''
+                EXPLAIN QUERY PLAN
+                WITH RECURSIVE tree (root, id, done) AS (
+                    SELECT parent_id, id, done FROM tasks
+                    WHERE parent_id IN (?, ?) AND {TASK_ACCESS}
+                    UNION ALL
+                    SELECT tree.root, t.id, t.done
+                    FROM tasks t JOIN tree ON t.parent_id = tree.id
+                )
+                SELECT root, SUM(done), COUNT(*) FROM tree GROUP BY root
+            ''', (1, 2, 3, 3)).fetchall())
+        self.assertIn('idx_tasks_parent', plan)
+        self.assertIn('idx_list_members_user', plan)
+
+    def test_20_change_feed_across_connections(self):
+        """
+        Тест чтения журнала изменений другим процессом.
+
+        :assert: Другое подключение к файлу видит события по мере фиксации
+        :assert: changes_since читает журнал пакетами, не теряя событий
+        :assert: Событие пишется в одной транзакции с изменением
+        """
+        self.db.create_table(self.user_id)
+        follower = Database(self.test_db, read_pool_size=1)
+        self.addCleanup(follower.close)
+        seq = follower.last_seq()
+        ids = [self.db.add_task(self.user_id, f"Задача {i}") for i in range(5)]
+        events = list(follower.changes_since(seq, batch_size=2))
+        self.assertEqual([event.task_id for event in events], ids)
+
+        with self.assertRaises(sqlite3.Error):
+            with self.db._write_connection() as conn:
+                self.db._delete_task(conn.cursor(), self.user_id, ids[0])
+                conn.execute('INSERT INTO missing_table VALUES (1)')
+        self.assertEqual(list(follower.changes_since(events[-1].seq)), [])
+        self.assertIsNotNone(self.db.get_task(self.user_id, ids[0]))
+
+
+class MemoryStoreTest(StoreConformance, unittest.TestCase):
+    """
+    Тесты хранилища задач в памяти.
+    """
+
+    def make_store(self):
+        return MemoryTaskStore()
+
+    def test_14_build_store(self):
+        """
+        Тест выбора хранилища переменной DB_BACKEND.
+
+        :assert: DB_BACKEND=memory дает хранилище в памяти
+        :assert: Неизвестное хранилище - ошибка
+        :assert: Групповая запись включается только для SQLite
+        """
+        with mock.patch.dict(os.environ, {'DB_BACKEND': 'memory', 'DB_GROUP_COMMIT_MS': '5'}):
+            store = build_store()
+            self.assertIsInstance(store, MemoryTaskStore)
+            self.assertIsNone(build_writer(store))
+        with mock.patch.dict(os.environ, {'DB_BACKEND': 'redis'}):
+            with self.assertRaises(ValueError):
+                build_store()
+
 
 class DateValidationTest(unittest.TestCase):
     """
@@ -357,6 +1039,1624 @@ class StatisticsTest(unittest.TestCase):
         self.assertEqual(percent, 100.0)
 
 
+class SessionTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты сессии Bot API с лимитом конкуренции и склеиванием дублей.
+    """
+
+    async def asyncSetUp(self):
+        """
+        Подменяет сетевой запрос AiohttpSession счетчиком вызовов.
+        """
+        self.calls = []
+        self.active = 0
+        self.peak = 0
+
+        async def fake_request(session, bot, method, timeout=None):
+            self.calls.append(method)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            await asyncio.sleep(0.01)
+            self.active -= 1
+            return True
+
+        patcher = mock.patch.object(AiohttpSession, 'make_request', fake_request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_1_duplicate_answers_coalesced(self):
+        """
+        Два одинаковых ответа на callback уходят одним запросом.
+
+        :assert: На сервер ушел один запрос, оба вызова получили результат
+        """
+        session = TunedSession(coalesce_window=1)
+        method = AnswerCallbackQuery(callback_query_id='cb1')
+        results = await asyncio.gather(
+            session.make_request(None, method),
+            session.make_request(None, AnswerCallbackQuery(callback_query_id='cb1')),
+        )
+        self.assertEqual(results, [True, True])
+        self.assertEqual(len(self.calls), 1)
+
+    async def test_2_different_edits_not_coalesced(self):
+        """
+        Правки с разным текстом для одного сообщения не склеиваются.
+
+        :assert: Каждая правка ушла отдельным запросом
+        """
+        session = TunedSession(coalesce_window=1)
+        await asyncio.gather(
+            session.make_request(None, EditMessageText(text='a', chat_id=1, message_id=1)),
+            session.make_request(None, EditMessageText(text='b', chat_id=1, message_id=1)),
+            session.make_request(None, EditMessageText(text='a', chat_id=1, message_id=1)),
+        )
+        self.assertEqual(len(self.calls), 2)
+
+    async def test_3_concurrency_limited(self):
+        """
+        Число одновременных запросов не превышает max_concurrency.
+
+        :assert: Пиковая конкуренция равна лимиту
+        """
+        session = TunedSession(max_concurrency=3)
+        await asyncio.gather(*[
+            session.make_request(None, SendMessage(chat_id=i, text='x'))
+            for i in range(20)
+        ])
+        self.assertEqual(len(self.calls), 20)
+        self.assertEqual(self.peak, 3)
+
+
+class PriorityLimiterTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты приоритетных полос исходящих запросов.
+    """
+
+    async def test_1_higher_lane_served_first(self):
+        """
+        Освободившийся слот получает самая приоритетная полоса.
+
+        :assert: Порядок запуска: callback, интерактивные, фоновые
+        """
+        limiter = PriorityLimiter(capacity=1)
+        await limiter.acquire(LANE_INTERACTIVE)
+        order = []
+
+        async def worker(lane):
+            await limiter.acquire(lane)
+            order.append(lane)
+            limiter.release()
+
+        tasks = [
+            asyncio.ensure_future(worker(lane))
+            for lane in (LANE_BACKGROUND, LANE_INTERACTIVE, LANE_CALLBACK)
+        ]
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, [LANE_CALLBACK, LANE_INTERACTIVE, LANE_BACKGROUND])
+
+    async def test_2_background_uses_leftover_capacity(self):
+        """
+        Фоновая полоса не занимает зарезервированные слоты.
+
+        :assert: Второй фоновый запрос ждет, интерактивный проходит сразу
+        """
+        limiter = PriorityLimiter(capacity=2, reserved=1)
+        await limiter.acquire(LANE_BACKGROUND)
+        waiting = asyncio.ensure_future(limiter.acquire(LANE_BACKGROUND))
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        await asyncio.wait_for(limiter.acquire(LANE_INTERACTIVE), 1)
+        limiter.release()
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        self.assertEqual(limiter.busy, 1)
+
+    def test_3_histogram_percentiles(self):
+        """
+        Перцентили гистограммы попадают в корзины наблюдений.
+
+        :assert: p50 и p99 равны верхним границам нужных корзин
+        """
+        hist = LatencyHistogram()
+        for _ in range(95):
+            hist.observe(0.004)
+        for _ in range(5):
+            hist.observe(0.8)
+        self.assertEqual(hist.count, 100)
+        self.assertEqual(hist.percentile(50), 0.005)
+        self.assertEqual(hist.percentile(99), 1.0)
+
+    async def test_4_cancel_after_grant(self):
+        """
+        Отмена ожидающего после выдачи слота не теряет слот, а отмена до
+        выдачи не ломает очередь, даже если release() уже вынул future.
+
+        :assert: Слот переходит следующему ожидающему, busy не растет
+        """
+        limiter = PriorityLimiter(capacity=1)
+        await limiter.acquire(LANE_INTERACTIVE)
+        cancelled = asyncio.ensure_future(limiter.acquire(LANE_INTERACTIVE))
+        granted = asyncio.ensure_future(limiter.acquire(LANE_INTERACTIVE))
+        after = asyncio.ensure_future(limiter.acquire(LANE_INTERACTIVE))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        limiter.release()
+        granted.cancel()
+        await asyncio.gather(cancelled, granted, return_exceptions=True)
+        self.assertTrue(cancelled.cancelled())
+        self.assertTrue(granted.cancelled())
+        await asyncio.wait_for(after, 1)
+        self.assertEqual(limiter.busy, 1)
+        self.assertEqual(limiter.pending(), 0)
+        limiter.release()
+        self.assertEqual(limiter.busy, 0)
+
+
+class ShardingTest(unittest.TestCase):
+    """
+    Тесты маршрутизации по шардам и перебалансировки.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmp, 'todo.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_1_user_id_from_raw_update(self):
+        """
+        Тест извлечения user_id из сообщений и callback-запросов.
+
+        :assert: ID берется из поля from события
+        """
+        message = {'update_id': 1, 'message': {'from': {'id': 7}, 'chat': {'id': 8}}}
+        callback = {'update_id': 2, 'callback_query': {'from': {'id': 9}}}
+        self.assertEqual(update_user_id(message), 7)
+        self.assertEqual(update_user_id(callback), 9)
+        self.assertEqual(update_user_id({'update_id': 3}), 0)
+
+    def test_2_shard_is_stable(self):
+        """
+        Тест стабильности и равномерности хеширования.
+
+        :assert: Один пользователь всегда попадает в один шард
+        :assert: Все шарды получают пользователей
+        """
+        shards = [shard_for(user_id, 4) for user_id in range(1000)]
+        self.assertEqual(shards, [shard_for(user_id, 4) for user_id in range(1000)])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+
+    def test_3_rebalance_moves_users_with_ids(self):
+        """
+        Тест перебалансировки с 1 на 3 шарда.
+
+        :assert: Каждый пользователь оказывается в своем новом шарде
+        :assert: ID задач сохраняются
+        """
+        db = prepare_shard(shard_db_name(self.base, 0), 0)
+        ids = {user_id: db.add_task(user_id, f"Задача {user_id}") for user_id in range(30)}
+
+        moved = rebalance(self.base, 1, 3)
+
+        self.assertGreater(moved['tasks'], 0)
+        for user_id, task_id in ids.items():
+            shard = Database(shard_db_name(self.base, shard_for(user_id, 3)))
+            tasks = shard.get_tasks(user_id)
+            self.assertEqual([task[0] for task in tasks], [task_id])
+
+    def test_4_shard_id_ranges_disjoint(self):
+        """
+        Тест непересекающихся диапазонов ID задач у шардов.
+
+        :assert: Задачи разных шардов получают разные ID
+        """
+        first = prepare_shard(shard_db_name(self.base, 0), 0)
+        second = prepare_shard(shard_db_name(self.base, 1), 1)
+        self.assertNotEqual(first.add_task(1, "a"), second.add_task(2, "b"))
+
+    def test_6_invite_shard(self):
+        """
+        Тест поиска шарда общего списка по коду приглашения.
+
+        :assert: Код находится на шарде владельца, неизвестный код - нигде
+        """
+        for index in range(2):
+            prepare_shard(shard_db_name(self.base, index), index).close()
+        db = Database(shard_db_name(self.base, 1))
+        shared = db.create_list(5, "Покупки")
+        db.close()
+        self.assertEqual(invite_shard(self.base, 2, shared.invite_code), 1)
+        self.assertIsNone(invite_shard(self.base, 2, "нет такого"))
+
+    def test_5_rebalance_keeps_sequences_in_range(self):
+        """
+        Тест счетчиков ID после переноса строк из чужих диапазонов.
+
+        :assert: Новые задачи и списки каждого шарда получают ID из его диапазона
+        :assert: ID удаленных задач шарда не переиспользуются
+        """
+        for index in range(2):
+            db = prepare_shard(shard_db_name(self.base, index), index)
+            for user_id in range(40):
+                if shard_for(user_id, 2) == index:
+                    db.add_task(user_id, f"Задача {user_id}")
+                    db.create_list(user_id, f"Список {user_id}")
+            db.close()
+        db = Database(shard_db_name(self.base, 0))
+        latest = db.add_task(0, "Последняя")
+        db.delete_task(0, latest)
+        db.close()
+
+        rebalance(self.base, 2, 3)
+
+        for index in range(3):
+            db = Database(shard_db_name(self.base, index))
+            floor = index << ID_RANGE_BITS
+            task_id = db.add_task(1000 + index, "Новая")
+            list_id = db.create_list(1000 + index, "Новый").id
+            for new_id in (task_id, list_id):
+                self.assertGreater(new_id, floor)
+                self.assertLess(new_id, floor + (1 << ID_RANGE_BITS))
+            if index == 0:
+                self.assertGreater(task_id, latest)
+            db.close()
+
+    def test_7_rebalance_keeps_event_logs(self):
+        """
+        Тест журналов событий шардов при перебалансировке.
+
+        :assert: События не переносятся, на шарде остаются только его пользователи
+        :assert: Номера seq журнала шарда не откатываются назад
+        :assert: Действие, сделанное до переноса, отменить нельзя
+        """
+        db = prepare_shard(shard_db_name(self.base, 0), 0)
+        for user_id in range(30):
+            db.add_task(user_id, f"Задача {user_id}")
+        last = db.last_seq()
+        db.close()
+
+        moved = rebalance(self.base, 1, 3)
+
+        self.assertNotIn('task_events', moved)
+        for index in range(3):
+            db = Database(shard_db_name(self.base, index))
+            events = list(db.changes_since(0))
+            self.assertTrue(all(shard_for(event.user_id, 3) == index for event in events))
+            if index == 0:
+                self.assertTrue(events)
+                db.add_task(1000, "Новая")
+                self.assertGreater(db.last_seq(), last)
+            else:
+                self.assertEqual(events, [])
+                user_id = next(u for u in range(30) if shard_for(u, 3) == index)
+                self.assertIsNone(db.undo_last(user_id))
+            db.close()
+
+
+class BackupTest(unittest.TestCase):
+    """
+    Тесты онлайн-резервных копий и восстановления.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp, 'todo.db')
+        self.db = Database(self.db_name)
+        self.db.create_table(1)
+        self.manager = BackupManager(
+            self.db_name, os.path.join(self.tmp, 'backups'), keep=2, pages=4, pause=0
+        )
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_1_snapshot_during_writes(self):
+        """
+        Тест снимка базы, в которую параллельно идет запись.
+
+        :assert: Копирование не начинается заново из-за записи
+        :assert: Снимок согласован: задачи есть целиком или отсутствуют
+        """
+        for i in range(300):
+            self.db.add_task(1, f"Задача {i} " + "x" * 200)
+        snapshot = os.path.join(self.tmp, 'snapshot.db')
+        writes = []
+
+        def progress_writes():
+            while len(writes) < 50:
+                writes.append(self.db.add_task(1, "Новая задача"))
+
+        with mock.patch('backup.time.sleep', side_effect=lambda _: progress_writes()):
+            steps = copy_database(self.db_name, snapshot, pages=4, pause=0.001)
+
+        total_pages = os.path.getsize(snapshot) // 4096
+        self.assertLessEqual(steps, total_pages // 4 + 1)
+        verify_snapshot(snapshot)
+        copy = sqlite3.connect(snapshot)
+        self.assertEqual(copy.execute("SELECT COUNT(*) FROM tasks").fetchone()[0], 300)
+        copy.close()
+
+    def test_2_rotation_keeps_latest(self):
+        """
+        Тест ротации снимков.
+
+        :assert: Хранятся только keep последних снимков
+        :assert: Снимок - один файл без журнала WAL
+        """
+        self.db.add_task(1, "Задача")
+        for day in (1, 2, 3):
+            self.manager.backup(datetime(2024, 1, day, 3))
+        names = [os.path.basename(path) for path in self.manager.snapshots()]
+        self.assertEqual(names, ['todo-20240103-030000.db', 'todo-20240102-030000.db'])
+        self.assertEqual(sorted(os.listdir(self.manager.directory)), sorted(names))
+
+    def test_3_restore_verifies_snapshot(self):
+        """
+        Тест восстановления базы из снимка.
+
+        :assert: Поврежденный снимок не восстанавливается
+        :assert: Из целого снимка возвращаются удаленные задачи
+        """
+        self.db.add_task(1, "Важная задача")
+        snapshot = self.manager.backup()
+        self.db.clear_all_tasks(1)
+        self.db.close()
+
+        broken = os.path.join(self.tmp, 'broken.db')
+        with open(snapshot, 'rb') as src, open(broken, 'wb') as dst:
+            data = bytearray(src.read())
+            data[4096:8192] = b'\xff' * 4096
+            dst.write(data)
+        with self.assertRaises(BackupError):
+            restore(broken, self.db_name)
+
+        restore(snapshot, self.db_name)
+        self.db = Database(self.db_name)
+        self.assertEqual([task.task_text for task in self.db.get_tasks(1)], ["Важная задача"])
+
+    def test_4_build_backup_from_env(self):
+        """
+        Тест включения резервных копий через окружение.
+
+        :assert: Без BACKUP_DIR и для хранилища в памяти копий нет
+        """
+        with mock.patch.dict(os.environ, {'BACKUP_DIR': self.tmp, 'BACKUP_KEEP': '3'}):
+            manager = build_backup(self.db)
+            self.assertIsNone(build_backup(MemoryTaskStore()))
+        self.assertEqual(manager.keep, 3)
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(build_backup(self.db))
+
+
+class KeyedLockTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты блокировок по ключу.
+    """
+
+    async def test_1_same_key_in_order_and_released(self):
+        """
+        Тест порядка внутри ключа и освобождения памяти.
+
+        :assert: Работы одного ключа выполняются по очереди
+        :assert: После завершения не остается блокировок
+        """
+        locks = KeyedLock()
+        order = []
+
+        async def job(key, n):
+            async with locks.hold(key):
+                await asyncio.sleep(0.01 if n == 0 else 0)
+                order.append((key, n))
+
+        await asyncio.gather(*[job(key, n) for n in range(3) for key in 'ab'])
+        self.assertEqual([n for key, n in order if key == 'a'], [0, 1, 2])
+        self.assertEqual(len(locks), 0)
+
+
+class UserLockMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты последовательной обработки апдейтов одного пользователя.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmp, 'todo.db'))
+        self.db.create_table(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    @staticmethod
+    def data_for(user_id):
+        return {'event_from_user': User(id=user_id, is_bot=False, first_name='u')}
+
+    async def test_1_fast_done_and_delete_taps(self):
+        """
+        Тест двух быстрых нажатий "выполнить" и "удалить" одной задачи.
+
+        :assert: Нажатия обработаны в порядке поступления
+        :assert: Оба действия нашли задачу
+        """
+        middleware = UserLockMiddleware()
+        task_id = self.db.add_task(1, "Задача")
+        results = []
+
+        async def done(event, data):
+            await asyncio.sleep(0.01)
+            results.append(('done', self.db.mark_done(1, task_id)))
+
+        async def delete(event, data):
+            results.append(('delete', self.db.delete_task(1, task_id)))
+
+        await asyncio.gather(
+            middleware(done, None, self.data_for(1)),
+            middleware(delete, None, self.data_for(1)),
+        )
+        self.assertEqual(results, [('done', True), ('delete', True)])
+        self.assertEqual(len(middleware.locks), 0)
+
+    async def test_2_users_processed_in_parallel(self):
+        """
+        Тест параллельной обработки разных пользователей.
+
+        Обработчики ждут общего события, поэтому результат не зависит
+        от скорости машины: считается, сколько из них успело начаться.
+
+        :assert: Обработчики разных пользователей работают одновременно
+        :assert: Обработчики одного пользователя идут по одному
+        """
+        async def entered_before_release(key_of):
+            middleware = UserLockMiddleware()
+            gate = asyncio.Event()
+            entered = []
+
+            async def handler(event, data):
+                entered.append(data['event_from_user'].id)
+                await gate.wait()
+
+            tasks = [
+                asyncio.ensure_future(
+                    middleware(handler, None, self.data_for(key_of(user_id)))
+                )
+                for user_id in range(50)
+            ]
+            for _ in range(5):
+                await asyncio.sleep(0)
+            count = len(entered)
+            gate.set()
+            await asyncio.gather(*tasks)
+            self.assertEqual(len(entered), 50)
+            self.assertEqual(len(middleware.locks), 0)
+            return count
+
+        self.assertEqual(await entered_before_release(lambda user_id: user_id), 50)
+        self.assertEqual(await entered_before_release(lambda user_id: 0), 1)
+
+
+class ThrottlingTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты ограничения частоты нажатий.
+    """
+
+    def setUp(self):
+        self.now = 0.0
+        self.middleware = ThrottlingMiddleware(
+            {'list': (2, 10)}, sweep_interval=30, clock=lambda: self.now
+        )
+
+    def test_1_burst_then_refill(self):
+        """
+        Тест всплеска и восстановления корзины.
+
+        :assert: Третье нажатие подряд отклоняется
+        :assert: Через 5 секунд восстанавливается один токен
+        """
+        self.assertTrue(self.middleware.allow(1, 'list'))
+        self.assertTrue(self.middleware.allow(1, 'list'))
+        self.assertFalse(self.middleware.allow(1, 'list'))
+        self.assertTrue(self.middleware.allow(2, 'list'))
+        self.now = 5.0
+        self.assertTrue(self.middleware.allow(1, 'list'))
+        self.assertFalse(self.middleware.allow(1, 'list'))
+
+    def test_2_unlimited_actions_and_sweep(self):
+        """
+        Тест действий без лимита и очистки старых записей.
+
+        :assert: Действия без лимита не учитываются
+        :assert: Восстановившиеся корзины удаляются
+        """
+        for _ in range(10):
+            self.assertTrue(self.middleware.allow(1, 'done_5'))
+        self.middleware.allow(1, 'list')
+        self.assertEqual(len(self.middleware.buckets), 1)
+        self.now = 31.0
+        self.middleware.allow(2, 'list')
+        self.assertEqual(list(self.middleware.buckets), [(2, 'list')])
+
+    async def test_3_throttled_callback_answered(self):
+        """
+        Тест ответа на отклоненное нажатие без вызова обработчика.
+
+        :assert: Обработчик вызван дважды из трех
+        :assert: Третье нажатие получило ответ
+        """
+        calls = []
+        answers = []
+
+        async def handler(event, data):
+            calls.append(event)
+
+        event = mock.Mock(data='list')
+        event.answer = mock.AsyncMock(side_effect=lambda text: answers.append(text))
+        data = {'event_from_user': User(id=1, is_bot=False, first_name='u')}
+        for _ in range(3):
+            await self.middleware(handler, event, data)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(answers), 1)
+
+    def test_4_parse_limits(self):
+        """
+        Тест разбора строки лимитов.
+
+        :assert: Лимиты разобраны по действиям
+        """
+        self.assertEqual(
+            parse_throttle_limits('list=5/10, stats=3/2.5'),
+            {'list': (5, 10.0), 'stats': (3, 2.5)}
+        )
+
+
+class GroupCommitWriterTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты групповой записи изменений.
+    """
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmp, 'todo.db'))
+        self.db.create_table(1)
+        self.writer = GroupCommitWriter(self.db, max_batch=50, max_delay=0.01)
+        self.writer.start()
+
+    async def asyncTearDown(self):
+        await self.writer.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    async def test_1_concurrent_writes_batched(self):
+        """
+        Тест объединения одновременных изменений в пакеты.
+
+        :assert: Каждый вызов получил свой ID задачи
+        :assert: Пакетов меньше, чем операций
+        :assert: Все задачи видны в базе после фиксации
+        """
+        ids = await asyncio.gather(*[
+            self.writer.add_task(1, f"Задача {i}") for i in range(120)
+        ])
+        self.assertEqual(len(set(ids)), 120)
+        self.assertLessEqual(self.writer.batches, 5)
+        self.assertEqual(len(self.db.get_tasks(1)), 120)
+
+    async def test_2_failed_operation_isolated(self):
+        """
+        Тест изоляции ошибочной операции в пакете.
+
+        :assert: Ошибочная операция получила исключение
+        :assert: Остальные операции пакета зафиксированы
+        """
+        results = await asyncio.gather(
+            self.writer.add_task(1, "Первая"),
+            self.writer.add_task(1, None),
+            self.writer.add_task(1, "Вторая"),
+            return_exceptions=True,
+        )
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual(
+            [task[2] for task in self.db.get_tasks(1)], ["Первая", "Вторая"]
+        )
+
+    async def test_3_results_match_database_methods(self):
+        """
+        Тест результатов операций, совпадающих с методами Database.
+
+        :assert: mark_done и delete_task возвращают True/False
+        :assert: clear_all_tasks возвращает число удаленных задач
+        """
+        task_id = await self.writer.add_task(1, "Задача")
+        self.assertTrue(await self.writer.mark_done(1, task_id))
+        self.assertFalse(await self.writer.mark_done(1, 999))
+        await self.writer.add_task(1, "Еще одна")
+        self.assertTrue(await self.writer.delete_task(1, task_id))
+        self.assertEqual(await self.writer.clear_all_tasks(1), 1)
+
+    async def test_4_shared_list_operations(self):
+        """
+        Тест операций общих списков через групповую запись.
+
+        :assert: Вступивший видит число участников с учетом себя
+        :assert: Список без участников удаляется
+        """
+        shared = await self.writer.create_list(1, "Покупки")
+        task_list, joined = await self.writer.join_list(2, shared.invite_code)
+        self.assertTrue(joined)
+        self.assertEqual(task_list, shared._replace(members=2))
+        self.assertEqual(await self.writer.join_list(2, "нет такого"), (None, False))
+        self.assertTrue(await self.writer.leave_list(1, shared.id))
+        self.assertTrue(await self.writer.leave_list(2, shared.id))
+        self.assertEqual(self.db.get_lists(2), [])
+
+
+class ReminderBucketTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты напоминаний, сгруппированных по часовым поясам.
+    """
+
+    async def asyncSetUp(self):
+        self.db = MemoryTaskStore()
+        self.bot = mock.AsyncMock()
+        with mock.patch.dict(os.environ, {'DEFAULT_TZ': 'UTC', 'REMINDER_HOUR': '9'}):
+            self.scheduler = ReminderScheduler(self.bot, self.db)
+
+    def test_1_offset_changes_with_dst(self):
+        """
+        Тест смещения пояса с учетом летнего времени.
+
+        :assert: Смещение Нью-Йорка зимой и летом различается на час
+        """
+        winter = datetime(2030, 1, 15, tzinfo=timezone.utc)
+        summer = datetime(2030, 7, 15, tzinfo=timezone.utc)
+        self.assertEqual(utc_offset_minutes('America/New_York', winter), -300)
+        self.assertEqual(utc_offset_minutes('America/New_York', summer), -240)
+        self.assertEqual(utc_offset_minutes('Asia/Kolkata', winter), 330)
+
+    async def test_2_one_job_per_offset(self):
+        """
+        Тест заданий групп напоминаний.
+
+        :assert: На каждое смещение одно задание, а не задание на задачу
+        :assert: Задание срабатывает каждый час в начале местного часа
+        :assert: Смещения пользователей обновляются при переходе на летнее время
+        """
+        winter = datetime(2030, 1, 15, tzinfo=timezone.utc)
+        self.db.set_user_tz(1, 'Europe/Moscow', 180)
+        self.db.set_user_tz(2, 'Europe/Moscow', 180)
+        self.db.set_user_tz(3, 'America/New_York', -240)
+        for user_id in (1, 2, 3):
+            self.db.add_task(user_id, "Задача", None, date(2030, 1, 16))
+
+        offsets = self.scheduler.sync_buckets(winter)
+
+        self.assertEqual(offsets, {0, 180, -300})
+        jobs = {job.id: job for job in self.scheduler.scheduler.get_jobs()}
+        self.assertEqual(set(jobs), {'bucket_0', 'bucket_180', 'bucket_-300'})
+        self.assertEqual(str(jobs['bucket_180'].trigger), "cron[minute='0']")
+        self.scheduler.ensure_bucket(330)
+        self.assertEqual(str(self.scheduler.scheduler.get_job('bucket_330').trigger),
+                         "cron[minute='30']")
+        self.assertEqual(self.db.get_timezones()['America/New_York'], -300)
+
+    async def test_3_bucket_sends_tomorrow_tasks(self):
+        """
+        Тест срабатывания группы напоминаний.
+
+        :assert: Отправляются задачи группы со сроком на завтра по местной дате
+        :assert: Задачи других поясов и выполненные задачи не отправляются
+        :assert: Пользователи без своего пояса попадают в группу пояса по умолчанию
+        """
+        self.db.set_user_tz(1, 'Asia/Tokyo', 540)
+        self.db.set_user_tz(2, 'America/New_York', -300)
+        tokyo = self.db.add_task(1, "Токио", None, date(2030, 1, 17))
+        self.db.add_task(2, "Нью-Йорк", None, date(2030, 1, 17))
+        done = self.db.add_task(1, "Сделано", None, date(2030, 1, 17))
+        self.db.mark_done(1, done)
+        default = self.db.add_task(3, "По умолчанию", None, date(2030, 1, 16))
+
+        # 2030-01-16 00:00 UTC: в Токио уже 09:00 16-го, завтра - 17-е
+        now = datetime(2030, 1, 16, 0, 0, tzinfo=timezone.utc)
+        self.assertEqual(await self.scheduler._fire_bucket(540, now), 1)
+        sent = self.bot.send_message.await_args_list
+        self.assertEqual(sent[0].args[0], 1)
+        self.assertIn(f"ID: {tokyo}", sent[0].args[1])
+
+        self.bot.send_message.reset_mock()
+        # 2030-01-15 09:00 UTC - утро 15-го в поясе по умолчанию
+        now = datetime(2030, 1, 15, 9, 0, tzinfo=timezone.utc)
+        self.assertEqual(await self.scheduler._fire_bucket(0, now), 1)
+        self.assertIn(f"ID: {default}", self.bot.send_message.await_args.args[1])
+
+    async def test_4_reminder_offsets(self):
+        """
+        Тест нескольких смещений напоминаний одной задачи.
+
+        :assert: Каждое смещение отправляется в свой час и один раз
+        :assert: Смещения, не включенные у задачи, не отправляются
+        :assert: Повторение задачи сохраняет ее смещения
+        """
+        mask = parse_reminders('1w, 1d, 1h')
+        self.assertEqual(mask, REMIND_1W | REMIND_1D | REMIND_1H)
+        with self.assertRaises(ValueError):
+            parse_reminders('2d')
+        task = self.db.add_task(1, "Отчет", None, date(2030, 1, 22), 'FREQ=WEEKLY',
+                                reminders=mask)
+
+        week_before = datetime(2030, 1, 15, 9, 0, tzinfo=timezone.utc)
+        self.assertEqual(await self.scheduler._fire_bucket(0, week_before), 1)
+        self.assertIn("неделя", self.bot.send_message.await_args.args[1])
+        self.assertEqual(await self.scheduler._fire_bucket(0, week_before), 0)
+        three_days = datetime(2030, 1, 19, 9, 0, tzinfo=timezone.utc)
+        self.assertEqual(await self.scheduler._fire_bucket(0, three_days), 0)
+        evening = datetime(2030, 1, 22, 21, 0, tzinfo=timezone.utc)
+        self.assertEqual(await self.scheduler._fire_bucket(0, evening), 0)
+        last_hour = datetime(2030, 1, 22, 23, 0, tzinfo=timezone.utc)
+        self.assertEqual(await self.scheduler._fire_bucket(0, last_hour), 1)
+        self.assertIn("остался час", self.bot.send_message.await_args.args[1])
+
+        _, next_task = self.db.complete_task(1, task, date(2030, 1, 22))
+        self.assertEqual(next_task.reminders, mask)
+
+    async def test_5_stale_reminders_and_snooze(self):
+        """
+        Тест проверки задачи перед отправкой и кнопок "отложить".
+
+        :assert: О выполненной или удаленной задаче напоминание не отправляется
+        :assert: Напоминание несет кнопки snooze_<ID>_<минуты>
+        :assert: Повторное откладывание переносит одно задание, а не добавляет второе
+        :assert: Отложенные напоминания разных пользователей не заменяют друг друга
+        """
+        task = self.db.add_task(1, "Позвонить", None, date(2030, 1, 16))
+        self.assertTrue(await self.scheduler._send_reminder(1, task, "Позвонить"))
+        markup = self.bot.send_message.await_args.kwargs['reply_markup']
+        self.assertEqual(markup.inline_keyboard[0][0].callback_data, f"snooze_{task}_60")
+
+        self.scheduler.scheduler.start(paused=True)
+        self.addCleanup(self.scheduler.scheduler.shutdown, wait=False)
+        now = datetime(2030, 1, 15, 9, 0, tzinfo=timezone.utc)
+        self.scheduler.snooze(1, task, "Позвонить", 60, now)
+        later = self.scheduler.snooze(1, task, "Позвонить", 180, now)
+        jobs = self.scheduler.scheduler.get_jobs()
+        self.assertEqual([job.id for job in jobs], [f'snooze_1_{task}'])
+        self.assertEqual(jobs[0].trigger.run_date, later)
+        self.scheduler.snooze(2, task, "Позвонить", 60, now)
+        self.assertEqual(len(self.scheduler.scheduler.get_jobs()), 2)
+        self.scheduler.scheduler.remove_job(f'snooze_2_{task}')
+
+        self.db.mark_done(1, task)
+        self.bot.send_message.reset_mock()
+        self.assertFalse(await self.scheduler._send_reminder(1, task, "Позвонить", None))
+        self.assertFalse(await self.scheduler._send_reminder(1, task + 1, "Удаленная"))
+        self.bot.send_message.assert_not_awaited()
+
+    async def test_6_reminders_marked_while_sending(self):
+        """
+        Тест отметки напоминаний по ходу рассылки группы.
+
+        :assert: Пачка отправленных напоминаний отмечается, пока остальные еще отправляются
+        :assert: При отмене рассылки отмечаются все отправленные напоминания
+        """
+        self.scheduler.MARK_BATCH = 2
+        for user_id in range(1, 6):
+            self.db.add_task(user_id, "Задача", None, date(2030, 1, 16))
+        hang = asyncio.Event()
+
+        async def send_message(user_id, text, **kwargs):
+            if user_id > 3:
+                await hang.wait()
+
+        self.bot.send_message.side_effect = send_message
+        now = datetime(2030, 1, 15, 9, 0, tzinfo=timezone.utc)
+        fire = asyncio.ensure_future(self.scheduler._fire_bucket(0, now))
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+
+        def due():
+            return {task.user_id for task in self.db.get_due_in_bucket(
+                date(2030, 1, 16), 0, self.scheduler.default_offset, REMIND_1D
+            )}
+
+        self.assertEqual(len(due()), 3)
+        fire.cancel()
+        await asyncio.gather(fire, return_exceptions=True)
+        self.assertEqual(due(), {4, 5})
+
+
+class ListNotifierTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты уведомлений участников общих списков.
+    """
+
+    async def asyncSetUp(self):
+        self.db = MemoryTaskStore()
+        self.bot = mock.AsyncMock()
+        self.shared = self.db.create_list(1, "Покупки")
+        for user_id in (2, 3):
+            self.db.join_list(user_id, self.shared.invite_code)
+
+    async def test_1_edits_coalesce_per_member(self):
+        """
+        Тест склейки изменений в окне.
+
+        :assert: Несколько правок за окно - одно сообщение каждому участнику
+        :assert: Автор не получает уведомление о своих правках
+        """
+        notifier = ListNotifier(self.bot, self.db, window=0.05)
+        notifier.notify(self.shared.id, 1, "➕ Молоко")
+        notifier.notify(self.shared.id, 1, "➕ Хлеб")
+        notifier.notify(self.shared.id, 2, "✅ Молоко")
+        self.bot.send_message.assert_not_awaited()
+        await asyncio.sleep(0.1)
+
+        sent = {call.args[0]: call.args[1] for call in self.bot.send_message.await_args_list}
+        self.assertEqual(self.bot.send_message.await_count, 3)
+        self.assertEqual(notifier.sent, 3)
+        self.assertTrue(sent[1].endswith(":\n✅ Молоко"))
+        self.assertTrue(sent[2].endswith(":\n➕ Молоко\n➕ Хлеб"))
+        self.assertTrue(sent[3].endswith(":\n➕ Молоко\n➕ Хлеб\n✅ Молоко"))
+
+    async def test_2_close_flushes_pending(self):
+        """
+        Тест рассылки накопленного при остановке.
+
+        :assert: close() рассылает изменения, не дожидаясь окна
+        :assert: Ошибка отправки одному участнику не мешает остальным
+        """
+        self.bot.send_message.side_effect = [Exception("blocked"), None]
+        notifier = ListNotifier(self.bot, self.db, window=60)
+        notifier.notify(self.shared.id, 1, "🗑️ Молоко")
+        await notifier.close()
+        self.assertEqual(self.bot.send_message.await_count, 2)
+        self.assertEqual(notifier.sent, 1)
+
+    async def test_3_message_within_limit(self):
+        """
+        Тест длинной серии изменений за одно окно.
+
+        :assert: Сообщение не длиннее предела Bot API
+        :assert: Не поместившиеся изменения сведены в строку с их числом
+        """
+        notifier = ListNotifier(self.bot, self.db, window=60)
+        for i in range(300):
+            notifier.notify(self.shared.id, 1, f"➕ Очень длинное название задачи номер {i}")
+        await notifier.close()
+        text = self.bot.send_message.await_args.args[1]
+        self.assertLessEqual(len(text), MESSAGE_LIMIT)
+        self.assertRegex(text, r"…и еще изменений: \d+$")
+
+
+
+class BroadcasterTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты рассылок администратора.
+    """
+
+    async def asyncSetUp(self):
+        self.db = MemoryTaskStore()
+        for user_id in range(1, 21):
+            self.db.register_user(user_id)
+        self.delivered = []
+        self.bot = mock.AsyncMock()
+
+    async def test_1_throttled_fanout(self):
+        """
+        Тест рассылки с ограничением темпа.
+
+        :assert: Темп не выше rate сообщений в секунду
+        :assert: После RetryAfter сообщение отправляется повторно
+        :assert: Заблокировавший бота помечается и пропускается следующей рассылкой
+        :assert: Автор получает сводку
+        """
+        method = SendMessage(chat_id=1, text="x")
+        retried = set()
+
+        async def send(user_id, text):
+            if user_id == 5:
+                raise TelegramForbiddenError(method, "bot was blocked by the user")
+            if user_id == 7 and user_id not in retried:
+                retried.add(user_id)
+                raise TelegramRetryAfter(method, "Flood control", 0)
+            self.delivered.append(user_id)
+
+        self.bot.send_message.side_effect = send
+        broadcaster = Broadcaster(self.bot, self.db, rate=200, workers=4, batch=3)
+        broadcast = self.db.create_broadcast(99, "Новости")
+        started = time.monotonic()
+        done = await broadcaster.run(broadcast)
+
+        self.assertGreaterEqual(time.monotonic() - started, 20 / 200)
+        self.assertEqual((done.sent, done.blocked, done.pending, done.finished),
+                         (19, 1, 0, True))
+        self.assertEqual(sorted(self.delivered[:-1]), [u for u in range(1, 21) if u != 5])
+        self.assertEqual(self.delivered[-1], 99)
+        self.assertEqual(self.db.create_broadcast(99, "Еще").total, 19)
+
+    async def test_2_resume_after_stop(self):
+        """
+        Тест продолжения прерванной рассылки.
+
+        :assert: При остановке записан ход рассылки
+        :assert: После запуска рассылка продолжается без повторов
+        """
+        async def send(user_id, text):
+            await asyncio.sleep(0.005)
+            self.delivered.append(user_id)
+
+        self.bot.send_message.side_effect = send
+        broadcaster = Broadcaster(self.bot, self.db, rate=1000, workers=2, batch=2)
+        broadcast = await broadcaster.start(99, "Новости")
+        while len(self.delivered) < 6:
+            await asyncio.sleep(0.005)
+        await broadcaster.close()
+
+        stopped = self.db.get_broadcast(broadcast.id)
+        self.assertFalse(stopped.finished)
+        self.assertEqual(stopped.sent, len(self.delivered))
+        self.assertGreater(stopped.pending, 0)
+
+        resumed = Broadcaster(self.bot, self.db, rate=1000, workers=2, batch=2)
+        self.assertEqual([b.id for b in await resumed.resume()], [broadcast.id])
+        while resumed._tasks:
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.delivered[:-1], sorted(self.delivered[:-1]))
+        self.assertEqual(sorted(self.delivered[:-1]), list(range(1, 21)))
+        self.assertTrue(self.db.get_broadcast(broadcast.id).finished)
+
+
+class ReplayTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты записи и воспроизведения апдейтов.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'updates.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    @staticmethod
+    def make_update(update_id, user_id, text):
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': 1700000000, 'text': text,
+            'chat': {'id': user_id, 'type': 'private', 'username': 'alice'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Алиса',
+                     'username': 'alice'},
+        }}
+
+    def test_1_anonymize_update(self):
+        """
+        Тест обезличивания апдейта.
+
+        :assert: ID пользователя и его чата заменяются одним псевдонимом
+        :assert: Имена и username удаляются, текст сохраняется
+        :assert: Другая соль дает другой псевдоним
+        """
+        update = self.make_update(1, 777, "Купить хлеб")
+        update['message']['reply_to_message'] = {'chat': {'id': -100, 'type': 'group',
+                                                          'title': 'Семья'}}
+        anonymous = anonymize_update(update, b'salt')
+        message = anonymous['message']
+        self.assertEqual(message['from']['id'], message['chat']['id'])
+        self.assertNotEqual(message['from']['id'], 777)
+        self.assertEqual(message['from']['first_name'], 'user')
+        self.assertNotIn('username', message['from'])
+        self.assertNotIn('username', message['chat'])
+        self.assertEqual(message['text'], "Купить хлеб")
+        self.assertLess(message['reply_to_message']['chat']['id'], 0)
+        self.assertNotIn('title', message['reply_to_message']['chat'])
+        self.assertEqual(update['message']['from']['id'], 777)
+        self.assertNotEqual(anonymous_id(777, b'other'), message['from']['id'])
+
+    async def test_2_record_and_replay(self):
+        """
+        Тест записи апдейтов и их воспроизведения.
+
+        :assert: Запись - склейка gzip-фрагментов, читаются все апдейты
+        :assert: Воспроизведение проходит по тем же обработчикам
+        :assert: Запросы к базе относятся к обработчику, который их выполнил
+        """
+        recorder = RecordingMiddleware(self.path, b'salt', flush_interval=0.01, batch=3)
+        dp = Dispatcher()
+        dp.update.outer_middleware(recorder)
+        seen = []
+
+        @dp.message()
+        async def handle_text(message):
+            seen.append(message.from_user.id)
+
+        bot = Bot('42:TEST', session=StubSession())
+        for i in range(10):
+            await dp.feed_raw_update(bot, self.make_update(i, 100 + i % 2, f"Задача {i}"))
+        recorder.close()
+        self.assertEqual(recorder.recorded, 10)
+        with open(self.path, 'rb') as f:
+            self.assertGreater(f.read().count(b'\x1f\x8b'), 1)
+        records = list(read_updates(self.path))
+        self.assertEqual([update['update_id'] for _, update in records], list(range(10)))
+        self.assertEqual(len({update['message']['from']['id'] for _, update in records}), 2)
+
+        stats = ReplayStats()
+        db = Database(os.path.join(self.tmp, 'replay.db'), trace=stats.trace)
+        db.create_table(None)
+        replay_dp = Dispatcher()
+        stats.attach(replay_dp)
+
+        @replay_dp.message()
+        async def add_from_message(message):
+            db.add_task(message.from_user.id, message.text)
+
+        await replay(replay_dp, bot, self.path, speed=0, concurrency=4, stats=stats)
+        db.close()
+
+        self.assertEqual((len(stats.updates), stats.errors), (10, 0))
+        latencies, queries = stats.handlers['add_from_message']
+        self.assertEqual(len(latencies), 10)
+        self.assertGreater(queries[0], 10)
+        self.assertLessEqual(queries[0], stats.queries)
+        self.assertIn('add_from_message', stats.report())
+
+    def test_3_anonymize_forwarded_message(self):
+        """
+        Тест обезличивания пересланного сообщения и контакта.
+
+        :assert: ID автора пересылки, бота и участников заменяются псевдонимами
+        :assert: Имена, username, телефон и vCard не попадают в запись
+        :assert: Обезличенный апдейт по-прежнему разбирается aiogram
+        """
+        author = {'id': 555, 'is_bot': False, 'first_name': 'Борис',
+                  'last_name': 'Петров', 'username': 'boris'}
+        update = self.make_update(1, 777, "Купить хлеб")
+        update['message'].update({
+            'forward_origin': {'type': 'user', 'date': 1700000000, 'sender_user': author},
+            'forward_from': author,
+            'forward_sender_name': 'Борис Петров',
+            'via_bot': {'id': 999, 'is_bot': True, 'first_name': 'Бот',
+                        'username': 'some_bot'},
+            'new_chat_members': [author],
+            'left_chat_member': author,
+            'contact': {'phone_number': '+79990001122', 'first_name': 'Борис',
+                        'last_name': 'Петров', 'user_id': 555,
+                        'vcard': 'BEGIN:VCARD\nTEL:+79990001122\nEND:VCARD'},
+        })
+        anonymous = anonymize_update(update, b'salt')
+        message = anonymous['message']
+        alias = anonymous_id(555, b'salt')
+        for user in (message['forward_origin']['sender_user'], message['forward_from'],
+                     message['new_chat_members'][0], message['left_chat_member']):
+            self.assertEqual(user, {'id': alias, 'is_bot': False, 'first_name': 'user'})
+        self.assertEqual(message['via_bot']['id'], anonymous_id(999, b'salt'))
+        self.assertEqual(message['contact'], {'phone_number': '', 'first_name': 'user',
+                                              'user_id': alias})
+        dump = json.dumps(anonymous, ensure_ascii=False)
+        for secret in ('555', 'Борис', 'Петров', 'boris', '79990001122', 'some_bot'):
+            self.assertNotIn(secret, dump)
+        self.assertEqual(Update.model_validate(anonymous).message.text, "Купить хлеб")
+
+
+class LoggingTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты неблокирующих структурированных логов.
+    """
+
+    def setUp(self):
+        root = logging.getLogger()
+        self.saved = root.handlers[:], root.level
+
+    def tearDown(self):
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        for handler in self.saved[0]:
+            root.addHandler(handler)
+        root.setLevel(self.saved[1])
+
+    async def test_1_json_with_correlation_id(self):
+        """
+        Тест записи логов через очередь в JSON.
+
+        :assert: Запись содержит отформатированное сообщение и уровень
+        :assert: Запись внутри апдейта помечена его update_id
+        """
+        stream = io.StringIO()
+        listener = configure_logging(stream=stream)
+
+        async def handler(event, data):
+            logging.info('задача %s добавлена', 7)
+
+        await CorrelationMiddleware()(handler, mock.Mock(update_id=42), {})
+        logging.warning('вне апдейта')
+        listener.stop()
+
+        first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(first['msg'], 'задача 7 добавлена')
+        self.assertEqual(first['level'], 'INFO')
+        self.assertEqual(first['cid'], '42')
+        self.assertEqual(second['cid'], '-')
+        self.assertEqual(correlation_id.get(), '-')
+
+    def test_2_sampling(self):
+        """
+        Тест сэмплирования частых записей.
+
+        :assert: Из частых INFO записей проходит каждая десятая
+        :assert: Редкий шаблон не вытесняется частым
+        :assert: WARNING проходят всегда
+        """
+        sampling = SamplingFilter(0.1)
+
+        def record(level, msg):
+            return logging.LogRecord('bot', level, __file__, 1, msg, (), None)
+
+        passed = sum(sampling.filter(record(logging.INFO, 'частое %s')) for _ in range(100))
+        self.assertEqual(passed, 10)
+        self.assertTrue(sampling.filter(record(logging.INFO, 'редкое')))
+        self.assertTrue(all(
+            sampling.filter(record(logging.WARNING, 'ошибка')) for _ in range(20)
+        ))
+
+    def test_3_exception_through_queue(self):
+        """
+        Тест записи исключения через очередь.
+
+        :assert: Трассировка попадает в поле exc, а не в текст сообщения
+        """
+        stream = io.StringIO()
+        listener = configure_logging(stream=stream)
+        try:
+            raise ValueError('сбой')
+        except ValueError:
+            logging.exception('не удалось добавить задачу %s', 7)
+        listener.stop()
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry['msg'], 'не удалось добавить задачу 7')
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertIn('Traceback', entry['exc'])
+        self.assertIn('ValueError: сбой', entry['exc'])
+
+
+class ProfilingTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты профилирования окна апдейтов.
+    """
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.profiler = ProfilingMiddleware(out_dir=self.tmp, top=10)
+
+    async def asyncTearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    async def test_1_disabled_passes_through(self):
+        """
+        Тест выключенного профилирования.
+
+        :assert: Апдейт обрабатывается, профиль не создается
+        """
+        handler = mock.AsyncMock(return_value='ok')
+        self.assertEqual(await self.profiler(handler, object(), {}), 'ok')
+        self.assertFalse(self.profiler.active)
+        self.assertIsNone(self.profiler.task)
+
+    async def test_2_window_writes_report(self):
+        """
+        Тест окна профилирования из N апдейтов.
+
+        :assert: После N апдейтов профилирование выключается
+        :assert: В каталоге появляются pstats и снимок памяти
+        :assert: Отчет с горячими функциями уходит в чат администратора
+        """
+        def hot_function():
+            return sum(i * i for i in range(20000))
+
+        async def handler(event, data):
+            return hot_function()
+
+        bot = mock.AsyncMock()
+        self.profiler.start(3, chat_id=99)
+        for _ in range(3):
+            await self.profiler(handler, object(), {'bot': bot})
+        self.assertFalse(self.profiler.active)
+        report = await self.profiler.task
+
+        files = sorted(os.listdir(self.tmp))
+        self.assertTrue(any(name.endswith('.pstats') for name in files))
+        self.assertTrue(any(name.endswith('.snapshot') for name in files))
+        self.assertIn('hot_function', report)
+        self.assertEqual(bot.send_message.await_args.args[0], 99)
+        self.assertEqual(await self.profiler(handler, object(), {}), hot_function())
+
+    async def test_3_stop_and_admin_ids(self):
+        """
+        Тест досрочной остановки и списка администраторов.
+
+        :assert: Остановка пустого окна не пишет файлов
+        :assert: Повторный запуск во время окна запрещен
+        :assert: Список ID разбирается из строки окружения
+        """
+        self.profiler.start(5)
+        with self.assertRaises(RuntimeError):
+            self.profiler.start(5)
+        self.assertIn('пуст', await self.profiler.stop())
+        self.assertEqual(os.listdir(self.tmp), [])
+        self.assertEqual(parse_admin_ids('1, 2,,3'), {1, 2, 3})
+        self.assertEqual(parse_admin_ids(''), frozenset())
+
+
+class FakeTelegram:
+    """
+    Локальный Bot API с очередью апдейтов для проверки перезапуска бота.
+
+    Как и Telegram, отдает апдейты, начиная с последнего подтвержденного
+    offset, и запоминает все отправленные ботом сообщения.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.updates = []
+        self.confirmed = 0
+        self.sent = []
+        self._runner = None
+
+    def add_start_updates(self, user_ids):
+        for user_id in user_ids:
+            update_id = len(self.updates) + 1
+            self.updates.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+                'text': '/start',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+            }})
+
+    async def _handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info['method']
+        form = await request.post()
+        if method == 'getMe':
+            result = {'id': 42, 'is_bot': True, 'first_name': 'test', 'username': 'test_bot'}
+        elif method == 'getUpdates':
+            offset = int(form.get('offset') or 0)
+            self.confirmed = max(self.confirmed, offset)
+            result = [u for u in self.updates if u['update_id'] >= self.confirmed]
+            result = result[:int(form.get('limit') or 100)]
+            if not result:
+                await asyncio.sleep(min(float(form.get('timeout') or 0), 0.2))
+        elif method == 'sendMessage':
+            chat_id = int(form['chat_id'])
+            self.sent.append((chat_id, form['text']))
+            await asyncio.sleep(self.latency)
+            result = {'message_id': len(self.sent), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': form['text']}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class LifecycleTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты плавной остановки и перезапуска бота.
+    """
+
+    async def test_1_inflight_ack_offset(self):
+        """
+        Тест учета обрабатываемых апдейтов.
+
+        :assert: Подтверждаются все полученные апдейты, в том числе обрабатываемые
+        :assert: Обрабатываемый апдейт виден в unfinished для сохранения
+        :assert: drain дожидается обработки
+        """
+        inflight = InFlightMiddleware()
+        self.assertIsNone(inflight.ack_offset())
+        release = asyncio.Event()
+
+        async def slow(event, data):
+            await release.wait()
+
+        async def fast(event, data):
+            return None
+
+        task = asyncio.ensure_future(inflight(slow, Update(update_id=5), {}))
+        await inflight(fast, Update(update_id=6), {})
+        await asyncio.sleep(0)
+        self.assertEqual(inflight.ack_offset(), 7)
+        self.assertEqual([update_id for update_id, _ in inflight.unfinished()], [5])
+        self.assertFalse(await inflight.drain(0.01))
+        release.set()
+        self.assertTrue(await inflight.drain(1))
+        await task
+        self.assertEqual(inflight.unfinished(), [])
+        self.assertEqual(inflight.ack_offset(), 7)
+
+    @unittest.skipIf(sys.platform == 'win32', 'нужен SIGTERM')
+    async def test_2_sigterm_mid_burst(self):
+        """
+        Тест остановки по SIGTERM посреди потока апдейтов и напоминаний.
+
+        Бот запускается, получает первую волну /start и рассылает
+        напоминания, посреди этого получает SIGTERM. Затем бот
+        перезапускается и обрабатывает вторую волну и новые напоминания.
+
+        :assert: Каждый апдейт обработан ровно один раз
+        :assert: Каждое напоминание отправлено ровно один раз
+        """
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        tomorrow = datetime.now(timezone.utc).date() + timedelta(days=1)
+        db = Database(os.path.join(tmp, 'todo_bot.db'))
+        db.create_table(None)
+        first_reminders = [db.add_task(1000 + i, f"Задача {i}", None, tomorrow)
+                           for i in range(20)]
+        db.close()
+
+        fake = FakeTelegram(latency=0.05)
+        url = await fake.start()
+        self.addAsyncCleanup(fake.stop)
+        fake.add_start_updates(range(1, 31))
+        env = dict(
+            os.environ, BOT_TOKEN='42:TEST', BOT_API_SERVER=url, DEFAULT_TZ='UTC',
+            REMINDER_HOUR='0', BOT_API_CONCURRENCY='4', BOT_API_RESERVED='1',
+            LOG_LEVEL='WARNING', SHUTDOWN_TIMEOUT='30', DB_GROUP_COMMIT_MS='5',
+        )
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+        log = open(os.path.join(tmp, 'bot.log'), 'wb')
+        self.addCleanup(log.close)
+
+        async def run_until(condition):
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, main_path, cwd=tmp, env=env, stdout=log, stderr=log
+            )
+            try:
+                for _ in range(600):
+                    if condition() or proc.returncode is not None:
+                        break
+                    await asyncio.sleep(0.05)
+                at_signal = len(fake.sent)
+                proc.send_signal(signal.SIGTERM)
+                await asyncio.wait_for(proc.wait(), 60)
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+            return proc.returncode, at_signal
+
+        def greetings():
+            return [chat for chat, text in fake.sent if text.startswith('Привет')]
+
+        code, at_signal = await run_until(lambda: len(greetings()) >= 3)
+        self.assertEqual(code, 0)
+        self.assertLess(at_signal, 50, 'SIGTERM должен прийти посреди потока')
+        self.assertEqual(len(fake.sent), 50, 'начатая работа должна завершиться')
+
+        fake.add_start_updates(range(31, 41))
+        db = Database(os.path.join(tmp, 'todo_bot.db'))
+        second_reminders = [db.add_task(2000 + i, f"Новая {i}", None, tomorrow)
+                            for i in range(5)]
+        db.close()
+        code, _ = await run_until(lambda: len(fake.sent) >= 40 + 25)
+        self.assertEqual(code, 0)
+
+        with open(os.path.join(tmp, 'bot.log'), encoding='utf-8', errors='replace') as f:
+            output = f.read()
+        self.assertEqual(Counter(greetings()), Counter(range(1, 41)), output)
+        reminders = [text for _, text in fake.sent if text.startswith('Напоминание')]
+        self.assertEqual(
+            sorted(int(text.split('(ID: ')[1].split(')')[0]) for text in reminders),
+            sorted(first_reminders + second_reminders), output
+        )
+
+
+    async def test_3_handler_outlives_shutdown_timeout(self):
+        """
+        Тест обработчиков, не уложившихся в SHUTDOWN_TIMEOUT, при групповой записи.
+
+        :assert: Обработчики прерываются, Telegram подтверждаются все апдейты
+        :assert: Апдейт, чье изменение уже зафиксировано, не сохраняется повторно
+        :assert: Изменение прерванного обработчика, не попавшее в транзакцию, отбрасывается
+        :assert: После перезапуска каждая задача есть ровно один раз
+        """
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        db_name = os.path.join(tmp, 'todo.db')
+        db = Database(db_name)
+        db.create_table(None)
+        with mock.patch.dict(os.environ, DB_GROUP_COMMIT_MS='200'):
+            writer = build_writer(db)
+        writer.start()
+        bot = Bot('42:TEST', session=StubSession())
+        bot.get_updates = mock.AsyncMock(return_value=[])
+
+        def raw(update_id, text):
+            return {
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id, 'date': 0, 'text': text,
+                    'chat': {'id': 7, 'type': 'private'},
+                    'from': {'id': 7, 'is_bot': False, 'first_name': 'u'},
+                },
+            }
+
+        committed, submitted = asyncio.Event(), asyncio.Event()
+        handled = []
+
+        first = Dispatcher()
+        inflight = InFlightMiddleware()
+        first.update.outer_middleware(inflight)
+
+        @first.message()
+        async def slow(message):
+            if message.text == 'Раз':
+                await writer.submit('add_task', 7, message.text)
+                committed.set()
+            else:
+                submitted.set()
+                await writer.submit('add_task', 7, message.text)
+            await asyncio.Event().wait()
+
+        tasks = [asyncio.ensure_future(first.feed_raw_update(bot, raw(10, 'Раз')))]
+        await committed.wait()
+        tasks.append(asyncio.ensure_future(first.feed_raw_update(bot, raw(11, 'Два'))))
+        await submitted.wait()
+        await graceful_shutdown(bot, inflight, mock.AsyncMock(), writer, db, timeout=0.05)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(task.cancelled() for task in tasks))
+        bot.get_updates.assert_awaited_once_with(offset=12, limit=1, timeout=0)
+
+        second = Dispatcher()
+        second.update.outer_middleware(InFlightMiddleware())
+        db = Database(db_name)
+        self.addCleanup(db.close)
+
+        @second.message()
+        async def fast(message):
+            handled.append(message.message_id)
+            db.add_task(7, message.text)
+
+        self.assertEqual([task.task_text for task in db.get_tasks(7)], ['Раз'])
+        self.assertEqual(await redeliver(second, bot, db), 1)
+        self.assertEqual(await redeliver(second, bot, db), 0)
+        self.assertEqual(handled, [11])
+        self.assertEqual([task.task_text for task in db.get_tasks(7)], ['Раз', 'Два'])
+
+
+class MenuTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты главного меню на локальном Bot API.
+    """
+
+    @unittest.skipIf(sys.platform == 'win32', 'нужен SIGTERM')
+    async def test_1_back_registers_user_not_bot(self):
+        """
+        Тест кнопки "Назад" под сообщением бота.
+
+        :assert: Меню показывается повторно
+        :assert: В реестр пользователей попадает пользователь, а не бот
+        """
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        fake = FakeTelegram(latency=0)
+        url = await fake.start()
+        self.addAsyncCleanup(fake.stop)
+        fake.add_start_updates([7])
+        fake.updates.append({'update_id': 2, 'callback_query': {
+            'id': '1', 'chat_instance': '1', 'data': 'back_to_start',
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'u'},
+            'message': {
+                'message_id': 1, 'date': int(time.time()), 'text': 'Меню',
+                'chat': {'id': 7, 'type': 'private'},
+                'from': {'id': 42, 'is_bot': True, 'first_name': 'test'},
+            },
+        }})
+        env = dict(os.environ, BOT_TOKEN='42:TEST', BOT_API_SERVER=url,
+                   DEFAULT_TZ='UTC', LOG_LEVEL='WARNING')
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, main_path, cwd=tmp, env=env,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            for _ in range(600):
+                if len(fake.sent) >= 2 or proc.returncode is not None:
+                    break
+                await asyncio.sleep(0.05)
+            proc.send_signal(signal.SIGTERM)
+            await asyncio.wait_for(proc.wait(), 60)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+
+        self.assertEqual([chat for chat, text in fake.sent if text.startswith('Привет')],
+                         [7, 7])
+        conn = sqlite3.connect(os.path.join(tmp, 'todo_bot.db'))
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute('SELECT user_id FROM users').fetchall(), [(7,)])
+
+
+class RecurrenceTest(unittest.TestCase):
+    """
+    Тесты правил повторения задач.
+    """
+
+    def test_1_month_end(self):
+        """
+        Тест месячного правила от последнего дня месяца.
+
+        :assert: День ограничивается длиной короткого месяца
+        :assert: После короткого месяца задача возвращается на исходный день
+        """
+        rule = make_rule('MONTHLY', date(2023, 1, 31))
+        self.assertEqual(rule, 'FREQ=MONTHLY;INTERVAL=1;BYMONTHDAY=31')
+        self.assertEqual(next_due(rule, date(2023, 1, 31)), date(2023, 2, 28))
+        self.assertEqual(next_due(rule, date(2023, 2, 28)), date(2023, 3, 31))
+        self.assertEqual(next_due(rule, date(2023, 3, 31)), date(2023, 4, 30))
+        self.assertEqual(next_due(rule, date(2023, 12, 31)), date(2024, 1, 31))
+
+    def test_2_leap_year(self):
+        """
+        Тест правил, попадающих на 29 февраля.
+
+        :assert: Месячное правило дает 29 февраля в високосный год
+        :assert: Годовое правило от 29 февраля дает 28 февраля и возвращается на 29-е
+        """
+        monthly = make_rule('MONTHLY', date(2024, 1, 30))
+        self.assertEqual(next_due(monthly, date(2024, 1, 30)), date(2024, 2, 29))
+        yearly = make_rule('YEARLY', date(2024, 2, 29))
+        self.assertEqual(next_due(yearly, date(2024, 2, 29)), date(2025, 2, 28))
+        self.assertEqual(next_due(yearly, date(2027, 2, 28)), date(2028, 2, 29))
+
+    def test_3_interval_and_catch_up(self):
+        """
+        Тест шага повторения и пропущенных повторений.
+
+        :assert: INTERVAL умножает шаг
+        :assert: Пропущенные повторения перескакиваются до not_before
+        """
+        self.assertEqual(
+            next_due('FREQ=WEEKLY;INTERVAL=2', date(2030, 1, 1)), date(2030, 1, 15)
+        )
+        self.assertEqual(
+            next_due('FREQ=DAILY', date(2030, 1, 1), date(2030, 3, 1)), date(2030, 3, 1)
+        )
+        self.assertEqual(
+            next_due('FREQ=WEEKLY', date(2030, 1, 1), date(2030, 1, 10)), date(2030, 1, 15)
+        )
+        self.assertEqual(
+            next_due('FREQ=MONTHLY;INTERVAL=3;BYMONTHDAY=31', date(2030, 1, 31),
+                     date(2030, 9, 1)),
+            date(2030, 10, 31)
+        )
+        self.assertEqual(describe('RRULE:FREQ=DAILY;INTERVAL=2'), 'каждый день ×2')
+
+    def test_4_invalid_rules(self):
+        """
+        Тест разбора некорректных правил.
+
+        :assert: Неизвестная частота, шаг и части правила вызывают ValueError
+        """
+        for text in ('FREQ=HOURLY', 'FREQ=DAILY;INTERVAL=0', 'FREQ=DAILY;BYDAY=MO',
+                     'FREQ=MONTHLY;BYMONTHDAY=32', 'DAILY'):
+            with self.assertRaises(ValueError):
+                parse_rule(text)
+
+
 if __name__ == "__main__":
     """
     Точка входа для запуска тестов.
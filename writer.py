@@ -0,0 +1,223 @@
+import asyncio
+import os
+import sqlite3
+
+from database import Database
+from lifecycle import commit_marker
+from models import DEFAULT_REMINDERS
+
+
+class GroupCommitWriter:
+    '''
+    Групповая запись изменений задач в SQLite.
+
+    Изменения от многих одновременных обработчиков копятся в очереди
+    и записываются одной транзакцией раз в max_delay секунд или
+    по набору max_batch операций. Каждый вызов получает свой результат
+    только после фиксации транзакции, поэтому гарантии сохранности
+    не ослабляются, а число fsync на операцию падает.
+
+    Каждая операция выполняется в своей точке сохранения (SAVEPOINT):
+    ошибка одной операции не откатывает остальные в пакете. Операции
+    прерванных (отмененных) вызовов, еще не попавшие в транзакцию,
+    отбрасываются; о зафиксированных сообщается учету апдейтов
+    (lifecycle.commit_marker).
+    '''
+
+    OPERATIONS = (
+        'add_task', 'mark_done', 'complete_task', 'delete_task', 'clear_all_tasks',
+        'undo_last', 'create_list', 'join_list', 'leave_list', 'toggle_reminder'
+    )
+
+    def __init__(self, db, max_batch=256, max_delay=0.005):
+        '''
+        :param db: база данных задач
+        :type db: Database
+        :param max_batch: максимальный размер пакета
+        :type max_batch: int
+        :param max_delay: максимальное ожидание накопления пакета, сек
+        :type max_delay: float
+        '''
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    def start(self):
+        '''
+        Запускает фоновую запись пакетов. Вызывается внутри цикла событий.
+
+        :returns: None
+        '''
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        '''
+        Записывает накопленные изменения и останавливает запись.
+
+        :returns: None
+        '''
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        self._full.set()
+        await self._task
+        self._task = None
+        self._closing = False
+
+    async def submit(self, operation, *args):
+        '''
+        Ставит изменение в очередь и ждет фиксации его пакета.
+
+        :param operation: имя операции из OPERATIONS
+        :type operation: str
+        :returns: результат соответствующего метода Database
+        :raises ValueError: если операция неизвестна
+        :raises RuntimeError: если запись не запущена
+        :raises sqlite3.Error: если операция или фиксация не удались
+        '''
+        if operation not in self.OPERATIONS:
+            raise ValueError(f'Неизвестная операция: {operation}')
+        if self._task is None or self._closing:
+            raise RuntimeError('GroupCommitWriter не запущен')
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((operation, args, future, commit_marker()))
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def add_task(self, user_id, task_text, category=None, deadline=None,
+                       recurrence=None, parent_id=None, list_id=None,
+                       reminders=DEFAULT_REMINDERS):
+        return await self.submit(
+            'add_task', user_id, task_text, category, deadline, recurrence,
+            parent_id, list_id, reminders
+        )
+
+    async def mark_done(self, user_id, task_id):
+        return await self.submit('mark_done', user_id, task_id)
+
+    async def complete_task(self, user_id, task_id, today=None):
+        return await self.submit('complete_task', user_id, task_id, today)
+
+    async def delete_task(self, user_id, task_id):
+        return await self.submit('delete_task', user_id, task_id)
+
+    async def clear_all_tasks(self, user_id):
+        return await self.submit('clear_all_tasks', user_id)
+
+    async def undo_last(self, user_id):
+        return await self.submit('undo_last', user_id)
+
+    async def create_list(self, user_id, title):
+        return await self.submit('create_list', user_id, title)
+
+    async def join_list(self, user_id, invite_code):
+        return await self.submit('join_list', user_id, invite_code)
+
+    async def leave_list(self, user_id, list_id):
+        return await self.submit('leave_list', user_id, list_id)
+
+    async def toggle_reminder(self, user_id, task_id, kind):
+        return await self.submit('toggle_reminder', user_id, task_id, kind)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if self._closing and not self._pending:
+                return
+            if not self._closing and len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+
+    async def _flush(self):
+        '''
+        Записывает один пакет и раздает результаты ожидающим.
+
+        :returns: None
+        '''
+        batch = [item for item in self._pending[:self.max_batch] if not item[2].cancelled()]
+        del self._pending[:self.max_batch]
+        if not self._pending and not self._closing:
+            self._wakeup.clear()
+        if not self._closing:
+            self._full.clear()
+        if not batch:
+            return
+        try:
+            results = await asyncio.to_thread(self._commit, batch)
+        except Exception as e:
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        for (_, _, future, marker), (ok, value) in zip(batch, results):
+            if ok and marker is not None:
+                marker()
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _commit(self, batch):
+        '''
+        Выполняет пакет в одной транзакции соединения-писателя
+        базы данных (в рабочем потоке).
+
+        :returns: список пар (успех, результат или исключение)
+        :rtype: list
+        '''
+        results = []
+        with self.db._write_connection() as conn:
+            cursor = conn.cursor()
+            for operation, args, _, _ in batch:
+                cursor.execute('SAVEPOINT op')
+                try:
+                    value = getattr(self.db, '_' + operation)(cursor, *args)
+                except sqlite3.Error as e:
+                    cursor.execute('ROLLBACK TO op')
+                    results.append((False, e))
+                else:
+                    results.append((True, value))
+                cursor.execute('RELEASE op')
+        return results
+
+
+def build_writer(db):
+    '''
+    Создает групповую запись, если она включена в окружении.
+
+    Переменные окружения:
+        DB_GROUP_COMMIT_MS: окно накопления пакета, мс (не задано - выключено)
+        DB_GROUP_COMMIT_BATCH: максимальный размер пакета (256)
+
+    Групповая запись работает только поверх SQLite: для других
+    хранилищ возвращается None.
+
+    :param db: хранилище задач
+    :type db: TaskStore
+    :returns: объект групповой записи или None
+    :rtype: GroupCommitWriter or None
+    '''
+    delay = os.getenv('DB_GROUP_COMMIT_MS')
+    if not delay or not isinstance(db, Database):
+        return None
+    return GroupCommitWriter(
+        db,
+        max_batch=int(os.getenv('DB_GROUP_COMMIT_BATCH', '256')),
+        max_delay=float(delay) / 1000,
+    )